@@ -0,0 +1,31 @@
+from fastapi import HTTPException
+from cache import user_phones_cache
+from database import get_sessions_async, session_exists_async, associate_session_with_user_async
+
+async def get_user_phones(user_id):
+    """Return the set of phones a user has access to, served from cache when possible."""
+    phones = user_phones_cache.get(user_id)
+    if phones is None:
+        phones = {phone for phone, _, _ in await get_sessions_async(user_id)}
+        user_phones_cache.set(user_id, phones)
+    return phones
+
+async def check_account_access(phone, current_user):
+    """Raise 403 unless the authenticated user may use this account.
+
+    Unauthenticated requests are allowed for backward compatibility, and an existing
+    account that is not yet associated with the user is associated on first use.
+    """
+    if not current_user:
+        return
+    if phone in await get_user_phones(current_user["id"]):
+        return
+    # Check if the account exists but is not associated with this user
+    if await session_exists_async(phone):
+        # Persisted by the write-behind queue; the request does not wait for the commit
+        await associate_session_with_user_async(phone, current_user["id"], wait=False)
+        phones = user_phones_cache.get(current_user["id"])
+        if phones is not None:
+            phones.add(phone)
+    else:
+        raise HTTPException(status_code=403, detail="You don't have access to this account")
@@ -1,4 +1,7 @@
 import secrets
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
@@ -6,15 +9,20 @@ from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
+from cache import token_user_cache
+import config
+import metrics
 
 # Security configuration
-SECRET_KEY = secrets.token_hex(32)
-print(f"Generated SECRET_KEY: {SECRET_KEY}")
+SECRET_KEY = config.SECRET_KEY
+if not SECRET_KEY:
+    SECRET_KEY = secrets.token_hex(32)
+    print(f"Generated SECRET_KEY: {SECRET_KEY}")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 1 week
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing. Hashes made with a different number of rounds are upgraded on login.
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 # Models
@@ -41,6 +49,61 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+# bcrypt is CPU bound, so it runs on a bounded worker pool instead of the event loop
+hash_executor = ThreadPoolExecutor(max_workers=config.HASH_WORKERS, thread_name_prefix="bcrypt")
+_hash_inflight = 0
+hash_stats = {
+    "count": 0,
+    "rejected": 0,
+    "time_total": 0.0,
+    "time_max": 0.0,
+}
+
+async def _run_hash(func, *args):
+    """Run a hashing function on the worker pool, shedding load when it is saturated."""
+    global _hash_inflight
+    if _hash_inflight >= config.HASH_WORKERS + config.HASH_QUEUE_DEPTH:
+        hash_stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many concurrent login attempts, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    _hash_inflight += 1
+    started = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(hash_executor, func, *args)
+    finally:
+        _hash_inflight -= 1
+        elapsed = time.perf_counter() - started
+        hash_stats["count"] += 1
+        hash_stats["time_total"] += elapsed
+        hash_stats["time_max"] = max(hash_stats["time_max"], elapsed)
+        metrics.span_latency.observe(elapsed, span="bcrypt")
+
+async def verify_password_async(plain_password, hashed_password):
+    """Verify a password off the event loop.
+
+    Returns (valid, new_hash) where new_hash is set when the stored hash should be
+    replaced because the configured bcrypt rounds changed.
+    """
+    return await _run_hash(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_hash(pwd_context.hash, password)
+
+def get_hash_stats():
+    count = hash_stats["count"]
+    return {
+        **hash_stats,
+        "inflight": _hash_inflight,
+        "workers": config.HASH_WORKERS,
+        "queue_depth": config.HASH_QUEUE_DEPTH,
+        "rounds": config.BCRYPT_ROUNDS,
+        "time_avg": hash_stats["time_total"] / count if count else 0.0,
+    }
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -54,6 +117,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     if token is None:
         return None
+    with metrics.span("get_current_user"):
+        return await _get_current_user(token)
+
+async def _get_current_user(token):
+    # Serve recently validated tokens without decoding or a database lookup
+    user = token_user_cache.get(token)
+    if user is not None:
+        return user
         
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -70,8 +141,13 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     
     # Get user from database
-    from database import get_user_by_username
-    user = get_user_by_username(token_data.username)
+    from database import get_user_by_username_async
+    user = await get_user_by_username_async(token_data.username)
     if user is None:
         raise credentials_exception
+    
+    # Never cache a token beyond its own expiry
+    ttl = min(token_user_cache.ttl, payload.get("exp", 0) - time.time())
+    if ttl > 0:
+        token_user_cache.set(token, user, ttl=ttl)
     return user
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""Offline load test of the API with fake Telegram clients.
+
+Runs the FastAPI app in-process with TelegramClient replaced by the stub in
+fake_telegram.py, seeds users and accounts, measures startup warm-up and then
+drives /login/, /list_accounts/, /get_chats/, /get_messages/ and /send_message/
+with concurrent simulated users, reporting req/s and p50/p99 latency. Each
+account count runs in its own process against a throwaway database.
+
+Usage: python benchmarks/bench_api.py [--accounts 10,100,1000] [--requests 500]
+       [--concurrency 50] [--latency-ms 50] [--connect-ms 200] [--flood-rate 0.0] [--verbose]
+"""
+import argparse
+import asyncio
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+ACCOUNTS_PER_USER = 5
+PASSWORD = "bench-password"
+
+def report(line):
+    # Results go to stderr; the app's own logging on stdout is hidden unless --verbose
+    print(line, file=sys.stderr, flush=True)
+
+def seed(accounts):
+    import auth
+    import database
+    from session_store import write_changes
+
+    # Hash once: seeding thousands of users should not take minutes of bcrypt
+    hashed = auth.pwd_context.hash(PASSWORD)
+    users = []
+    for i in range((accounts + ACCOUNTS_PER_USER - 1) // ACCOUNTS_PER_USER):
+        user = database.create_user(f"bench{i}", f"bench{i}@example.com", hashed_password=hashed)
+        users.append({"username": user["username"], "email": user["email"], "phones": []})
+    for j in range(accounts):
+        phone = f"+1555{j:06d}"
+        user = users[j // ACCOUNTS_PER_USER]
+        database.add_session(phone, 1, "hash", database.get_user_by_username(user["username"])["id"])
+        write_changes([{"phone": phone, "session": (2, "127.0.0.1", 443, b"", None),
+                        "entities": [], "update_states": [], "files": []}])
+        user["phones"].append(phone)
+    return users
+
+async def run(name, request, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = collections.Counter()
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            status = await request(i)
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    codes = " ".join(f"{code}x{count}" for code, count in sorted(statuses.items()))
+    report(f"  {name:<15} {total / elapsed:8.1f} req/s  "
+           f"p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms  "
+           f"p99 {latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000:7.1f} ms  [{codes}]")
+
+async def bench_scale(args):
+    import httpx
+    import fake_telegram
+    fake_telegram.settings.update(
+        latency=args.latency_ms / 1000,
+        connect_latency=args.connect_ms / 1000,
+        flood_rate=args.flood_rate,
+    )
+    fake_telegram.install()
+
+    import main
+    from auth import create_access_token
+    from session_manager import load_sessions_on_startup, disconnect_all_clients, warmup_status
+
+    users = seed(args.scale)
+    report(f"{args.scale} accounts, {len(users)} users")
+
+    started = time.perf_counter()
+    await load_sessions_on_startup()
+    report(f"  {'warm-up':<15} {time.perf_counter() - started:8.2f} s     "
+           f"({warmup_status['loaded']} loaded, {warmup_status['failed']} failed)")
+
+    tokens = [{"Authorization": f"Bearer {create_access_token({'sub': u['username']})}"} for u in users]
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+
+        def user(i):
+            return users[i % len(users)], tokens[i % len(tokens)]
+
+        async def login(i):
+            u, _ = user(i)
+            r = await http.post("/login/", data={"username": u["email"], "password": PASSWORD})
+            return r.status_code
+
+        async def list_accounts(i):
+            _, headers = user(i)
+            return (await http.get("/list_accounts/", headers=headers)).status_code
+
+        async def get_chats(i):
+            u, headers = user(i)
+            phone = u["phones"][i % len(u["phones"])]
+            return (await http.get("/get_chats/", params={"phone": phone}, headers=headers)).status_code
+
+        async def get_messages(i):
+            u, headers = user(i)
+            phone = u["phones"][i % len(u["phones"])]
+            chat_id = 1000 + i % fake_telegram.settings["dialogs"]
+            params = {"phone": phone, "chat_id": chat_id, "limit": 50}
+            return (await http.get("/get_messages/", params=params, headers=headers)).status_code
+
+        async def send_message(i):
+            u, headers = user(i)
+            phone = u["phones"][i % len(u["phones"])]
+            body = {"phone": phone, "recipient": f"user{1000 + i % 50}", "message": f"bench {i}"}
+            return (await http.post("/send_message/", json=body, headers=headers)).status_code
+
+        await run("login", login, min(args.requests, args.login_requests), args.concurrency)
+        for name, request in (("list_accounts", list_accounts), ("get_chats", get_chats),
+                              ("get_messages", get_messages), ("send_message", send_message)):
+            await run(name, request, args.requests, args.concurrency)
+
+    await disconnect_all_clients()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", default="10,100,1000", help="comma-separated account counts")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--login-requests", type=int, default=50, help="bcrypt makes logins slow by design")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=50, help="simulated Telegram round trip")
+    parser.add_argument("--connect-ms", type=float, default=200, help="simulated client connect time")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="fraction of sends hitting FloodWait")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        asyncio.run(bench_scale(args))
+        return
+
+    # One process per scale so every run starts from an empty database and pool
+    passthrough = [
+        "--requests", str(args.requests), "--login-requests", str(args.login_requests),
+        "--concurrency", str(args.concurrency), "--latency-ms", str(args.latency_ms),
+        "--connect-ms", str(args.connect_ms), "--flood-rate", str(args.flood_rate),
+    ]
+    for accounts in args.accounts.split(","):
+        env = dict(
+            os.environ,
+            DB_PATH=os.path.join(tempfile.mkdtemp(), "bench.db"),
+            POOL_MAX_ACTIVE=str(max(int(accounts), 1)),
+            SESSION_BACKEND="db",
+            SHARD_ROLE="",
+            PYTHONPATH=os.pathsep.join([BACKEND_DIR, BENCH_DIR]),
+        )
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--scale", accounts, *passthrough],
+            cwd=BACKEND_DIR, env=env, check=True,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Compare request throughput of blocking vs. pooled async database access.
+
+Simulates concurrent API requests that each look up a user and their sessions and
+then await some network I/O (standing in for the Telegram call). The "blocking"
+mode calls the sqlite functions directly on the event loop, as the handlers did
+before; the "async" mode uses the *_async functions backed by the DB thread pool.
+
+Usage: python benchmarks/bench_db.py [--requests 2000] [--concurrency 50] [--io-ms 2]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# Use a throwaway database so the benchmark never touches sessions.db
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+USERS = 200
+ACCOUNTS_PER_USER = 5
+
+def seed():
+    for i in range(USERS):
+        user = database.create_user(f"user{i}", f"user{i}@example.com", hashed_password="x")
+        for j in range(ACCOUNTS_PER_USER):
+            database.add_session(f"+{i:04d}{j:02d}", 1, "hash", user["id"])
+    return [database.get_user_by_email(f"user{i}@example.com")["username"] for i in range(USERS)]
+
+async def blocking_request(username, io_delay):
+    user = database.get_user_by_username(username)
+    database.get_sessions(user["id"])
+    await asyncio.sleep(io_delay)
+
+async def async_request(username, io_delay):
+    user = await database.get_user_by_username_async(username)
+    await database.get_sessions_async(user["id"])
+    await asyncio.sleep(io_delay)
+
+async def run(handler, usernames, total, concurrency, io_delay):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(usernames[i % len(usernames)], io_delay)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "req_per_s": total / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--io-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"Seeding {USERS} users x {ACCOUNTS_PER_USER} accounts into {database.db_path}")
+    usernames = seed()
+
+    for name, handler in (("blocking", blocking_request), ("async", async_request)):
+        result = asyncio.run(run(handler, usernames, args.requests, args.concurrency, args.io_ms / 1000))
+        print(f"{name:>8}: {result['req_per_s']:8.1f} req/s  "
+              f"p50 {result['p50_ms']:6.2f} ms  p99 {result['p99_ms']:6.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare encoders and compression for large /get_messages/ and /get_chats/ payloads.
+
+Builds a page of messages and a dialog list of the given sizes and times:
+FastAPI's default path (jsonable_encoder + stdlib json), responses.dumps_json
+(orjson when installed), MessagePack, and gzip/brotli on top of the JSON body.
+For chats it also times DialogCache.page() cold and with its pre-shaped dicts.
+
+Usage: python benchmarks/bench_serialization.py [--messages 10000] [--dialogs 5000] [--rounds 5]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+import config  # noqa: E402
+import responses  # noqa: E402
+from dialog_cache import DialogCache  # noqa: E402
+from message_store import _row_to_message  # noqa: E402
+
+def make_messages(count):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(count):
+        media = '{"type": "photo", "mime_type": "image/jpeg", "size": 123456, "has_thumb": true}' if i % 10 == 0 else None
+        rows.append((
+            i + 1, f"Message {i} with some ordinary chat text, a link https://example.com/{i} and émojis 🙂",
+            (start + timedelta(seconds=37 * i)).isoformat(), i % 3 == 0, 1000 + i % 7,
+            i - 1 if i % 5 == 0 and i else None, media,
+        ))
+    return {"messages": [_row_to_message(row) for row in rows]}
+
+def make_dialogs(count):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        SimpleNamespace(id=-100_000_000 - i, name=f"Chat number {i}", unread_count=i % 4,
+                        date=start + timedelta(minutes=i), message=SimpleNamespace(id=10_000 + i))
+        for i in range(count)
+    ]
+
+def timed(func, rounds):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def fastapi_default(content):
+    # What JSONResponse does with an endpoint's dict return value
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode()
+
+def report(name, seconds, size=None):
+    line = f"  {name:<28} {seconds * 1000:9.2f} ms"
+    if size is not None:
+        line += f"  {size / 1024:9.1f} KiB"
+    print(line)
+
+def bench_payload(title, content, rounds):
+    print(title)
+    seconds, body = timed(lambda: fastapi_default(content), rounds)
+    report("jsonable_encoder + json", seconds, len(body))
+    encoder = "orjson" if responses.orjson is not None else "json (orjson not installed)"
+    seconds, body = timed(lambda: responses.dumps_json(content), rounds)
+    report(encoder, seconds, len(body))
+    if responses.msgpack is not None:
+        seconds, packed = timed(lambda: responses.msgpack.packb(content, default=responses._default), rounds)
+        report("msgpack", seconds, len(packed))
+    seconds, compressed = timed(lambda: gzip.compress(body, compresslevel=config.GZIP_LEVEL), rounds)
+    report(f"gzip level {config.GZIP_LEVEL}", seconds, len(compressed))
+    if responses.brotli is not None:
+        seconds, compressed = timed(lambda: responses.brotli.compress(body, quality=config.BROTLI_QUALITY), rounds)
+        report(f"brotli quality {config.BROTLI_QUALITY}", seconds, len(compressed))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--dialogs", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    bench_payload(f"{args.messages} messages", make_messages(args.messages), args.rounds)
+
+    cache = DialogCache()
+    cache.load(make_dialogs(args.dialogs))
+    print(f"{args.dialogs} dialogs, shaping")
+    cache._shaped.clear()
+    started = time.perf_counter()
+    chats, _ = cache.page()
+    report("page() cold", time.perf_counter() - started)
+    seconds, _ = timed(cache.page, args.rounds)
+    report("page() pre-shaped", seconds)
+    bench_payload(f"{args.dialogs} dialogs, encoding", {"chats": chats, "version": cache.version, "delta": False}, args.rounds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Local stand-in for telethon.TelegramClient used by the offline benchmarks.
+
+Every network call sleeps for a configurable latency and returns generated
+dialogs and messages; a fraction of sends can fail with FloodWaitError. Install
+it with install(), which replaces the TelegramClient used by session_manager.
+"""
+import asyncio
+import datetime
+import random
+from telethon import types
+from telethon.errors import FloodWaitError
+
+# Tunables, set by the benchmark before the app connects any client
+settings = {
+    "latency": 0.05,      # seconds per simulated Telegram request
+    "connect_latency": 0.2,
+    "dialogs": 50,
+    "messages": 1000,     # messages per chat
+    "flood_rate": 0.0,    # fraction of send_message calls raising FloodWaitError
+    "flood_seconds": 5,
+}
+
+_EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeMessage:
+    def __init__(self, chat_id, msg_id):
+        self.id = msg_id
+        self.chat_id = chat_id
+        self.text = f"message {msg_id} in chat {chat_id}"
+        self.date = _EPOCH + datetime.timedelta(minutes=msg_id)
+        self.out = msg_id % 3 == 0
+        self.sender_id = chat_id
+        self.reply_to_msg_id = msg_id - 1 if msg_id % 10 == 0 else None
+
+
+class FakeDialog:
+    def __init__(self, index, is_self=False):
+        # Index 0 with is_self is the account's own "Saved Messages" chat
+        user_id = 1 if is_self else 1000 + index
+        name = "Saved Messages" if is_self else f"User {index}"
+        self.entity = types.User(id=user_id, is_self=is_self, access_hash=user_id * 7, username=f"user{user_id}", first_name=name)
+        self.id = user_id
+        self.name = name
+        self.unread_count = index % 4
+        self.message = FakeMessage(user_id, settings["messages"])
+        self.date = self.message.date - datetime.timedelta(hours=index)
+
+
+class FakeTelegramClient:
+    def __init__(self, session, api_id, api_hash):
+        self.session = session
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self._connected = False
+
+    async def _network(self):
+        await asyncio.sleep(settings["latency"])
+
+    async def connect(self):
+        await asyncio.sleep(settings["connect_latency"])
+        self._connected = True
+
+    def is_connected(self):
+        return self._connected
+
+    async def disconnect(self):
+        self._connected = False
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+    async def send_code_request(self, phone):
+        await self._network()
+
+    async def sign_in(self, phone, code):
+        await self._network()
+
+    async def get_me(self):
+        await self._network()
+        return types.User(id=1, is_self=True, access_hash=7, first_name="Bench")
+
+    async def get_dialogs(self, limit=None):
+        await self._network()
+        return [FakeDialog(0, is_self=True)] + [FakeDialog(i) for i in range(1, settings["dialogs"])]
+
+    async def get_input_entity(self, peer):
+        await self._network()
+        if isinstance(peer, int):
+            return types.InputPeerUser(peer, peer * 7)
+        return types.InputPeerUser(abs(hash(peer)) % 10 ** 9, 1)
+
+    async def get_messages(self, entity, limit=20, min_id=0, offset_id=0, reverse=False):
+        await self._network()
+        chat_id = getattr(entity, "user_id", 0)
+        newest = settings["messages"]
+        if reverse:
+            ids = range(max(min_id, offset_id) + 1, min(newest, max(min_id, offset_id) + limit) + 1)
+        else:
+            top = offset_id - 1 if offset_id else newest
+            ids = [i for i in range(top, max(min_id, top - limit), -1)]
+        return [FakeMessage(chat_id, i) for i in ids]
+
+    async def send_message(self, entity, message):
+        await self._network()
+        if random.random() < settings["flood_rate"]:
+            raise FloodWaitError(request=None, capture=settings["flood_seconds"])
+        return FakeMessage(getattr(entity, "user_id", 0), settings["messages"] + 1)
+
+
+def install():
+    """Make the app create FakeTelegramClients instead of real ones."""
+    import session_manager
+    session_manager.TelegramClient = FakeTelegramClient
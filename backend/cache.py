@@ -0,0 +1,60 @@
+import time
+import config
+
+
+class TTLCache:
+    """Small in-memory cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        if key not in self._data and len(self._data) >= self.maxsize:
+            # Drop the oldest inserted entry
+            del self._data[next(iter(self._data))]
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        now = time.monotonic()
+        return [(key, value) for key, (expires, value) in list(self._data.items()) if expires >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+
+# user_id -> set of phones the user has access to
+user_phones_cache = TTLCache(ttl=config.ACCESS_CACHE_TTL)
+# JWT -> user dict decoded from it
+token_user_cache = TTLCache(ttl=config.TOKEN_CACHE_TTL)
+
+def invalidate_user(user_id):
+    """Forget the cached accounts of a user after their associations changed."""
+    user_phones_cache.invalidate(user_id)
+
+def invalidate_phone(phone):
+    """Forget every cached association of an account, e.g. after its session was removed."""
+    for user_id, phones in user_phones_cache.items():
+        if phone in phones:
+            user_phones_cache.invalidate(user_id)
+
+def invalidate_all():
+    user_phones_cache.clear()
+    token_user_cache.clear()
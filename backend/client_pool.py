@@ -0,0 +1,236 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+
+class ClientPool:
+    """LRU pool of TelegramClients that are connected lazily on first use.
+
+    Every known account is registered with its API credentials, but only up to
+    `max_active` clients are kept connected at once. The least recently used
+    client is disconnected when the pool is full, and clients left idle longer
+    than `idle_ttl` seconds are disconnected by the reaper. A disconnected
+    account is reconnected transparently the next time it is acquired. Clients
+    held through lease() are in use and are neither evicted nor reaped, so the
+    pool may briefly exceed `max_active` while they all are.
+    """
+
+    def __init__(self, connect, max_active=100, idle_ttl=600):
+        # connect(phone, api_id, api_hash) -> connected client, or None if unauthorized
+        self._connect = connect
+        self.max_active = max_active
+        self.idle_ttl = idle_ttl
+        self._credentials = {}
+        self._active = OrderedDict()
+        self._last_used = {}
+        # phone -> number of lease() blocks currently using the client
+        self._leases = {}
+        self._locks = {}
+        # Callbacks called as hook(phone, client) when a client is connected or disconnected
+        self.on_connect = []
+        self.on_disconnect = []
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "idle_disconnects": 0,
+            "connect_failures": 0,
+            "connects": 0,
+            "connect_time_total": 0.0,
+            "connect_time_max": 0.0,
+        }
+
+    # Dict-like access to the registered accounts and connected clients
+
+    def __contains__(self, phone):
+        return phone in self._credentials or phone in self._active
+
+    def __getitem__(self, phone):
+        return self._active[phone]
+
+    def __len__(self):
+        return len(self._active)
+
+    def get(self, phone, default=None):
+        return self._active.get(phone, default)
+
+    def items(self):
+        return list(self._active.items())
+
+    def phones(self):
+        return list(self._credentials)
+
+    async def add(self, phone, client):
+        """Add an already connected client, e.g. one that just finished logging in."""
+        self._credentials[phone] = (client.api_id, client.api_hash)
+        self._active[phone] = client
+        self._touch(phone)
+        self._run_hooks(self.on_connect, phone, client)
+        await self._evict_over_capacity(keep=phone)
+
+    def register(self, phone, api_id, api_hash):
+        """Make an account known to the pool without connecting it."""
+        self._credentials[phone] = (api_id, api_hash)
+
+    def is_connected(self, phone):
+        return phone in self._active
+
+    async def acquire(self, phone):
+        """Return a connected client for `phone`, connecting it if needed.
+
+        Returns None if the account is unknown, unauthorized or cannot be connected.
+        """
+        client = self._active.get(phone)
+        if client is not None:
+            self.stats["hits"] += 1
+            self._touch(phone)
+            return client
+
+        if phone not in self._credentials:
+            return None
+
+        lock = self._locks.setdefault(phone, asyncio.Lock())
+        async with lock:
+            # Another request may have connected it while we waited for the lock
+            client = self._active.get(phone)
+            if client is not None:
+                self.stats["hits"] += 1
+                self._touch(phone)
+                return client
+
+            self.stats["misses"] += 1
+            api_id, api_hash = self._credentials[phone]
+            started = time.perf_counter()
+            try:
+                client = await self._connect(phone, api_id, api_hash)
+            except Exception as e:
+                self.stats["connect_failures"] += 1
+                print(f"Error connecting client for {phone}: {str(e)}")
+                return None
+            elapsed = time.perf_counter() - started
+            self.stats["connects"] += 1
+            self.stats["connect_time_total"] += elapsed
+            self.stats["connect_time_max"] = max(self.stats["connect_time_max"], elapsed)
+
+            if client is None:
+                print(f"Session for {phone} is not authorized, removing it from the pool")
+                self._credentials.pop(phone, None)
+                return None
+
+            self._active[phone] = client
+            self._touch(phone)
+            self._run_hooks(self.on_connect, phone, client)
+
+        await self._evict_over_capacity(keep=phone)
+        return client
+
+    @asynccontextmanager
+    async def lease(self, phone, connect=True):
+        """Acquire a client and keep it connected until the block exits.
+
+        Use it around work that must not lose its connection halfway, like a
+        download, an export or a send. Yields None when acquire() would. With
+        connect=False only an already connected client is leased and its idle time
+        is left alone, for background work that should not keep an account connected.
+        """
+        client = await self.acquire(phone) if connect else self._active.get(phone)
+        if client is None:
+            yield None
+            return
+        self._leases[phone] = self._leases.get(phone, 0) + 1
+        try:
+            yield client
+        finally:
+            self._leases[phone] -= 1
+            if not self._leases[phone]:
+                del self._leases[phone]
+            if connect and self._active.get(phone) is client:
+                # Idle time counts from the end of the work
+                self._touch(phone)
+            # Capacity that was held by leased clients can be reclaimed now
+            await self._evict_over_capacity()
+
+    async def remove(self, phone):
+        """Forget an account entirely, disconnecting its client if connected."""
+        self._credentials.pop(phone, None)
+        self._locks.pop(phone, None)
+        await self._disconnect(phone)
+
+    async def disconnect(self, phone):
+        """Disconnect an account's client but keep it registered, so it reconnects on next use."""
+        await self._disconnect(phone)
+
+    async def reap_idle(self):
+        """Disconnect clients that have not been used for `idle_ttl` seconds."""
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [
+            phone for phone in self._active
+            if phone not in self._leases and self._last_used.get(phone, 0) < cutoff
+        ]
+        for phone in idle:
+            self.stats["idle_disconnects"] += 1
+            await self._disconnect(phone)
+        return len(idle)
+
+    async def run_reaper(self, interval=60):
+        """Periodically disconnect idle clients until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                reaped = await self.reap_idle()
+                if reaped:
+                    print(f"Disconnected {reaped} idle Telegram clients")
+            except Exception as e:
+                print(f"Error reaping idle clients: {str(e)}")
+
+    async def close(self):
+        """Disconnect every connected client."""
+        for phone in list(self._active):
+            await self._disconnect(phone)
+
+    def get_stats(self):
+        connects = self.stats["connects"]
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "active": len(self._active),
+            "leased": len(self._leases),
+            "registered": len(self._credentials),
+            "max_active": self.max_active,
+            "idle_ttl": self.idle_ttl,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "connect_time_avg": self.stats["connect_time_total"] / connects if connects else 0.0,
+        }
+
+    def _run_hooks(self, hooks, phone, client):
+        for hook in hooks:
+            try:
+                hook(phone, client)
+            except Exception as e:
+                print(f"Error in client pool hook for {phone}: {str(e)}")
+
+    def _touch(self, phone):
+        self._active.move_to_end(phone)
+        self._last_used[phone] = time.monotonic()
+
+    async def _evict_over_capacity(self, keep=None):
+        while len(self._active) > self.max_active:
+            # Least recently used first, skipping clients in use
+            phone = next((p for p in self._active if p not in self._leases and p != keep), None)
+            if phone is None:
+                return
+            self.stats["evictions"] += 1
+            await self._disconnect(phone)
+
+    async def _disconnect(self, phone):
+        client = self._active.pop(phone, None)
+        self._last_used.pop(phone, None)
+        if client is None:
+            return
+        self._run_hooks(self.on_disconnect, phone, client)
+        try:
+            await client.disconnect()
+            print(f"Disconnected client for {phone}")
+        except Exception as e:
+            print(f"Error disconnecting client for {phone}: {str(e)}")
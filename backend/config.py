@@ -1 +1,130 @@
+import os
 
+# Telegram API credentials
+API_ID = int(os.getenv("API_ID", "0"))
+API_HASH = os.getenv("API_HASH", "")
+
+# JWT signing key; generated at startup when unset. Must be shared by all shard processes.
+SECRET_KEY = os.getenv("SECRET_KEY", "")
+
+# Session warm-up on startup
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "20"))
+WARMUP_CONNECT_TIMEOUT = float(os.getenv("WARMUP_CONNECT_TIMEOUT", "15"))
+WARMUP_RETRIES = int(os.getenv("WARMUP_RETRIES", "3"))
+WARMUP_BACKOFF = float(os.getenv("WARMUP_BACKOFF", "1.0"))
+# Fraction of sessions that must be processed before /ready/ reports ready
+READY_THRESHOLD = float(os.getenv("READY_THRESHOLD", "0.9"))
+
+# Telegram client pool
+POOL_MAX_ACTIVE = int(os.getenv("POOL_MAX_ACTIVE", "100"))
+POOL_IDLE_TTL = float(os.getenv("POOL_IDLE_TTL", "600"))
+POOL_REAP_INTERVAL = float(os.getenv("POOL_REAP_INTERVAL", "60"))
+
+# Authorization caches (seconds)
+ACCESS_CACHE_TTL = float(os.getenv("ACCESS_CACHE_TTL", "300"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "60"))
+
+# Database connection pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+# Session upserts and user-account associations are batched into one commit per interval
+DB_WRITE_INTERVAL = float(os.getenv("DB_WRITE_INTERVAL", "0.05"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "200"))
+
+# Password hashing
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+# Hash requests allowed to wait for a worker before new ones get a 429
+HASH_QUEUE_DEPTH = int(os.getenv("HASH_QUEUE_DEPTH", "16"))
+
+# Real-time event stream
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", "15"))
+
+# Batch sending: per-account rate limit (messages per second) and burst size
+SEND_RATE = float(os.getenv("SEND_RATE", "1.0"))
+SEND_BURST = int(os.getenv("SEND_BURST", "5"))
+SEND_MAX_FLOOD_RETRIES = int(os.getenv("SEND_MAX_FLOOD_RETRIES", "3"))
+# Seconds to keep finished batch jobs around for status queries
+SEND_JOB_RETENTION = float(os.getenv("SEND_JOB_RETENTION", "3600"))
+
+# Identical concurrent Telegram calls are made once; results are reused for SINGLEFLIGHT_TTL seconds
+SINGLEFLIGHT_TTL = float(os.getenv("SINGLEFLIGHT_TTL", "1"))
+
+# Entity resolution cache (seconds); negative entries are for unknown usernames/phones
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "86400"))
+ENTITY_NEGATIVE_TTL = float(os.getenv("ENTITY_NEGATIVE_TTL", "600"))
+
+# Sharding accounts across worker processes (see run_sharded.py).
+# SHARD_ROLE is "front", "worker" or empty for a single process.
+SHARD_ROLE = os.getenv("SHARD_ROLE", "")
+SHARD_ID = os.getenv("SHARD_ID", "")
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "4"))
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "shards"))
+SHARD_REPLICAS = int(os.getenv("SHARD_REPLICAS", "100"))
+SHARD_MEMBERSHIP_INTERVAL = float(os.getenv("SHARD_MEMBERSHIP_INTERVAL", "5"))
+SHARD_PROXY_TIMEOUT = float(os.getenv("SHARD_PROXY_TIMEOUT", "60"))
+
+# Telegram session storage: "db" keeps every account's state in sessions.db,
+# "file" uses one sessions/<phone>.session file per account
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "db")
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "2"))
+SESSION_FLUSH_BATCH = int(os.getenv("SESSION_FLUSH_BATCH", "50"))
+
+# Streaming chat export: pause between history requests, flood waits tolerated before giving up
+EXPORT_WAIT_TIME = float(os.getenv("EXPORT_WAIT_TIME", "1"))
+EXPORT_MAX_FLOOD_WAIT = int(os.getenv("EXPORT_MAX_FLOOD_WAIT", "300"))
+EXPORT_MAX_FLOOD_WAITS = int(os.getenv("EXPORT_MAX_FLOOD_WAITS", "5"))
+
+# Aggregated inbox: accounts fetched at once and the time each one gets
+INBOX_CONCURRENCY = int(os.getenv("INBOX_CONCURRENCY", "10"))
+INBOX_ACCOUNT_TIMEOUT = float(os.getenv("INBOX_ACCOUNT_TIMEOUT", "10"))
+
+# Connection health supervisor: ping interval and batch size, reconnect backoff
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "60"))
+HEALTH_BATCH_SIZE = int(os.getenv("HEALTH_BATCH_SIZE", "20"))
+HEALTH_PING_TIMEOUT = float(os.getenv("HEALTH_PING_TIMEOUT", "10"))
+HEALTH_RECONNECT_ATTEMPTS = int(os.getenv("HEALTH_RECONNECT_ATTEMPTS", "5"))
+HEALTH_RECONNECT_BACKOFF = float(os.getenv("HEALTH_RECONNECT_BACKOFF", "1"))
+HEALTH_RECONNECT_MAX = float(os.getenv("HEALTH_RECONNECT_MAX", "60"))
+
+# Media proxy: on-disk cache of downloaded photos and documents
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024 ** 3)))
+
+# Login flow: pending logins expire after LOGIN_PENDING_TTL seconds, at most LOGIN_MAX_PENDING at once
+LOGIN_PENDING_TTL = float(os.getenv("LOGIN_PENDING_TTL", "300"))
+LOGIN_MAX_PENDING = int(os.getenv("LOGIN_MAX_PENDING", "50"))
+LOGIN_RESEND_INTERVAL = float(os.getenv("LOGIN_RESEND_INTERVAL", "60"))
+LOGIN_EXPIRE_INTERVAL = float(os.getenv("LOGIN_EXPIRE_INTERVAL", "30"))
+
+# Full-text search: background indexer pass interval, pages of SEARCH_INDEX_PAGE messages
+SEARCH_INDEX_INTERVAL = float(os.getenv("SEARCH_INDEX_INTERVAL", "300"))
+SEARCH_INDEX_PAGE = int(os.getenv("SEARCH_INDEX_PAGE", "100"))
+SEARCH_INDEX_WAIT = float(os.getenv("SEARCH_INDEX_WAIT", "1"))
+SEARCH_INDEX_DIALOGS = int(os.getenv("SEARCH_INDEX_DIALOGS", "200"))
+SEARCH_INDEX_CONCURRENCY = int(os.getenv("SEARCH_INDEX_CONCURRENCY", "2"))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+
+# Response compression: bodies of at least COMPRESS_MIN_SIZE bytes are sent brotli or gzip encoded
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+# Scheduled messages: jobs due within SCHEDULE_LOOKAHEAD seconds are loaded SCHEDULE_BATCH at a time
+# every SCHEDULE_REFRESH_INTERVAL seconds; jobs of one account are SCHEDULE_ACCOUNT_SPACING seconds
+# apart plus up to SCHEDULE_JITTER seconds of random delay
+SCHEDULE_LOOKAHEAD = float(os.getenv("SCHEDULE_LOOKAHEAD", "60"))
+SCHEDULE_REFRESH_INTERVAL = float(os.getenv("SCHEDULE_REFRESH_INTERVAL", "10"))
+SCHEDULE_BATCH = int(os.getenv("SCHEDULE_BATCH", "500"))
+SCHEDULE_ACCOUNT_SPACING = float(os.getenv("SCHEDULE_ACCOUNT_SPACING", "1"))
+SCHEDULE_JITTER = float(os.getenv("SCHEDULE_JITTER", "5"))
+SCHEDULE_MAX_ATTEMPTS = int(os.getenv("SCHEDULE_MAX_ATTEMPTS", "5"))
+SCHEDULE_RETRY_DELAY = float(os.getenv("SCHEDULE_RETRY_DELAY", "30"))
+SCHEDULE_MIN_INTERVAL = float(os.getenv("SCHEDULE_MIN_INTERVAL", "60"))
+
+# Contact import: phone numbers per ImportContactsRequest, pause between requests, flood waits slept through
+CONTACTS_IMPORT_BATCH = int(os.getenv("CONTACTS_IMPORT_BATCH", "100"))
+CONTACTS_IMPORT_INTERVAL = float(os.getenv("CONTACTS_IMPORT_INTERVAL", "2"))
+CONTACTS_IMPORT_MAX = int(os.getenv("CONTACTS_IMPORT_MAX", "10000"))
+CONTACTS_MAX_FLOOD_WAIT = int(os.getenv("CONTACTS_MAX_FLOOD_WAIT", "300"))
@@ -0,0 +1,290 @@
+import asyncio
+import csv
+import json
+import time
+import uuid
+from telethon import functions, types, utils
+from telethon.errors import FloodWaitError, RPCError
+import config
+import entity_cache
+import metrics
+from health import INVALID_SESSION_ERRORS
+from database import run_db
+from session_manager import clients
+
+stats = {
+    "jobs": 0,
+    "imported": 0,
+    "resolved": 0,
+    "already_known": 0,
+    "not_found": 0,
+    "failed": 0,
+    "flood_waits": 0,
+}
+
+
+class ImportJob:
+    """Progress of one contact import."""
+
+    def __init__(self, user_id, phone, total):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.phone = phone
+        self.total = total
+        self.imported = 0
+        self.already_known = 0
+        self.not_found = 0
+        self.failed = 0
+        self.errors = []
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def pending(self):
+        return self.total - self.imported - self.already_known - self.not_found - self.failed
+
+    def record(self, outcome, count=1):
+        setattr(self, outcome, getattr(self, outcome) + count)
+        stats[outcome] += count
+
+    def record_failure(self, recipient, error):
+        self.record("failed")
+        # Keep the report bounded for huge address books
+        if len(self.errors) < 100:
+            self.errors.append({"recipient": recipient, "error": error})
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "phone": self.phone,
+            "status": self.status,
+            "total": self.total,
+            "imported": self.imported,
+            "already_known": self.already_known,
+            "not_found": self.not_found,
+            "failed": self.failed,
+            "pending": self.pending,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+jobs = {}
+# One import at a time per account; Telegram limits imports per account, not per request
+_locks = {}
+
+# Parsing
+
+def _contact(recipient, first_name="", last_name=""):
+    recipient = str(recipient).strip()
+    if not recipient:
+        return None
+    return {"recipient": recipient, "first_name": (first_name or "").strip(), "last_name": (last_name or "").strip()}
+
+async def _lines(stream):
+    """Decode a byte stream into lines without reading the whole body first."""
+    buffer = b""
+    first = True
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig" if first else "utf-8").rstrip("\r")
+            first = False
+    if buffer:
+        yield buffer.decode("utf-8-sig" if first else "utf-8").rstrip("\r")
+
+async def read_contacts(stream, content_type):
+    """Parse an uploaded address book into contact dicts.
+
+    CSV may have a header naming phone/username/first_name/last_name columns;
+    without one the columns are recipient, first name, last name. JSON is a list
+    of recipients or of objects with those keys, optionally under "contacts".
+    Raises ValueError for malformed input or more than CONTACTS_IMPORT_MAX contacts.
+    """
+    contacts = []
+
+    def add(contact):
+        if contact is None:
+            return
+        if len(contacts) >= config.CONTACTS_IMPORT_MAX:
+            raise ValueError(f"At most {config.CONTACTS_IMPORT_MAX} contacts per import")
+        contacts.append(contact)
+
+    if "json" in content_type:
+        body = b"".join([chunk async for chunk in stream])
+        data = json.loads(body)
+        if isinstance(data, dict):
+            data = data.get("contacts")
+        if not isinstance(data, list):
+            raise ValueError("Expected a list of contacts")
+        for item in data:
+            if isinstance(item, dict):
+                recipient = item.get("phone") or item.get("username") or item.get("recipient") or ""
+                add(_contact(recipient, item.get("first_name"), item.get("last_name")))
+            else:
+                add(_contact(item))
+        return contacts
+
+    header = None
+    async for line in _lines(stream):
+        if not line.strip():
+            continue
+        row = next(csv.reader([line]))
+        if header is None and contacts == [] and any(
+            column.strip().lower() in ("phone", "username", "recipient") for column in row
+        ):
+            header = [column.strip().lower() for column in row]
+            continue
+        if header is not None:
+            item = dict(zip(header, row))
+            recipient = item.get("phone") or item.get("username") or item.get("recipient") or ""
+            add(_contact(recipient, item.get("first_name"), item.get("last_name")))
+        else:
+            add(_contact(*row[:3]))
+    return contacts
+
+# Import
+
+def _is_phone(key):
+    return key.startswith("+")
+
+async def _with_flood_wait(job, call):
+    """Return `await call()`, sleeping through flood waits of up to CONTACTS_MAX_FLOOD_WAIT seconds."""
+    while True:
+        try:
+            return await call()
+        except FloodWaitError as e:
+            stats["flood_waits"] += 1
+            metrics.flood_waits.inc(source="contact_import")
+            if e.seconds > config.CONTACTS_MAX_FLOOD_WAIT:
+                raise
+            print(f"Flood wait of {e.seconds}s importing contacts for {job.phone}")
+            job.status = "waiting"
+            await asyncio.sleep(e.seconds)
+            job.status = "running"
+
+async def _import_phones(job, client, batch):
+    """Import one batch of phone numbers and cache the users they belong to."""
+    by_client_id = {i: contact for i, contact in enumerate(batch)}
+    request = functions.contacts.ImportContactsRequest([
+        types.InputPhoneContact(
+            client_id=i, phone=contact["key"],
+            first_name=contact["first_name"] or contact["key"], last_name=contact["last_name"],
+        )
+        for i, contact in by_client_id.items()
+    ])
+    with metrics.span("import_contacts"):
+        result = await _with_flood_wait(job, lambda: client(request))
+
+    users = {user.id: user for user in result.users}
+    found = []
+    for imported in result.imported:
+        contact = by_client_id.pop(imported.client_id, None)
+        user = users.get(imported.user_id)
+        if contact is not None and user is not None:
+            found.append((contact["key"], utils.get_input_peer(user)))
+    retry = set(result.retry_contacts)
+    for client_id in retry:
+        contact = by_client_id.pop(client_id, None)
+        if contact is not None:
+            job.record_failure(contact["recipient"], "Telegram refused the import, retry later")
+
+    # Phone keys for the sends; ids and usernames for everything else
+    await entity_cache.remember(job.phone, found)
+    await entity_cache.remember_entities(job.phone, result.users)
+    job.record("imported", len(found))
+    # Numbers without a Telegram account are remembered briefly, like failed resolutions
+    missing = list(by_client_id.values())
+    if missing:
+        await entity_cache.remember(
+            job.phone, [(contact["key"], None) for contact in missing], ttl=config.ENTITY_NEGATIVE_TTL
+        )
+        job.record("not_found", len(missing))
+
+async def _resolve_username(job, client, contact):
+    try:
+        await _with_flood_wait(job, lambda: entity_cache.resolve(client, job.phone, contact["recipient"]))
+        job.record("imported")
+        stats["resolved"] += 1
+    except ValueError:
+        job.record("not_found")
+    except (FloodWaitError, *INVALID_SESSION_ERRORS):
+        # Long flood waits and dead sessions stop the whole import
+        raise
+    except RPCError as e:
+        job.record_failure(contact["recipient"], str(e))
+
+async def _run(job, contacts):
+    async with _locks.setdefault(job.phone, asyncio.Lock()):
+        job.status = "running"
+        try:
+            # Leased so the client stays connected for the whole import
+            async with clients.lease(job.phone) as client:
+                if client is None:
+                    raise RuntimeError("Account not connected")
+
+                # Recipients resolved before (by earlier imports, dialogs or sends) need no request
+                for contact in contacts:
+                    contact["key"] = entity_cache.normalize_key(contact["recipient"])
+                known = await run_db(entity_cache.load_known_keys, job.phone, {c["key"] for c in contacts})
+                todo = []
+                seen = set()
+                for contact in contacts:
+                    if contact["key"] in known or contact["key"] in seen:
+                        job.record("already_known")
+                    elif contact["key"].lstrip("-").isdigit():
+                        job.record_failure(contact["recipient"], "Peer ids cannot be imported")
+                    else:
+                        seen.add(contact["key"])
+                        todo.append(contact)
+
+                phones = [contact for contact in todo if _is_phone(contact["key"])]
+                for start in range(0, len(phones), config.CONTACTS_IMPORT_BATCH):
+                    if start:
+                        await asyncio.sleep(config.CONTACTS_IMPORT_INTERVAL)
+                    await _import_phones(job, client, phones[start:start + config.CONTACTS_IMPORT_BATCH])
+                # Usernames have no bulk request; entity_cache.resolve() looks them up one by one
+                for contact in todo:
+                    if not _is_phone(contact["key"]):
+                        await _resolve_username(job, client, contact)
+            job.status = "done"
+        except FloodWaitError as e:
+            job.status = "failed"
+            job.errors.append({"recipient": None, "error": f"Flood wait of {e.seconds}s, import stopped"})
+        except Exception as e:
+            job.status = "failed"
+            job.errors.append({"recipient": None, "error": str(e)})
+        finally:
+            job.finished_at = time.time()
+            if job.status == "failed":
+                job.record("failed", job.pending)
+
+def _prune_jobs():
+    cutoff = time.time() - config.SEND_JOB_RETENTION
+    for job_id, job in list(jobs.items()):
+        if job.finished_at is not None and job.finished_at < cutoff:
+            del jobs[job_id]
+
+def submit_import(user_id, phone, contacts):
+    """Start importing `contacts` into an account in the background and return the ImportJob."""
+    _prune_jobs()
+    job = ImportJob(user_id, phone, len(contacts))
+    jobs[job.id] = job
+    stats["jobs"] += 1
+    job.task = asyncio.create_task(_run(job, contacts))
+    return job
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+def get_stats():
+    return {**stats, "running": sum(1 for job in jobs.values() if job.finished_at is None)}
+
+async def shutdown():
+    for job in jobs.values():
+        if job.task and not job.task.done():
+            job.task.cancel()
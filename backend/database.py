@@ -1,158 +1,293 @@
 import sqlite3
 import os
 import uuid
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from auth import get_password_hash
+import cache
+import config
+import metrics
+import migrations
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-db_path = os.path.join(BASE_DIR, 'sessions.db')
-conn = sqlite3.connect(db_path, check_same_thread=False)
-cursor = conn.cursor()
-
-# Create tables if they don't exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS sessions (
-        phone TEXT PRIMARY KEY,
-        api_id INTEGER,
-        api_hash TEXT
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id TEXT PRIMARY KEY,
-        username TEXT UNIQUE,
-        email TEXT UNIQUE,
-        hashed_password TEXT,
-        disabled INTEGER DEFAULT 0
-    )
-''')
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS user_accounts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT NOT NULL,
-        phone TEXT NOT NULL,
-        UNIQUE(user_id, phone)
-    )
-''')
-
-conn.commit()
-
-# Check if user_id column exists in sessions table
-cursor.execute("PRAGMA table_info(sessions)")
-columns = cursor.fetchall()
-column_names = [column[1] for column in columns]
-
-if 'user_id' not in column_names:
-    try:
-        print("Adding user_id column to sessions table...")
-        cursor.execute("ALTER TABLE sessions ADD COLUMN user_id TEXT")
-        conn.commit()
-        print("Column added successfully.")
-    except sqlite3.OperationalError as e:
-        print(f"Error adding user_id column: {str(e)}")
+db_path = os.getenv("DB_PATH", os.path.join(BASE_DIR, 'sessions.db'))
+
+# Each DB worker thread owns one connection, so the executor doubles as the connection pool
+_local = threading.local()
+db_executor = ThreadPoolExecutor(max_workers=config.DB_POOL_SIZE, thread_name_prefix="db")
+
+def get_connection():
+    """Return this thread's SQLite connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # cached_statements keeps prepared statements around for reuse
+        conn = sqlite3.connect(db_path, timeout=config.DB_BUSY_TIMEOUT, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function on the DB thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+# Bring the schema up to date; see migrations.py
+migrations.migrate(get_connection())
+
+def _user_from_row(user):
+    if user:
+        return {
+            "id": user[0],
+            "username": user[1],
+            "email": user[2],
+            "hashed_password": user[3],
+            "disabled": bool(user[4])
+        }
+    return None
 
 # User management functions
-def create_user(username, email, password):
+def create_user(username, email, password=None, hashed_password=None):
+    conn = get_connection()
     user_id = str(uuid.uuid4())
-    hashed_password = get_password_hash(password)
-    
+    if hashed_password is None:
+        hashed_password = get_password_hash(password)
+
     try:
-        cursor.execute(
+        conn.execute(
             "INSERT INTO users (id, username, email, hashed_password) VALUES (?, ?, ?, ?)",
             (user_id, username, email, hashed_password)
         )
         conn.commit()
         return {"id": user_id, "username": username, "email": email}
     except sqlite3.IntegrityError:
+        conn.rollback()
         # Check if username or email already exists
-        cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?", (username, email))
-        result = cursor.fetchone()
+        result = conn.execute("SELECT id FROM users WHERE username = ? OR email = ?", (username, email)).fetchone()
         if result:
             return None
         raise
 
 def get_user_by_username(username):
-    cursor.execute("SELECT id, username, email, hashed_password, disabled FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    if user:
-        return {
-            "id": user[0],
-            "username": user[1],
-            "email": user[2],
-            "hashed_password": user[3],
-            "disabled": bool(user[4])
-        }
-    return None
+    user = get_connection().execute(
+        "SELECT id, username, email, hashed_password, disabled FROM users WHERE username = ?", (username,)
+    ).fetchone()
+    return _user_from_row(user)
 
 def get_user_by_email(email):
-    cursor.execute("SELECT id, username, email, hashed_password, disabled FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-    if user:
-        return {
-            "id": user[0],
-            "username": user[1],
-            "email": user[2],
-            "hashed_password": user[3],
-            "disabled": bool(user[4])
-        }
-    return None
+    user = get_connection().execute(
+        "SELECT id, username, email, hashed_password, disabled FROM users WHERE email = ?", (email,)
+    ).fetchone()
+    return _user_from_row(user)
+
+def update_password_hash(user_id, hashed_password):
+    conn = get_connection()
+    conn.execute("UPDATE users SET hashed_password = ? WHERE id = ?", (hashed_password, user_id))
+    conn.commit()
 
 # Session management functions
-def add_session(phone, api_id, api_hash, user_id=None):
+_UPSERT_SESSION = (
+    "INSERT INTO sessions (phone, api_id, api_hash) VALUES (?, ?, ?) "
+    "ON CONFLICT(phone) DO UPDATE SET api_id = excluded.api_id, api_hash = excluded.api_hash"
+)
+_ASSOCIATE = "INSERT INTO user_accounts (user_id, phone) VALUES (?, ?) ON CONFLICT(user_id, phone) DO NOTHING"
+
+def write_accounts(sessions, associations):
+    """Upsert (phone, api_id, api_hash) sessions and (user_id, phone) associations in one transaction."""
+    conn = get_connection()
     try:
-        # Check if session exists
-        cursor.execute("SELECT phone FROM sessions WHERE phone = ?", (phone,))
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Update existing session
-            cursor.execute("UPDATE sessions SET api_id = ?, api_hash = ? WHERE phone = ?",
-                       (api_id, api_hash, phone))
-        else:
-            # Insert new session
-            cursor.execute("INSERT INTO sessions (phone, api_id, api_hash) VALUES (?, ?, ?)",
-                       (phone, api_id, api_hash))
-        
-        # If user_id is provided, associate this account with the user
-        if user_id:
-            associate_session_with_user(phone, user_id)
-            
+        if sessions:
+            conn.executemany(_UPSERT_SESSION, sessions)
+        if associations:
+            conn.executemany(_ASSOCIATE, associations)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for phone, _, _ in sessions:
+        cache.invalidate_phone(phone)
+    for user_id in {user_id for user_id, _ in associations}:
+        cache.invalidate_user(user_id)
+
+def add_session(phone, api_id, api_hash, user_id=None):
+    try:
+        write_accounts([(phone, api_id, api_hash)], [(user_id, phone)] if user_id else [])
     except Exception as e:
         print(f"Error in add_session: {str(e)}")
         raise
 
 def get_sessions(user_id=None):
+    conn = get_connection()
     try:
         if user_id:
             # Get sessions associated with this user from the user_accounts table
-            cursor.execute("""
-                SELECT s.phone, s.api_id, s.api_hash 
+            return conn.execute("""
+                SELECT s.phone, s.api_id, s.api_hash
                 FROM sessions s
                 JOIN user_accounts ua ON s.phone = ua.phone
                 WHERE ua.user_id = ?
-            """, (user_id,))
-        else:
-            cursor.execute("SELECT phone, api_id, api_hash FROM sessions")
-        return cursor.fetchall()
+            """, (user_id,)).fetchall()
+        return conn.execute("SELECT phone, api_id, api_hash FROM sessions").fetchall()
     except sqlite3.OperationalError as e:
         print(f"Database error in get_sessions: {str(e)}")
         # Fallback to getting all sessions if there's an error
-        cursor.execute("SELECT phone, api_id, api_hash FROM sessions")
-        return cursor.fetchall()
+        return conn.execute("SELECT phone, api_id, api_hash FROM sessions").fetchall()
 
 def associate_session_with_user(phone, user_id):
     try:
-        # Add to user_accounts table (many-to-many relationship)
-        cursor.execute("INSERT OR IGNORE INTO user_accounts (user_id, phone) VALUES (?, ?)", 
-                      (user_id, phone))
-        conn.commit()
+        write_accounts([], [(user_id, phone)])
         return True
     except sqlite3.OperationalError as e:
         print(f"Error in associate_session_with_user: {str(e)}")
         return False
 
+def session_exists(phone):
+    return get_connection().execute("SELECT 1 FROM sessions WHERE phone = ?", (phone,)).fetchone() is not None
+
+def delete_session(phone):
+    conn = get_connection()
+    conn.execute("DELETE FROM sessions WHERE phone = ?", (phone,))
+    conn.commit()
+    cache.invalidate_phone(phone)
+
 def is_account_associated_with_user(phone, user_id):
-    cursor.execute("SELECT 1 FROM user_accounts WHERE user_id = ? AND phone = ?", (user_id, phone))
-    return cursor.fetchone() is not None
\ No newline at end of file
+    return get_connection().execute(
+        "SELECT 1 FROM user_accounts WHERE user_id = ? AND phone = ?", (user_id, phone)
+    ).fetchone() is not None
+
+# Async versions that run on the DB thread pool so they never block the event loop
+async def create_user_async(username, email, password=None, hashed_password=None):
+    return await run_db(create_user, username, email, password, hashed_password)
+
+async def get_user_by_username_async(username):
+    return await run_db(get_user_by_username, username)
+
+async def get_user_by_email_async(email):
+    return await run_db(get_user_by_email, email)
+
+async def update_password_hash_async(user_id, hashed_password):
+    return await run_db(update_password_hash, user_id, hashed_password)
+
+async def add_session_async(phone, api_id, api_hash, user_id=None):
+    """Queue a session upsert (and association) and wait until its batch is committed."""
+    await account_writer.upsert_session(phone, api_id, api_hash, user_id)
+
+async def get_sessions_async(user_id=None):
+    with metrics.span("get_sessions"):
+        return await run_db(get_sessions, user_id)
+
+async def associate_session_with_user_async(phone, user_id, wait=True):
+    """Queue an association; with wait=False return without waiting for the commit."""
+    future = account_writer.associate(phone, user_id)
+    if wait:
+        await future
+    else:
+        # Failures are already logged by the writer
+        future.add_done_callback(lambda f: f.exception())
+    return True
+
+async def session_exists_async(phone):
+    return await run_db(session_exists, phone)
+
+async def delete_session_async(phone):
+    return await run_db(delete_session, phone)
+
+
+class AccountWriter:
+    """Write-behind queue that coalesces session upserts and user associations.
+
+    Writes queued by concurrent requests are committed together in a single
+    transaction every DB_WRITE_INTERVAL seconds, or as soon as DB_WRITE_BATCH are
+    waiting. Callers get a future resolved once their batch is committed, so
+    awaiting it keeps read-your-writes; close() flushes everything on shutdown.
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._sessions = {}
+        self._associations = set()
+        self._waiters = []
+        self._task = None
+        self._wakeup = None
+        self.stats = {"batches": 0, "sessions_written": 0, "associations_written": 0, "coalesced": 0, "errors": 0}
+
+    def _queue(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append(future)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        if len(self._sessions) + len(self._associations) >= self.batch_size:
+            self._wakeup.set()
+        return future
+
+    def upsert_session(self, phone, api_id, api_hash, user_id=None):
+        if phone in self._sessions:
+            self.stats["coalesced"] += 1
+        self._sessions[phone] = (api_id, api_hash)
+        if user_id:
+            self._associations.add((user_id, phone))
+        return self._queue()
+
+    def associate(self, phone, user_id):
+        if (user_id, phone) in self._associations:
+            self.stats["coalesced"] += 1
+        self._associations.add((user_id, phone))
+        return self._queue()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not (self._sessions or self._associations or self._waiters):
+            return
+        sessions = [(phone, api_id, api_hash) for phone, (api_id, api_hash) in self._sessions.items()]
+        associations = list(self._associations)
+        waiters = self._waiters
+        self._sessions, self._associations, self._waiters = {}, set(), []
+        try:
+            await run_db(write_accounts, sessions, associations)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Error writing account batch: {str(e)}")
+            # Keep the writes for the next flush unless newer ones replaced them
+            for phone, api_id, api_hash in sessions:
+                self._sessions.setdefault(phone, (api_id, api_hash))
+            self._associations.update(associations)
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.stats["batches"] += 1
+        self.stats["sessions_written"] += len(sessions)
+        self.stats["associations_written"] += len(associations)
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def close(self):
+        """Stop the background flusher and commit everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+        if self._sessions or self._associations:
+            # The last flush failed; try once more before giving up
+            await self.flush()
+        if self._sessions or self._associations:
+            print(f"Lost {len(self._sessions)} session and {len(self._associations)} association writes")
+
+    def get_stats(self):
+        return {**self.stats, "queued": len(self._sessions) + len(self._associations)}
+
+
+account_writer = AccountWriter(config.DB_WRITE_INTERVAL, config.DB_WRITE_BATCH)
@@ -0,0 +1,176 @@
+import itertools
+import time
+from telethon import events, utils
+import entity_cache
+import metrics
+from singleflight import telegram_calls
+
+# Versions are global and seeded from the clock, so a reloaded cache (even after a restart)
+# always moves past any version or ETag a client has already seen
+_versions = itertools.count(int(time.time() * 1000))
+
+
+class DialogCache:
+    """Per-account cache of dialogs, kept current from Telethon update events."""
+
+    def __init__(self):
+        self.dialogs = {}
+        self.changed = {}
+        # Dialogs in their API shape, built once per change instead of on every page
+        self._shaped = {}
+        self.base_version = 0
+        self.version = 0
+        self.loaded = False
+
+    def load(self, dialogs):
+        """Replace the cache with a full get_dialogs() result."""
+        self.version = self.base_version = next(_versions)
+        self.dialogs = {}
+        self.changed = {}
+        self._shaped = {}
+        for dialog in dialogs:
+            self.dialogs[dialog.id] = {
+                "id": dialog.id,
+                "name": dialog.name,
+                "unread_count": dialog.unread_count,
+                "date": dialog.date,
+                "top_message_id": dialog.message.id if dialog.message else 0,
+            }
+        self.loaded = True
+
+    def update(self, dialog_id, **fields):
+        dialog = self.dialogs.get(dialog_id)
+        if dialog is None:
+            return
+        dialog.update(fields)
+        self._bump(dialog_id)
+
+    def add(self, dialog):
+        self.dialogs[dialog["id"]] = dialog
+        self._bump(dialog["id"])
+
+    def invalidate(self):
+        """Force a full reload on the next request."""
+        self.loaded = False
+
+    def etag(self):
+        return f'"{self.version}"'
+
+    def page(self, limit=None, offset_date=None, since=None):
+        """Return (chats, is_delta) with chats sorted by last message date, newest first.
+
+        With `since`, only dialogs changed after that version are returned, unless the
+        cache was reloaded since then, in which case the full list is returned.
+        The chat dicts are shared between requests and must not be modified.
+        """
+        is_delta = since is not None and since >= self.base_version
+        if is_delta:
+            dialogs = [self.dialogs[i] for i, v in self.changed.items() if v > since]
+        else:
+            dialogs = list(self.dialogs.values())
+
+        dialogs.sort(key=_sort_key, reverse=True)
+        if offset_date is not None:
+            dialogs = [d for d in dialogs if d["date"] is not None and d["date"] < offset_date]
+        if limit is not None:
+            dialogs = dialogs[:limit]
+        return [self._chat(d) for d in dialogs], is_delta
+
+    def _chat(self, dialog):
+        chat = self._shaped.get(dialog["id"])
+        if chat is None:
+            chat = self._shaped[dialog["id"]] = _to_chat(dialog)
+        return chat
+
+    def _bump(self, dialog_id):
+        self._shaped.pop(dialog_id, None)
+        self.version = next(_versions)
+        self.changed[dialog_id] = self.version
+
+
+def _sort_key(dialog):
+    date = dialog["date"]
+    return date.timestamp() if date is not None else 0
+
+# Fields of a chat as returned by the API; /get_chats/?fields= selects a subset
+CHAT_FIELDS = ("id", "name", "unread_count", "date")
+
+def _to_chat(dialog):
+    return {
+        "id": dialog["id"],
+        "name": dialog["name"],
+        "unread_count": dialog["unread_count"],
+        "date": dialog["date"].isoformat() if dialog["date"] is not None else None,
+    }
+
+
+dialog_caches = {}
+
+async def get_dialog_cache(client, phone):
+    """Return the account's dialog cache, doing a full get_dialogs() only when it is not loaded."""
+    cache = dialog_caches.setdefault(phone, DialogCache())
+    if not cache.loaded:
+        # Concurrent first requests for the account share one get_dialogs() call. Not kept
+        # afterwards: a reload after invalidate() must see the current dialogs.
+        with metrics.span("get_dialogs"):
+            dialogs = await telegram_calls.do((phone, "get_dialogs"), client.get_dialogs, ttl=0)
+        if not cache.loaded:
+            cache.load(dialogs)
+            # Warm the entity cache so sends and history views of these chats skip resolution
+            await entity_cache.remember_entities(phone, [dialog.entity for dialog in dialogs])
+    return cache
+
+def attach(phone, client):
+    """Register the update handlers that keep the dialog cache of `phone` current."""
+
+    async def on_new_message(event):
+        cache = dialog_caches.get(phone)
+        if cache is None or not cache.loaded:
+            return
+        dialog = cache.dialogs.get(event.chat_id)
+        if dialog is None:
+            chat = await event.get_chat()
+            cache.add({
+                "id": event.chat_id,
+                "name": utils.get_display_name(chat) if chat else "",
+                "unread_count": 0 if event.out else 1,
+                "date": event.date,
+                "top_message_id": event.id,
+            })
+            return
+        cache.update(
+            event.chat_id,
+            date=event.date,
+            top_message_id=event.id,
+            unread_count=dialog["unread_count"] + (0 if event.out else 1),
+        )
+
+    async def on_message_read(event):
+        cache = dialog_caches.get(phone)
+        if cache is None or not cache.loaded or not event.inbox:
+            return
+        dialog = cache.dialogs.get(event.chat_id)
+        if dialog is not None and event.max_id >= dialog["top_message_id"]:
+            cache.update(event.chat_id, unread_count=0)
+        elif dialog is not None:
+            # Partially read; the exact unread count is only known after a reload
+            cache.invalidate()
+
+    async def on_chat_action(event):
+        cache = dialog_caches.get(phone)
+        if cache is None or not cache.loaded:
+            return
+        if event.new_title:
+            cache.update(event.chat_id, name=event.new_title)
+        else:
+            # Joins, leaves, deletions etc. can add or remove dialogs
+            cache.invalidate()
+
+    client.add_event_handler(on_new_message, events.NewMessage())
+    client.add_event_handler(on_message_read, events.MessageRead())
+    client.add_event_handler(on_chat_action, events.ChatAction())
+
+def detach(phone, client):
+    """Drop the cache of a disconnected account, since it no longer receives updates."""
+    dialog_caches.pop(phone, None)
+    telegram_calls.forget(phone)
@@ -0,0 +1,176 @@
+import json
+import time
+from telethon import types, utils
+import config
+from cache import TTLCache
+from database import get_connection, run_db
+
+# In-memory layer in front of the table: (phone, key) -> InputPeer, or None for negative entries
+_memory = TTLCache(ttl=config.ENTITY_CACHE_TTL, maxsize=100000)
+_MISSING = object()
+
+stats = {
+    "memory_hits": 0,
+    "db_hits": 0,
+    "negative_hits": 0,
+    "misses": 0,
+    "resolve_failures": 0,
+}
+
+def normalize_key(recipient):
+    """Map the different spellings of a recipient to one cache key."""
+    if isinstance(recipient, int):
+        return str(recipient)
+    value = str(recipient).strip()
+    for prefix in ("https://t.me/", "http://t.me/", "t.me/", "@"):
+        if value.lower().startswith(prefix):
+            value = value[len(prefix):]
+            break
+    if value.startswith("-") and value[1:].isdigit():
+        return str(int(value))
+    # Like Telethon, treat other numeric strings as phone numbers
+    digits = "".join(ch for ch in value if ch.isdigit())
+    if value.startswith("+") or (digits and value.replace(" ", "").replace("-", "") == digits):
+        return "+" + digits
+    return value.lower()
+
+def _to_row(peer):
+    if isinstance(peer, types.InputPeerUser):
+        return "user", peer.user_id, peer.access_hash
+    if isinstance(peer, types.InputPeerChat):
+        return "chat", peer.chat_id, 0
+    if isinstance(peer, types.InputPeerChannel):
+        return "channel", peer.channel_id, peer.access_hash
+    if isinstance(peer, types.InputPeerSelf):
+        return "self", 0, 0
+    return None
+
+def _from_row(peer_type, peer_id, access_hash):
+    if peer_type == "user":
+        return types.InputPeerUser(peer_id, access_hash)
+    if peer_type == "chat":
+        return types.InputPeerChat(peer_id)
+    if peer_type == "channel":
+        return types.InputPeerChannel(peer_id, access_hash)
+    if peer_type == "self":
+        return types.InputPeerSelf()
+    return None
+
+# Blocking helpers, run on the DB executor
+
+def load_entity(phone, key):
+    """Return (InputPeer or None for a negative entry, expires_at), or _MISSING."""
+    row = get_connection().execute(
+        "SELECT peer_type, peer_id, access_hash, expires_at FROM entities WHERE phone = ? AND key = ?",
+        (phone, key)
+    ).fetchone()
+    if row is None or row[3] < time.time():
+        return _MISSING
+    return _from_row(row[0], row[1], row[2]), row[3]
+
+def store_entities(phone, entries, ttl):
+    """Store (key, InputPeer or None) pairs; None records a negative entry."""
+    expires_at = time.time() + ttl
+    rows = []
+    for key, peer in entries:
+        row = _to_row(peer) if peer is not None else (None, None, None)
+        if row is not None:
+            rows.append((phone, key, *row, expires_at))
+    conn = get_connection()
+    conn.executemany(
+        "INSERT OR REPLACE INTO entities (phone, key, peer_type, peer_id, access_hash, expires_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+
+def load_known_keys(phone, keys):
+    """Return the subset of `keys` with a live, positive entry for the account."""
+    rows = get_connection().execute(
+        "SELECT key FROM entities WHERE phone = ? AND key IN (SELECT value FROM json_each(?)) "
+        "AND peer_type IS NOT NULL AND expires_at > ?",
+        (phone, json.dumps(list(keys)), time.time())
+    )
+    return {row[0] for row in rows}
+
+def delete_account_entities(phone):
+    conn = get_connection()
+    conn.execute("DELETE FROM entities WHERE phone = ?", (phone,))
+    conn.commit()
+    for (cached_phone, key), _ in _memory.items():
+        if cached_phone == phone:
+            _memory.invalidate((cached_phone, key))
+
+# Async API
+
+async def remember(phone, entries, ttl=None):
+    """Cache already resolved (recipient, InputPeer) pairs, e.g. from dialogs or imported contacts.
+
+    Recipients are given as they would be passed to resolve(): peer ids as ints,
+    usernames and phone numbers as strings.
+    """
+    ttl = config.ENTITY_CACHE_TTL if ttl is None else ttl
+    entries = [(normalize_key(key), peer) for key, peer in entries]
+    for key, peer in entries:
+        _memory.set((phone, key), peer, ttl=ttl)
+    await run_db(store_entities, phone, entries, ttl)
+
+async def remember_entities(phone, entities):
+    """Cache users, chats and channels by peer id and by username."""
+    entries = []
+    for entity in entities:
+        try:
+            # InputPeerSelf has no peer id and is only valid on this one session
+            peer = utils.get_input_peer(entity, allow_self=False)
+        except TypeError:
+            continue
+        entries.append((utils.get_peer_id(peer), peer))
+        username = getattr(entity, "username", None)
+        if username:
+            entries.append((username, peer))
+        entity_phone = getattr(entity, "phone", None)
+        if entity_phone:
+            entries.append(("+" + entity_phone, peer))
+    if entries:
+        await remember(phone, entries)
+
+async def resolve(client, phone, recipient):
+    """Resolve a recipient (username, phone number or peer id) to an InputPeer.
+
+    Raises ValueError for recipients Telegram does not know. Unknown usernames and
+    phone numbers are remembered for ENTITY_NEGATIVE_TTL seconds so repeated
+    attempts skip the network; peer ids are not, since they only fail until the
+    session has seen the peer (e.g. after the next get_dialogs).
+    """
+    key = normalize_key(recipient)
+    peer = _memory.get((phone, key), _MISSING)
+    if peer is not _MISSING:
+        stats["memory_hits"] += 1
+    else:
+        found = await run_db(load_entity, phone, key)
+        if found is not _MISSING:
+            stats["db_hits"] += 1
+            peer, expires_at = found
+            _memory.set((phone, key), peer, ttl=expires_at - time.time())
+        else:
+            peer = _MISSING
+
+    if peer is None:
+        stats["negative_hits"] += 1
+        raise ValueError(f'Cannot find any entity corresponding to "{recipient}"')
+    if peer is not _MISSING:
+        return peer
+
+    stats["misses"] += 1
+    try:
+        peer = await client.get_input_entity(recipient)
+    except ValueError:
+        stats["resolve_failures"] += 1
+        if not key.lstrip("-").isdigit():
+            await remember(phone, [(recipient, None)], ttl=config.ENTITY_NEGATIVE_TTL)
+        raise
+    await remember(phone, [(recipient, peer)])
+    return peer
+
+def get_stats():
+    return {**stats, "memory_entries": len(_memory)}
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from telethon import events
+import config
+from message_store import format_message
+from sharding import shards
+
+_sequence = itertools.count()
+
+
+class Subscription:
+    """Bounded event buffer for one browser connection.
+
+    Events with a coalescing key replace a pending event with the same key, so a burst
+    of read receipts for one chat is delivered once. When the buffer is full the oldest
+    event is dropped and the client receives an "overflow" event telling it to refetch.
+    """
+
+    def __init__(self, phones, maxsize=256):
+        self.phones = set(phones)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.coalesced = 0
+        self._pending = OrderedDict()
+        self._overflow = 0
+        self._ready = asyncio.Event()
+
+    def put(self, event, key=None):
+        if key is None:
+            key = next(_sequence)
+        elif key in self._pending:
+            del self._pending[key]
+            self.coalesced += 1
+        if len(self._pending) >= self.maxsize:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+            self._overflow += 1
+        self._pending[key] = event
+        self._ready.set()
+
+    async def get(self, timeout):
+        """Wait up to `timeout` seconds and return every pending event (possibly none)."""
+        if not self._pending:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = list(self._pending.values())
+        if self._overflow:
+            batch.insert(0, {"type": "overflow", "dropped": self._overflow})
+            self._overflow = 0
+        self._pending.clear()
+        self._ready.clear()
+        return batch
+
+
+class EventHub:
+    """Fans out Telegram updates of each account to every subscribed connection.
+
+    One set of Telethon handlers is registered per connected client, no matter how many
+    browser connections are listening to that account.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self.stats = {"published": 0, "delivered": 0}
+
+    def subscribe(self, phones, maxsize=256):
+        subscription = Subscription(phones, maxsize)
+        for phone in subscription.phones:
+            self._subscribers.setdefault(phone, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for phone in subscription.phones:
+            subscribers = self._subscribers.get(phone)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[phone]
+
+    def has_subscribers(self, phone):
+        return bool(self._subscribers.get(phone))
+
+    def publish(self, phone, event, key=None):
+        subscribers = self._subscribers.get(phone)
+        if not subscribers:
+            return
+        self.stats["published"] += 1
+        for subscription in subscribers:
+            subscription.put(event, key)
+            self.stats["delivered"] += 1
+
+    def attach(self, phone, client):
+        """Register the account's update handlers; used as a client pool on_connect hook."""
+
+        async def on_new_message(event):
+            if not self.has_subscribers(phone):
+                return
+            self.publish(phone, {
+                "type": "new_message",
+                "phone": phone,
+                "chat_id": event.chat_id,
+                "message": format_message(event.message),
+            })
+
+        async def on_message_read(event):
+            if not self.has_subscribers(phone):
+                return
+            self.publish(phone, {
+                "type": "message_read",
+                "phone": phone,
+                "chat_id": event.chat_id,
+                "max_id": event.max_id,
+                "inbox": event.inbox,
+            }, key=(phone, event.chat_id, "message_read", event.inbox))
+
+        async def on_chat_action(event):
+            if not self.has_subscribers(phone):
+                return
+            self.publish(phone, {
+                "type": "chat_action",
+                "phone": phone,
+                "chat_id": event.chat_id,
+                "new_title": event.new_title,
+                "user_joined": event.user_joined,
+                "user_left": event.user_left or event.user_kicked,
+            })
+
+        client.add_event_handler(on_new_message, events.NewMessage())
+        client.add_event_handler(on_message_read, events.MessageRead())
+        client.add_event_handler(on_chat_action, events.ChatAction())
+
+    def get_stats(self):
+        subscriptions = {s for subs in self._subscribers.values() for s in subs}
+        return {
+            **self.stats,
+            "connections": len(subscriptions),
+            "accounts": len(self._subscribers),
+            "dropped": sum(s.dropped for s in subscriptions),
+            "coalesced": sum(s.coalesced for s in subscriptions),
+        }
+
+
+hub = EventHub()
+
+# Sharded mode: the front holds no clients, so it relays the streams of the workers
+
+async def _read_worker_events(worker_id, phones, token, headers, queue):
+    query = {"phones": ",".join(sorted(phones))}
+    if token:
+        query["token"] = token
+    try:
+        upstream = await shards.forward(worker_id, "GET", "/events/", query, headers, b"", stream=True)
+        try:
+            if upstream.status_code != 200:
+                await upstream.aread()
+                raise RuntimeError(upstream.json().get("detail", f"HTTP {upstream.status_code}"))
+            buffer = ""
+            async for text in upstream.aiter_text():
+                buffer += text
+                # Pass on whole events only, so events of different workers never interleave
+                *complete, buffer = buffer.split("\n\n")
+                for event in complete:
+                    await queue.put(event + "\n\n")
+        finally:
+            await upstream.aclose()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Error relaying events from shard {worker_id}: {str(e)}")
+    # Tell the relay this stream ended
+    await queue.put(None)
+
+async def relay_shard_events(request, phones, token, headers):
+    """Merge the SSE streams of the workers owning `phones` into one stream.
+
+    The stream ends when every worker stream has ended, so the browser's
+    EventSource reconnects and is routed to the current owners again.
+    """
+    by_worker = {}
+    for phone in phones:
+        by_worker.setdefault(shards.ring.node_for(phone), set()).add(phone)
+    queue = asyncio.Queue(maxsize=config.EVENT_QUEUE_SIZE)
+    readers = [
+        asyncio.create_task(_read_worker_events(worker_id, worker_phones, token, headers, queue))
+        for worker_id, worker_phones in by_worker.items()
+    ]
+    open_streams = len(readers)
+    try:
+        while open_streams and not await request.is_disconnected():
+            chunk = await queue.get()
+            if chunk is None:
+                open_streams -= 1
+                continue
+            yield chunk
+    finally:
+        for reader in readers:
+            reader.cancel()
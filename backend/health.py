@@ -0,0 +1,199 @@
+import asyncio
+import random
+import time
+from fastapi import HTTPException
+from telethon import functions
+from telethon.errors import UnauthorizedError
+import config
+from session_manager import clients
+
+# Errors meaning the session itself is dead: revoked, unregistered key, deleted account...
+INVALID_SESSION_ERRORS = (UnauthorizedError,)
+
+HEALTHY = "healthy"
+RECONNECTING = "reconnecting"
+DOWN = "down"
+
+
+class HealthSupervisor:
+    """Pings connected clients in the background and repairs or evicts broken ones.
+
+    Every HEALTH_INTERVAL seconds each connected client gets a cheap GetState call,
+    at most HEALTH_BATCH_SIZE at a time. A client whose connection dropped is
+    disconnected and reconnected through the pool with jittered exponential
+    backoff; an account whose session is no longer authorized is handed to the
+    `on_invalid` callbacks. Endpoints call ensure_available() to fail fast while an
+    account is being reconnected instead of waiting on a dead socket.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.accounts = {}
+        self._reconnects = {}
+        # Async callbacks called as callback(phone) for sessions that are no longer valid
+        self.on_invalid = []
+        self.stats = {
+            "pings": 0,
+            "ping_failures": 0,
+            "reconnects": 0,
+            "reconnect_failures": 0,
+            "invalid_sessions": 0,
+        }
+
+    def _set(self, phone, state, error=None):
+        account = self.accounts.setdefault(phone, {"failures": 0})
+        account["state"] = state
+        account["updated_at"] = time.time()
+        if state == HEALTHY:
+            account["failures"] = 0
+            account["last_ok"] = account["updated_at"]
+        if error is not None:
+            account["last_error"] = error
+
+    # Pool hooks
+
+    def attach(self, phone, client):
+        self._set(phone, HEALTHY)
+
+    def detach(self, phone, client):
+        # Accounts being reconnected keep their state until the reconnect finishes
+        if phone not in self._reconnects:
+            self.accounts.pop(phone, None)
+
+    # Checks
+
+    async def ping(self, phone, client):
+        started = time.perf_counter()
+        try:
+            if not client.is_connected():
+                raise ConnectionError("Client is not connected")
+            await asyncio.wait_for(client(functions.updates.GetStateRequest()), timeout=config.HEALTH_PING_TIMEOUT)
+        except INVALID_SESSION_ERRORS as e:
+            await self.invalidate(phone, f"{type(e).__name__}: {e}")
+            return
+        except Exception as e:
+            self.stats["ping_failures"] += 1
+            print(f"Health check failed for {phone} ({type(e).__name__}: {e}), reconnecting")
+            self.schedule_reconnect(phone, f"{type(e).__name__}: {e}")
+            return
+        finally:
+            self.stats["pings"] += 1
+        self._set(phone, HEALTHY)
+        self.accounts[phone]["latency"] = time.perf_counter() - started
+
+    async def check_all(self):
+        semaphore = asyncio.Semaphore(max(1, config.HEALTH_BATCH_SIZE))
+
+        async def check(phone, client):
+            async with semaphore:
+                await self.ping(phone, client)
+
+        targets = [(phone, client) for phone, client in self.pool.items() if phone not in self._reconnects]
+        await asyncio.gather(*(check(phone, client) for phone, client in targets))
+
+    async def run(self):
+        """Check all connected clients every HEALTH_INTERVAL seconds until cancelled."""
+        while True:
+            await asyncio.sleep(config.HEALTH_INTERVAL)
+            try:
+                await self.check_all()
+            except Exception as e:
+                print(f"Error checking client health: {str(e)}")
+
+    # Repair
+
+    def schedule_reconnect(self, phone, error=None):
+        if phone in self._reconnects:
+            return
+        self._set(phone, RECONNECTING, error)
+        self._reconnects[phone] = asyncio.create_task(self._reconnect(phone))
+
+    async def _reconnect(self, phone):
+        try:
+            await self.pool.disconnect(phone)
+            for attempt in range(config.HEALTH_RECONNECT_ATTEMPTS):
+                # Full jitter keeps many accounts dropped at once from reconnecting in lockstep
+                delay = min(config.HEALTH_RECONNECT_MAX, config.HEALTH_RECONNECT_BACKOFF * (2 ** attempt))
+                await asyncio.sleep(random.uniform(0, delay))
+                try:
+                    client = await self.pool.acquire(phone)
+                    if client is not None:
+                        await asyncio.wait_for(
+                            client(functions.updates.GetStateRequest()), timeout=config.HEALTH_PING_TIMEOUT
+                        )
+                except INVALID_SESSION_ERRORS as e:
+                    await self.invalidate(phone, f"{type(e).__name__}: {e}")
+                    return
+                except Exception as e:
+                    self.accounts[phone]["last_error"] = f"{type(e).__name__}: {e}"
+                    client = None
+                if client is not None:
+                    self.stats["reconnects"] += 1
+                    self._set(phone, HEALTHY)
+                    print(f"Reconnected {phone}")
+                    return
+                if phone not in self.pool:
+                    # The pool found the session unauthorized
+                    await self.invalidate(phone, "Session is not authorized")
+                    return
+                self.accounts[phone]["failures"] += 1
+                await self.pool.disconnect(phone)
+            self.stats["reconnect_failures"] += 1
+            self._set(phone, DOWN)
+            print(f"Giving up reconnecting {phone} after {config.HEALTH_RECONNECT_ATTEMPTS} attempts")
+        finally:
+            self._reconnects.pop(phone, None)
+
+    async def invalidate(self, phone, error):
+        self.stats["invalid_sessions"] += 1
+        print(f"Session for {phone} is no longer valid ({error})")
+        self.accounts.pop(phone, None)
+        for callback in self.on_invalid:
+            try:
+                await callback(phone)
+            except Exception as e:
+                print(f"Error handling invalid session for {phone}: {str(e)}")
+
+    # Endpoint helpers
+
+    def ensure_available(self, phone):
+        """Raise 503 right away while the account is being reconnected, or for a while after
+        reconnecting gave up."""
+        account = self.accounts.get(phone)
+        if account is None:
+            return
+        if account["state"] == RECONNECTING:
+            raise HTTPException(
+                status_code=503,
+                detail="Account connection is being re-established, retry shortly",
+                headers={"Retry-After": str(int(config.HEALTH_RECONNECT_BACKOFF) + 1)},
+            )
+        if account["state"] == DOWN:
+            retry_at = account["updated_at"] + config.HEALTH_RECONNECT_MAX
+            if time.time() < retry_at:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Account connection is down",
+                    headers={"Retry-After": str(int(retry_at - time.time()) + 1)},
+                )
+            # Let the next request try to connect the account again
+            self.accounts.pop(phone, None)
+
+    def get_status(self, phone=None):
+        if phone is not None:
+            return self.accounts.get(phone, {"state": "unknown"})
+        return dict(self.accounts)
+
+    def get_stats(self):
+        states = [account["state"] for account in self.accounts.values()]
+        return {
+            **self.stats,
+            "healthy": states.count(HEALTHY),
+            "reconnecting": states.count(RECONNECTING),
+            "down": states.count(DOWN),
+        }
+
+
+supervisor = HealthSupervisor(clients)
+clients.on_connect.append(supervisor.attach)
+clients.on_disconnect.append(supervisor.detach)
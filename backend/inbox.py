@@ -0,0 +1,73 @@
+import asyncio
+import json
+import config
+from dialog_cache import get_dialog_cache
+from session_manager import clients
+from sharding import shards
+
+
+async def _local_chats(phone):
+    async with clients.lease(phone) as client:
+        if client is None:
+            raise RuntimeError("Account not connected")
+        cache = await get_dialog_cache(client, phone)
+    chats, _ = cache.page()
+    return chats
+
+async def _remote_chats(phone, headers):
+    # Front process: ask the worker that owns the account
+    worker_id = shards.ring.node_for(phone)
+    if worker_id is None:
+        raise RuntimeError("No shard workers available")
+    upstream = await shards.forward(worker_id, "GET", "/get_chats/", {"phone": phone}, headers, b"")
+    if upstream.status_code != 200:
+        raise RuntimeError(upstream.json().get("detail", f"HTTP {upstream.status_code}"))
+    return json.loads(upstream.content)["chats"]
+
+async def _account_chats(semaphore, phone, headers):
+    async with semaphore:
+        if config.SHARD_ROLE == "front":
+            fetch = _remote_chats(phone, headers)
+        else:
+            fetch = _local_chats(phone)
+        return await asyncio.wait_for(fetch, timeout=config.INBOX_ACCOUNT_TIMEOUT)
+
+def _inbox_key(chat):
+    # Unread chats first, then newest first
+    return (chat["unread_count"] > 0, chat["date"] or "")
+
+async def get_inbox(phones, headers=None, limit=None, unread_only=False):
+    """Merge the dialogs of several accounts into one list, fetching the accounts concurrently.
+
+    At most INBOX_CONCURRENCY accounts are fetched at once and each gets
+    INBOX_ACCOUNT_TIMEOUT seconds; accounts that fail or time out are reported in
+    "accounts" and the chats of the others are still returned.
+    """
+    phones = sorted(phones)
+    semaphore = asyncio.Semaphore(max(1, config.INBOX_CONCURRENCY))
+    results = await asyncio.gather(
+        *(_account_chats(semaphore, phone, headers or {}) for phone in phones),
+        return_exceptions=True,
+    )
+
+    chats = []
+    accounts = {}
+    for phone, result in zip(phones, results):
+        if isinstance(result, asyncio.TimeoutError):
+            accounts[phone] = "timeout"
+        elif isinstance(result, Exception):
+            accounts[phone] = f"error: {str(result)}"
+        else:
+            accounts[phone] = "ok"
+            chats.extend({**chat, "phone": phone} for chat in result)
+
+    if unread_only:
+        chats = [chat for chat in chats if chat["unread_count"] > 0]
+    chats.sort(key=_inbox_key, reverse=True)
+    if limit is not None:
+        chats = chats[:limit]
+    return {
+        "chats": chats,
+        "accounts": accounts,
+        "partial": any(status != "ok" for status in accounts.values()),
+    }
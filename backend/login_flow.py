@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+
+class LoginCapacityError(Exception):
+    """Raised when too many logins are waiting for their verification code."""
+
+
+class PendingLogins:
+    """Clients waiting for a login code, disconnected automatically after `ttl` seconds.
+
+    At most `max_pending` logins can be in flight at once, so a burst of sign-ups
+    cannot exhaust sockets. A new login reserve()s its slot before connecting, so
+    logins still connecting count against the cap too. lock(phone) serializes the
+    login steps of one phone.
+    """
+
+    def __init__(self, ttl=300, max_pending=50):
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self._pending = {}
+        # Phones holding a slot while their client connects and requests the code
+        self._reserved = set()
+        self._locks = {}
+        self.stats = {"started": 0, "completed": 0, "expired": 0, "rejected": 0, "reused": 0}
+
+    def __contains__(self, phone):
+        return self.get(phone) is not None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def items(self):
+        return [(phone, entry["client"]) for phone, entry in self._pending.items()]
+
+    def lock(self, phone):
+        return self._locks.setdefault(phone, asyncio.Lock())
+
+    def get(self, phone):
+        """Return the pending client for `phone`, or None if there is none or it expired."""
+        entry = self._pending.get(phone)
+        if entry is None or entry["expires_at"] < time.monotonic():
+            return None
+        return entry["client"]
+
+    def age(self, phone):
+        entry = self._pending.get(phone)
+        return time.monotonic() - entry["started_at"] if entry else None
+
+    def is_full(self):
+        return len(self._pending) + len(self._reserved) >= self.max_pending
+
+    def ensure_capacity(self, phone):
+        """Raise LoginCapacityError if a new login for `phone` would exceed `max_pending`."""
+        if phone not in self._pending and phone not in self._reserved and self.is_full():
+            self.stats["rejected"] += 1
+            raise LoginCapacityError("Too many logins in progress, please retry shortly")
+
+    def reserve(self, phone):
+        """Take a slot for a new login of `phone` or raise LoginCapacityError.
+
+        Checking and taking the slot happen without yielding to the event loop, so
+        concurrent logins cannot all pass the check before any of them is added.
+        The slot passes to add(), or must be given back with release().
+        """
+        self.ensure_capacity(phone)
+        if phone not in self._pending:
+            self._reserved.add(phone)
+
+    def release(self, phone):
+        """Give back the slot of a login that failed before add()."""
+        self._reserved.discard(phone)
+
+    def add(self, phone, client):
+        """Track a client waiting for its code, (re)starting its TTL."""
+        self.ensure_capacity(phone)
+        self._reserved.discard(phone)
+        if phone not in self._pending:
+            self.stats["started"] += 1
+        now = time.monotonic()
+        self._pending[phone] = {"client": client, "started_at": now, "expires_at": now + self.ttl}
+
+    def complete(self, phone):
+        """Forget a login that succeeded; its client now belongs to the pool."""
+        if self._pending.pop(phone, None) is not None:
+            self.stats["completed"] += 1
+        self._locks.pop(phone, None)
+
+    async def discard(self, phone):
+        """Drop a pending login and disconnect its client."""
+        entry = self._pending.pop(phone, None)
+        if entry is None:
+            return
+        try:
+            await entry["client"].disconnect()
+        except Exception as e:
+            print(f"Error disconnecting pending client for {phone}: {str(e)}")
+
+    async def expire(self):
+        """Disconnect the clients of logins that were not completed in time."""
+        now = time.monotonic()
+        expired = [phone for phone, entry in self._pending.items() if entry["expires_at"] < now]
+        for phone in expired:
+            if self.lock(phone).locked():
+                # Being completed right now
+                continue
+            self.stats["expired"] += 1
+            print(f"Login for {phone} expired, disconnecting its client")
+            await self.discard(phone)
+            self._locks.pop(phone, None)
+        return len(expired)
+
+    async def run_expirer(self, interval=30):
+        """Periodically expire abandoned logins until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.expire()
+            except Exception as e:
+                print(f"Error expiring pending logins: {str(e)}")
+
+    async def close(self):
+        for phone in list(self._pending):
+            await self.discard(phone)
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "pending": len(self._pending),
+            "reserved": len(self._reserved),
+            "max_pending": self.max_pending,
+        }
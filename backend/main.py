@@ -1,15 +1,43 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from datetime import timedelta
-from database import add_session, get_sessions, create_user, get_user_by_email, associate_session_with_user, conn, cursor
-from session_manager import start_login, complete_login, clients, load_sessions_on_startup, disconnect_all_clients, pending_clients
-from auth import User, get_password_hash, verify_password, create_access_token, get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from database import add_session_async, get_sessions_async, create_user_async, get_user_by_email_async, update_password_hash_async, delete_session_async, run_db, account_writer
+from login_flow import LoginCapacityError
+from session_manager import start_login, complete_login, clients, load_sessions_on_startup, disconnect_all_clients, pending_clients, warmup_status, is_ready, rebalance_shard
+from auth import User, get_password_hash_async, verify_password_async, get_hash_stats, create_access_token, get_current_user, oauth2_scheme, ACCESS_TOKEN_EXPIRE_MINUTES
+from access import check_account_access, get_user_phones
+from message_store import get_messages_cached, delete_account_messages, forget_chat, MESSAGE_FIELDS
+from message_export import export_messages, get_stats as get_export_stats
+from media_cache import get_media, release_media, delete_account_media, get_stats as get_media_stats
+from dialog_cache import get_dialog_cache, CHAT_FIELDS
+from inbox import get_inbox
+from responses import FastJSONResponse, encode, project
+from search_index import search as search_messages, delete_account_index, count_indexed, get_stats as get_search_stats
+from health import supervisor, INVALID_SESSION_ERRORS
+from event_hub import hub, relay_shard_events
+from sharding import shards, SHARDED_PATHS, STREAMED_PATHS, extract_phone
+from session_store import delete_session_data, writer as session_writer
+import httpx
 import config
-import os
+import time
+import asyncio
+import json
+import send_queue
+import entity_cache
+import metrics
+import search_indexer
+import scheduler
+import contact_import
+from singleflight import telegram_calls
+import sqlite3
+from telethon.errors import BadRequestError, FloodWaitError, RPCError
 
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 
 # Enable CORS
 app.add_middleware(
@@ -20,6 +48,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# In sharded mode the front process forwards account requests to the owning worker
+@app.middleware("http")
+async def route_to_shard(request: Request, call_next):
+    if config.SHARD_ROLE != "front" or request.url.path not in SHARDED_PATHS:
+        return await call_next(request)
+    
+    body = await request.body()
+    phone = extract_phone(request.query_params, body)
+    if not phone:
+        # Let the endpoint's own validation report the missing phone
+        return await call_next(request)
+    
+    worker_id = shards.ring.node_for(phone)
+    if worker_id is None:
+        return JSONResponse(status_code=503, content={"detail": "No shard workers available"})
+    streamed = request.url.path in STREAMED_PATHS
+    try:
+        upstream = await shards.forward(
+            worker_id, request.method, request.url.path, request.query_params, request.headers, body,
+            stream=streamed,
+        )
+    except httpx.HTTPError as e:
+        print(f"Error forwarding request for {phone} to shard {worker_id}: {str(e)}")
+        await shards.refresh()
+        return JSONResponse(status_code=502, content={"detail": "Shard worker unavailable"})
+    
+    headers = {k: v for k, v in upstream.headers.items()
+               if k.lower() not in ("content-length", "content-encoding", "transfer-encoding", "connection")}
+    if streamed:
+        # Relay the worker's stream as it arrives instead of buffering it
+        return StreamingResponse(
+            upstream.aiter_raw(), status_code=upstream.status_code, headers=headers,
+            background=BackgroundTask(upstream.aclose),
+        )
+    return Response(content=upstream.content, status_code=upstream.status_code, headers=headers)
+
+# Per-endpoint latency; registered last so it also times requests forwarded to shards
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        if route is not None:
+            path = route.path
+        elif request.url.path in SHARDED_PATHS:
+            # Forwarded to a shard before routing; these paths have no parameters
+            path = request.url.path
+        else:
+            path = "unmatched"
+        metrics.request_latency.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            path=path,
+            status=f"{status_code // 100}xx",
+        )
+
 # Data models
 class StartLoginRequest(BaseModel):
     phone: str
@@ -34,20 +123,107 @@ class SendMessageRequest(BaseModel):
     recipient: str
     message: str
 
+class BatchSendItem(BaseModel):
+    phone: Optional[str] = None  # None to let the batch pick an account
+    recipient: str
+    message: str
+
+class BatchSendRequest(BaseModel):
+    messages: List[BatchSendItem]
+    # Accounts to spread messages without a phone over; defaults to all of the user's accounts
+    fan_out_phones: Optional[List[str]] = None
+
+class ScheduleMessageRequest(BaseModel):
+    phone: str
+    recipient: str
+    message: str
+    send_at: Optional[datetime] = None  # Naive times are UTC
+    delay: Optional[float] = None  # Seconds from now, instead of send_at
+    interval: Optional[float] = None  # Repeat every `interval` seconds
+    max_runs: Optional[int] = None  # Stop repeating after this many sends
+
 class UserRegister(BaseModel):
     username: str
     email: str
     password: str
 
+def as_utc(value):
+    """Read a naive datetime from a query or body as UTC, so it compares with Telegram's aware dates."""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
 # Health check endpoint
 @app.get("/health/")
 async def health_check():
     return {"status": "ok"}
 
+# Readiness endpoint for the load balancer: 503 until session warm-up crosses the threshold
+@app.get("/ready/")
+async def readiness_check():
+    if config.SHARD_ROLE == "front":
+        # The front is ready as soon as it can route to at least one worker
+        body = {"ready": bool(shards.ring.nodes), **shards.get_status()}
+    else:
+        body = {"ready": is_ready(), **warmup_status}
+    if not body["ready"]:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+@app.get("/pool_stats/")
+async def pool_stats():
+    return clients.get_stats()
+
+@app.get("/shard_status/")
+async def shard_status():
+    return shards.get_status()
+
+@app.get("/account_health/")
+async def account_health(phone: Optional[str] = None):
+    if phone is not None:
+        return {phone: supervisor.get_status(phone)}
+    return {"stats": supervisor.get_stats(), "accounts": supervisor.get_status()}
+
+@app.get("/hash_stats/")
+async def hash_stats():
+    return get_hash_stats()
+
 # Authentication endpoints
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _send_queue_totals():
+    senders = send_queue.get_stats().values()
+    return {
+        "accounts": len(senders),
+        "queued": sum(s["queued"] for s in senders),
+        "flood_waits": sum(s["flood_waits"] for s in senders),
+    }
+
+metrics.register_collector("client_pool", clients.get_stats)
+metrics.register_collector("login", pending_clients.get_stats)
+metrics.register_collector("warmup", lambda: warmup_status)
+metrics.register_collector("password_hash", get_hash_stats)
+metrics.register_collector("entity_cache", entity_cache.get_stats)
+metrics.register_collector("event_hub", hub.get_stats)
+metrics.register_collector("send_queue", _send_queue_totals)
+metrics.register_collector("session_writer", lambda: session_writer.stats)
+metrics.register_collector("export", get_export_stats)
+metrics.register_collector("media_cache", get_media_stats)
+metrics.register_collector("account_health", supervisor.get_stats)
+metrics.register_collector("account_writer", account_writer.get_stats)
+metrics.register_collector("singleflight", telegram_calls.get_stats)
+metrics.register_collector("scheduler", scheduler.get_stats)
+metrics.register_collector("contact_import", contact_import.get_stats)
+metrics.register_collector("search_index", get_search_stats)
+metrics.register_collector("search_indexer", search_indexer.get_stats)
+
 @app.post("/register/")
 async def register(user_data: UserRegister):
-    user = create_user(user_data.username, user_data.email, user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
+    user = await create_user_async(user_data.username, user_data.email, hashed_password=hashed_password)
     if not user:
         raise HTTPException(status_code=400, detail="Username or email already registered")
     
@@ -61,13 +237,18 @@ async def register(user_data: UserRegister):
 
 @app.post("/login/")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = get_user_by_email(form_data.username)
+    user = await get_user_by_email_async(form_data.username)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     
-    if not verify_password(form_data.password, user["hashed_password"]):
+    valid, new_hash = await verify_password_async(form_data.password, user["hashed_password"])
+    if not valid:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
     
+    # Transparently upgrade hashes made with a different bcrypt cost
+    if new_hash:
+        await update_password_hash_async(user["id"], new_hash)
+    
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -103,9 +284,11 @@ async def start_telegram_login(request: StartLoginRequest, current_user: User =
         
         # If login successful, associate the session with the user
         if result["status"] in ["code_sent", "authorized"]:
-            add_session(request.phone, config.API_ID, config.API_HASH, current_user["id"])
+            await add_session_async(request.phone, config.API_ID, config.API_HASH, current_user["id"])
         
         return result
+    except LoginCapacityError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -117,7 +300,7 @@ async def complete_telegram_login(request: CompleteLoginRequest, current_user: U
         
         # If login successful, associate the session with the user
         if result["status"] == "success":
-            add_session(request.phone, config.API_ID, config.API_HASH, current_user["id"])
+            await add_session_async(request.phone, config.API_ID, config.API_HASH, current_user["id"])
         
         return result
     except Exception as e:
@@ -128,16 +311,16 @@ async def list_accounts(current_user: User = Depends(get_current_user)):
     try:
         if current_user:
             # Return accounts associated with the current user
-            user_sessions = get_sessions(current_user["id"])
+            user_sessions = await get_sessions_async(current_user["id"])
             return {"accounts": [phone for phone, _, _ in user_sessions]}
         else:
             # For backward compatibility, return all accounts if not authenticated
-            all_sessions = get_sessions()
+            all_sessions = await get_sessions_async()
             return {"accounts": [phone for phone, _, _ in all_sessions]}
     except Exception as e:
         print(f"Error in list_accounts: {str(e)}")
         # Fallback to all accounts
-        all_sessions = get_sessions()
+        all_sessions = await get_sessions_async()
         return {"accounts": [phone for phone, _, _ in all_sessions]}
 
 @app.post("/send_message/")
@@ -146,167 +329,514 @@ async def send_message(request: SendMessageRequest, current_user: User = Depends
         raise HTTPException(status_code=404, detail="Account not connected")
     
     # If authenticated, verify that this account belongs to the current user
-    if current_user:
-        user_sessions = get_sessions(current_user["id"])
-        user_phones = [phone for phone, _, _ in user_sessions]
-        
-        if request.phone not in user_phones:
-            # Check if the account exists but is not associated with this user
-            cursor.execute("SELECT phone FROM sessions WHERE phone = ?", (request.phone,))
-            if cursor.fetchone():
-                # If the account exists, associate it with this user
-                associate_session_with_user(request.phone, current_user["id"])
-            else:
-                raise HTTPException(status_code=403, detail="You don't have access to this account")
-    
-    client = clients[request.phone]
-    await client.send_message(request.recipient, request.message)
+    await check_account_access(request.phone, current_user)
+    
+    supervisor.ensure_available(request.phone)
+    async with clients.lease(request.phone) as client:
+        if client is None:
+            raise HTTPException(status_code=404, detail="Account not connected")
+        try:
+            peer = await entity_cache.resolve(client, request.phone, request.recipient)
+            with metrics.span("send_message"):
+                await client.send_message(peer, request.message)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except INVALID_SESSION_ERRORS:
+            await handle_invalid_session(request.phone, current_user)
+            raise HTTPException(status_code=401, detail="Session is no longer valid. Please log in again.")
+        except FloodWaitError as e:
+            metrics.flood_waits.inc(source="send_message")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Telegram rate limit hit, retry in {e.seconds} seconds",
+                headers={"Retry-After": str(e.seconds)},
+            )
+    forget_chat(request.phone, peer)
     return {"message": "Message sent successfully"}
 
+@app.post("/send_batch/")
+async def send_batch(request: BatchSendRequest, http_request: Request, current_user: User = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="No messages to send")
+    
+    fan_out_phones = request.fan_out_phones
+    if fan_out_phones is None:
+        fan_out_phones = sorted(await get_user_phones(current_user["id"]))
+    
+    needs_fan_out = any(item.phone is None for item in request.messages)
+    if needs_fan_out and not fan_out_phones:
+        raise HTTPException(status_code=400, detail="No accounts available to send from")
+    
+    phones = {item.phone for item in request.messages if item.phone is not None}
+    if needs_fan_out:
+        phones.update(fan_out_phones)
+    for phone in phones:
+        # The front holds no clients; each worker checks its own part
+        if config.SHARD_ROLE != "front" and phone not in clients:
+            raise HTTPException(status_code=404, detail=f"Account not connected: {phone}")
+        await check_account_access(phone, current_user)
+    
+    items = [(item.phone, item.recipient, item.message) for item in request.messages]
+    if config.SHARD_ROLE == "front":
+        job = await send_queue.submit_sharded_batch(
+            current_user["id"], items, fan_out_phones if needs_fan_out else [], http_request.headers
+        )
+        return await send_queue.sharded_job_status(job, http_request.headers)
+    job = send_queue.submit_batch(current_user["id"], items, fan_out_phones)
+    return job.to_dict()
+
+@app.get("/send_batch/{job_id}")
+async def send_batch_status(job_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    job = send_queue.get_job(job_id)
+    if job is None or not current_user or job.user_id != current_user["id"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if isinstance(job, send_queue.ShardedSendJob):
+        return await send_queue.sharded_job_status(job, request.headers)
+    return job.to_dict()
+
+# Messages sent later, once or repeatedly; jobs are kept in sessions.db and survive restarts
+@app.post("/schedule_message/")
+async def schedule_message(request: ScheduleMessageRequest, current_user: User = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if (request.send_at is None) == (request.delay is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of send_at and delay")
+    if request.phone not in clients:
+        raise HTTPException(status_code=404, detail="Account not connected")
+    await check_account_access(request.phone, current_user)
+    
+    if request.send_at is not None:
+        run_at = as_utc(request.send_at).timestamp()
+    else:
+        run_at = time.time() + max(0.0, request.delay)
+    try:
+        job = await scheduler.schedule(
+            current_user["id"], request.phone, request.recipient, request.message,
+            run_at, interval=request.interval, max_runs=request.max_runs,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return scheduler.to_dict(job)
+
+@app.get("/scheduled_messages/")
+async def list_scheduled_messages(
+    phone: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user),
+):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    jobs = await run_db(scheduler.list_jobs, current_user["id"], phone, status, max(1, min(limit, 1000)))
+    return {"jobs": [scheduler.to_dict(job) for job in jobs]}
+
+@app.get("/scheduled_messages/{job_id}")
+async def get_scheduled_message(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await run_db(scheduler.get_job, job_id)
+    if job is None or not current_user or job["user_id"] != current_user["id"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return scheduler.to_dict(job)
+
+@app.delete("/scheduled_messages/{job_id}")
+async def cancel_scheduled_message(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await run_db(scheduler.get_job, job_id)
+    if job is None or not current_user or job["user_id"] != current_user["id"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not await run_db(scheduler.cancel_job, job_id, current_user["id"]):
+        raise HTTPException(status_code=409, detail=f"Job is already {job['status']}")
+    return {"id": job_id, "status": "cancelled"}
+
+@app.get("/scheduler_stats/")
+async def scheduler_stats():
+    return scheduler.get_stats()
+
+# Address book upload: resolves recipients ahead of time so later sends skip resolution
+@app.post("/import_contacts/")
+async def import_contacts(phone: str, request: Request, current_user: User = Depends(get_current_user)):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if phone not in clients:
+        raise HTTPException(status_code=404, detail="Account not connected")
+    await check_account_access(phone, current_user)
+    supervisor.ensure_available(phone)
+    
+    # CSV is parsed as it is received; JSON needs the whole body
+    try:
+        contacts = await contact_import.read_contacts(request.stream(), request.headers.get("content-type", ""))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid contact list: {str(e)}")
+    if not contacts:
+        raise HTTPException(status_code=400, detail="No contacts to import")
+    
+    job = contact_import.submit_import(current_user["id"], phone, contacts)
+    return job.to_dict()
+
+# Same path as the upload so sharded deployments route it to the worker running the import
+@app.get("/import_contacts/")
+async def import_contacts_status(phone: str, job_id: str, current_user: User = Depends(get_current_user)):
+    job = contact_import.get_job(job_id)
+    if job is None or job.phone != phone or not current_user or job.user_id != current_user["id"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/entity_cache_stats/")
+async def entity_cache_stats():
+    return entity_cache.get_stats()
+
+@app.get("/singleflight_stats/")
+async def singleflight_stats():
+    return telegram_calls.get_stats()
+
+@app.get("/send_queue_stats/")
+async def send_queue_stats():
+    return send_queue.get_stats()
+
 # Add this function to handle invalid sessions
 async def handle_invalid_session(phone: str, current_user: User = None):
     """Handle an invalid session by removing it from clients and database."""
     print(f"Handling invalid session for {phone}")
     
-    # Remove from active clients
-    if phone in clients:
-        try:
-            await clients[phone].disconnect()
-        except Exception as e:
-            print(f"Error disconnecting client: {str(e)}")
-        del clients[phone]
+    # Remove from the client pool
+    await clients.remove(phone)
     
     # Remove from pending clients
-    if phone in pending_clients:
-        try:
-            await pending_clients[phone].disconnect()
-        except Exception as e:
-            print(f"Error disconnecting pending client: {str(e)}")
-        del pending_clients[phone]
+    await pending_clients.discard(phone)
     
-    # Remove session file
-    session_path = os.path.join("sessions", phone + ".session")
-    if os.path.exists(session_path):
-        try:
-            os.remove(session_path)
-            print(f"Removed session file: {session_path}")
-        except Exception as e:
-            print(f"Error removing session file: {str(e)}")
+    # Remove the stored Telegram session
+    try:
+        await delete_session_data(phone)
+    except Exception as e:
+        print(f"Error removing stored session: {str(e)}")
     
     # Remove from database
     try:
-        cursor.execute("DELETE FROM sessions WHERE phone = ?", (phone,))
-        conn.commit()
+        await delete_session_async(phone)
+        await run_db(delete_account_messages, phone)
+        await run_db(entity_cache.delete_account_entities, phone)
+        await run_db(delete_account_media, phone)
+        await run_db(delete_account_index, phone)
+        await run_db(scheduler.cancel_account_jobs, phone)
         print(f"Removed session from database: {phone}")
     except Exception as e:
         print(f"Error removing session from database: {str(e)}")
     
     return {"status": "session_invalid", "message": "Session is no longer valid. Please log in again."}
 
-# Update the get_chats function to handle invalid sessions
+# Sessions found dead by the health supervisor are cleaned up the same way
+supervisor.on_invalid.append(handle_invalid_session)
+
 @app.get("/get_chats/")
-async def get_chats(phone: str, current_user: User = Depends(get_current_user)):
+async def get_chats(
+    phone: str,
+    request: Request,
+    limit: Optional[int] = None,
+    offset_date: Optional[datetime] = None,
+    since: Optional[int] = None,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+):
     if phone not in clients:
         raise HTTPException(status_code=404, detail="Account not connected")
     
     # If authenticated, verify that this account belongs to the current user
-    if current_user:
-        user_sessions = get_sessions(current_user["id"])
-        user_phones = [phone for phone, _, _ in user_sessions]
-        
-        if phone not in user_phones:
-            # Check if the account exists but is not associated with this user
-            cursor.execute("SELECT phone FROM sessions WHERE phone = ?", (phone,))
-            if cursor.fetchone():
-                # If the account exists, associate it with this user
-                associate_session_with_user(phone, current_user["id"])
-            else:
-                raise HTTPException(status_code=403, detail="You don't have access to this account")
+    await check_account_access(phone, current_user)
     
-    client = clients[phone]
+    supervisor.ensure_available(phone)
+    async with clients.lease(phone) as client:
+        if client is None:
+            raise HTTPException(status_code=404, detail="Account not connected")
     
-    try:
-        dialogs = await client.get_dialogs()
-        chats = []
-        for dialog in dialogs:
-            chats.append({
-                "id": dialog.id,
-                "name": dialog.name,
-                "unread_count": dialog.unread_count
-            })
-        return {"chats": chats}
-    except Exception as e:
-        error_str = str(e)
-        print(f"Error getting chats for {phone}: {error_str}")
-        
-        # Check for AuthKeyUnregisteredError
-        if "AuthKeyUnregisteredError" in error_str or "The key is not registered in the system" in error_str:
-            # Handle invalid session
+        try:
+            # Served from the dialog cache, which is kept current from Telegram update events
+            cache = await get_dialog_cache(client, phone)
+        except INVALID_SESSION_ERRORS:
+            # Revoked or unregistered authorization key
             await handle_invalid_session(phone, current_user)
             raise HTTPException(
                 status_code=401, 
                 detail="Session is no longer valid. Please log in again."
             )
-        
-        # Handle other errors
-        raise HTTPException(status_code=500, detail=error_str)
+        except Exception as e:
+            error_str = str(e)
+            print(f"Error getting chats for {phone}: {error_str}")
+            raise HTTPException(status_code=500, detail=error_str)
+    
+    etag = cache.etag()
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    chats, is_delta = cache.page(limit=limit, offset_date=as_utc(offset_date), since=since)
+    chats = project(chats, fields, CHAT_FIELDS)
+    return await encode(request, {"chats": chats, "version": cache.version, "delta": is_delta}, headers={"ETag": etag})
+
+# Dialogs of all of the user's accounts in one unread-first list
+@app.get("/inbox/")
+async def get_aggregated_inbox(
+    request: Request,
+    limit: Optional[int] = None,
+    unread_only: bool = False,
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    user_phones = await get_user_phones(current_user["id"])
+    # Forwarded to the shard workers in sharded mode
+    headers = {"authorization": request.headers.get("authorization", "")}
+    inbox = await get_inbox(user_phones, headers=headers, limit=limit, unread_only=unread_only)
+    inbox["chats"] = project(inbox["chats"], fields, CHAT_FIELDS + ("phone",))
+    return await encode(request, inbox)
 
 @app.get("/get_messages/")
-async def get_messages(phone: str, chat_id: int, limit: int = 50, current_user: User = Depends(get_current_user)):
+async def get_messages(
+    phone: str,
+    chat_id: int,
+    request: Request,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
     if phone not in clients:
         raise HTTPException(status_code=404, detail="Account not connected")
     
     # If authenticated, verify that this account belongs to the current user
-    if current_user:
-        user_sessions = get_sessions(current_user["id"])
-        user_phones = [phone for phone, _, _ in user_sessions]
-        
-        if phone not in user_phones:
-            # Check if the account exists but is not associated with this user
-            cursor.execute("SELECT phone FROM sessions WHERE phone = ?", (phone,))
-            if cursor.fetchone():
-                # If the account exists, associate it with this user
-                associate_session_with_user(phone, current_user["id"])
-            else:
-                raise HTTPException(status_code=403, detail="You don't have access to this account")
+    await check_account_access(phone, current_user)
+    
+    supervisor.ensure_available(phone)
+    async with clients.lease(phone) as client:
+        if client is None:
+            raise HTTPException(status_code=404, detail="Account not connected")
+    
+        try:
+            # Served from the local message store; only missing messages are fetched from Telegram
+            formatted_messages = await get_messages_cached(
+                client, phone, int(chat_id), limit=limit, before_id=before_id, after_id=after_id
+            )
+        except INVALID_SESSION_ERRORS:
+            await handle_invalid_session(phone, current_user)
+            raise HTTPException(status_code=401, detail="Session is no longer valid. Please log in again.")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid chat ID: {str(e)}")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    formatted_messages = project(formatted_messages, fields, MESSAGE_FIELDS)
+    return await encode(request, {"messages": formatted_messages})
+
+# Photos and documents of a message, served from the on-disk media cache
+@app.get("/get_media/")
+async def get_message_media(
+    phone: str,
+    chat_id: int,
+    msg_id: int,
+    thumb: bool = False,
+    current_user: User = Depends(get_current_user),
+):
+    if phone not in clients:
+        raise HTTPException(status_code=404, detail="Account not connected")
+    
+    await check_account_access(phone, current_user)
+    
+    supervisor.ensure_available(phone)
+    async with clients.lease(phone) as client:
+        if client is None:
+            raise HTTPException(status_code=404, detail="Account not connected")
+    
+        try:
+            media = await get_media(client, phone, int(chat_id), msg_id, thumb=thumb)
+        except INVALID_SESSION_ERRORS:
+            await handle_invalid_session(phone, current_user)
+            raise HTTPException(status_code=401, detail="Session is no longer valid. Please log in again.")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid chat ID: {str(e)}")
+        except FloodWaitError as e:
+            metrics.flood_waits.inc(source="get_media")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Telegram rate limit hit, retry in {e.seconds} seconds",
+                headers={"Retry-After": str(e.seconds)},
+            )
+        except BadRequestError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except RPCError as e:
+            raise HTTPException(status_code=502, detail=f"Telegram error: {str(e)}")
+    if media is None:
+        raise HTTPException(status_code=404, detail="Message has no media" if not thumb else "Media has no thumbnail")
+    
+    path, mime_type, name = media
+    # FileResponse answers Range requests, so players can seek and downloads can resume
+    return FileResponse(
+        path,
+        media_type=mime_type,
+        filename=name,
+        content_disposition_type="inline",
+        headers={"Cache-Control": "private, max-age=86400"},
+        # The file is kept from eviction until it has been sent
+        background=BackgroundTask(release_media, path),
+    )
+
+@app.get("/media_cache_stats/")
+async def media_cache_stats():
+    return get_media_stats()
+
+# Full chat history as NDJSON, streamed with constant memory
+@app.get("/export_messages/")
+async def export_chat_messages(
+    phone: str,
+    chat_id: int,
+    after_id: int = 0,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+):
+    if phone not in clients:
+        raise HTTPException(status_code=404, detail="Account not connected")
     
-    client = clients[phone]
+    await check_account_access(phone, current_user)
+    supervisor.ensure_available(phone)
     
+    return StreamingResponse(
+        export_messages(phone, int(chat_id), after_id=after_id, from_date=as_utc(from_date), to_date=as_utc(to_date)),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+@app.get("/export_stats/")
+async def export_stats():
+    return get_export_stats()
+
+# Full-text search over the local message index; Telegram is not contacted
+@app.get("/search/")
+async def search(
+    q: str,
+    request: Request,
+    phone: Optional[str] = None,
+    chat_id: Optional[int] = None,
+    limit: int = 20,
+    offset: int = 0,
+    current_user: User = Depends(get_current_user),
+):
+    if phone is not None:
+        await check_account_access(phone, current_user)
+        phones = {phone}
+    elif current_user:
+        phones = await get_user_phones(current_user["id"])
+    else:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    limit = max(1, min(limit, config.SEARCH_MAX_LIMIT))
     try:
-        entity = await client.get_entity(int(chat_id))
-        messages = await client.get_messages(entity, limit=limit, reverse=True)
-        
-        formatted_messages = []
-        for msg in messages:
-            text = msg.text if msg.text is not None else ""
-            
-            message_obj = {
-                "id": msg.id,
-                "text": text,
-                "date": msg.date.isoformat(),
-                "out": msg.out,
-                "sender_id": msg.sender_id
-            }
-            
-            if hasattr(msg, 'reply_to_msg_id') and msg.reply_to_msg_id is not None:
-                message_obj["reply_to_msg_id"] = msg.reply_to_msg_id
-                
-            formatted_messages.append(message_obj)
-        
-        return {"messages": formatted_messages}
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=f"Invalid chat ID: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        with metrics.span("search"):
+            results = await run_db(search_messages, phones, q, chat_id, limit, max(0, offset))
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {str(e)}")
+    return await encode(request, {"results": results})
+
+@app.get("/search_stats/")
+async def search_stats():
+    return {
+        **get_search_stats(),
+        "indexer": search_indexer.get_stats(),
+        "indexed_messages": await run_db(count_indexed),
+    }
+
+# Server-Sent Events stream of incoming messages and dialog changes
+@app.get("/events/")
+async def stream_events(
+    request: Request,
+    phones: Optional[str] = None,
+    token: Optional[str] = None,
+    header_token: Optional[str] = Depends(oauth2_scheme),
+):
+    # EventSource cannot send headers, so the token may also be passed as a query parameter
+    current_user = await get_current_user(token or header_token)
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    user_phones = await get_user_phones(current_user["id"])
+    if phones:
+        requested = set(phones.split(","))
+        if not requested <= user_phones:
+            raise HTTPException(status_code=403, detail="You don't have access to this account")
+        user_phones = requested
+    
+    if config.SHARD_ROLE == "front":
+        if not shards.ring.nodes:
+            raise HTTPException(status_code=503, detail="No shard workers available")
+        return StreamingResponse(
+            relay_shard_events(request, user_phones, token, request.headers),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    
+    # Make sure every account is connected so its update handlers are registered
+    for phone in user_phones:
+        await clients.acquire(phone)
+    
+    subscription = hub.subscribe(user_phones, maxsize=config.EVENT_QUEUE_SIZE)
+    
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                batch = await subscription.get(timeout=config.EVENT_HEARTBEAT)
+                if not batch:
+                    # Keep the connection alive and keep the clients from being reaped as idle
+                    for phone in subscription.phones:
+                        await clients.acquire(phone)
+                    yield ": keep-alive\n\n"
+                    continue
+                for event in batch:
+                    yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            hub.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/event_stats/")
+async def event_stats():
+    return hub.get_stats()
 
 @app.on_event("startup")
 async def startup_event():
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(load_sessions_on_startup)
+    if config.SHARD_ROLE:
+        # Learn the current workers before loading sessions, then follow joins and leaves
+        await shards.refresh()
+        if config.SHARD_ROLE == "worker":
+            shards.on_change(rebalance_shard)
+        app.state.shard_task = asyncio.create_task(shards.run_membership_watcher())
+    if config.SHARD_ROLE == "front":
+        # The front holds no Telegram clients
+        return
+    # Warm up sessions in the background so the server starts accepting requests immediately
+    app.state.warmup_task = asyncio.create_task(load_sessions_on_startup())
+    app.state.reaper_task = asyncio.create_task(clients.run_reaper(config.POOL_REAP_INTERVAL))
+    app.state.health_task = asyncio.create_task(supervisor.run())
+    app.state.login_task = asyncio.create_task(pending_clients.run_expirer(config.LOGIN_EXPIRE_INTERVAL))
+    app.state.search_task = asyncio.create_task(search_indexer.run())
+    app.state.scheduler_task = asyncio.create_task(scheduler.scheduler.run())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    for name in ("warmup_task", "reaper_task", "health_task", "login_task", "search_task", "scheduler_task", "shard_task"):
+        task = getattr(app.state, name, None)
+        if task and not task.done():
+            task.cancel()
+    await send_queue.shutdown()
+    await contact_import.shutdown()
+    await shards.close()
     await disconnect_all_clients()
+    await session_writer.close()
+    await account_writer.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+import config
+from database import get_connection, run_db
+from entity_cache import resolve as resolve_entity
+from singleflight import telegram_calls
+
+
+class MediaCache:
+    """Size-bounded, content-addressed cache of downloaded media on local disk.
+
+    Files are stored under the hash of their Telegram file id, so the same photo or
+    document reached through different accounts, chats or forwards is stored once.
+    When the total size exceeds `max_bytes` the least recently served files are
+    deleted. Concurrent requests for a file that is not cached yet share one download.
+    Paths returned by get() and fetch() are pinned, so eviction leaves the file
+    alone until the caller is done serving it and calls release().
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        # file key -> [lock, number of requests holding or waiting for it]
+        self._locks = {}
+        # file name -> number of requests serving it
+        self._pins = {}
+        self._loading = None
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "downloaded_bytes": 0, "evictions": 0}
+
+    def _scan(self):
+        """Return (mtime, name, size) of the files already on disk; runs in a worker thread."""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(".part"):
+                    # Left over from an interrupted download
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        return files
+
+    async def _index_disk(self):
+        """Index the files already on disk, least recently used first."""
+        for _, name, size in sorted(await run_in_threadpool(self._scan)):
+            self._entries[name] = size
+            self.total_bytes += size
+
+    async def _load(self):
+        if self._loading is None:
+            # Shared by concurrent first requests, so the directory is scanned once
+            self._loading = asyncio.ensure_future(self._index_disk())
+        try:
+            await asyncio.shield(self._loading)
+        except Exception:
+            self._loading = None
+            raise
+
+    def path_for(self, file_key):
+        digest = hashlib.sha256(file_key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _pin(self, name):
+        self._pins[name] = self._pins.get(name, 0) + 1
+
+    def _unpin(self, name):
+        self._pins[name] -= 1
+        if not self._pins[name]:
+            del self._pins[name]
+
+    async def get(self, file_key):
+        """Return the pinned path of a cached file and mark it recently used, or None."""
+        await self._load()
+        path = self.path_for(file_key)
+        name = os.path.basename(path)
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        self._pin(name)
+        # The mtime orders the files for LRU after a restart
+        if not await run_in_threadpool(_touch_file, path):
+            self._unpin(name)
+            self._forget(name)
+            return None
+        return path
+
+    async def release(self, path):
+        """Unpin a path returned by get() or fetch() once it has been served."""
+        self._unpin(os.path.basename(path))
+        await self._evict()
+
+    async def fetch(self, file_key, download):
+        """Return the pinned path of `file_key`, calling `await download(file)` to fill it on a miss."""
+        path = await self.get(file_key)
+        if path is not None:
+            self.stats["hits"] += 1
+            return path
+
+        # Dropped only once no request holds or waits for it, so two downloads never share a .part file
+        entry = self._locks.setdefault(file_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # Another request may have downloaded it while we waited
+                path = await self.get(file_key)
+                if path is not None:
+                    self.stats["hits"] += 1
+                    return path
+
+                self.stats["misses"] += 1
+                path = self.path_for(file_key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                partial = path + ".part"
+                try:
+                    # Telethon writes the file chunk by chunk as it downloads
+                    with open(partial, "wb") as file:
+                        await download(file)
+                    os.replace(partial, path)
+                except BaseException:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                    raise
+
+                name = os.path.basename(path)
+                size = os.path.getsize(path)
+                self._entries[name] = size
+                self._pin(name)
+                self.total_bytes += size
+                self.stats["downloaded_bytes"] += size
+                await self._evict()
+                return path
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[file_key]
+
+    def _forget(self, name):
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    async def _evict(self):
+        """Delete least recently served files until the cache fits, skipping pinned ones."""
+        victims = []
+        for name in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if name in self._pins:
+                continue
+            self._forget(name)
+            self.stats["evictions"] += 1
+            victims.append(os.path.join(self.directory, name[:2], name))
+        if victims:
+            await run_in_threadpool(_remove_files, victims)
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "files": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "pinned": len(self._pins),
+        }
+
+
+def _touch_file(path):
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+cache = MediaCache(config.MEDIA_CACHE_DIR, config.MEDIA_CACHE_MAX_BYTES)
+
+# Blocking helpers, run on the DB executor
+
+def load_media_file(phone, chat_id, msg_id, variant):
+    return get_connection().execute(
+        "SELECT file_key, mime_type, name FROM media_files WHERE phone = ? AND chat_id = ? AND msg_id = ? AND variant = ?",
+        (phone, chat_id, msg_id, variant)
+    ).fetchone()
+
+def store_media_file(phone, chat_id, msg_id, variant, file_key, mime_type, name):
+    conn = get_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO media_files (phone, chat_id, msg_id, variant, file_key, mime_type, name) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (phone, chat_id, msg_id, variant, file_key, mime_type, name)
+    )
+    conn.commit()
+
+def delete_account_media(phone):
+    # The files themselves may be shared with other accounts; LRU eviction removes them
+    conn = get_connection()
+    conn.execute("DELETE FROM media_files WHERE phone = ?", (phone,))
+    conn.commit()
+
+# Async API
+
+def _describe(msg, thumb):
+    """Return (file_key, mime_type, name, thumb index) for the media of a message, or None."""
+    if msg.photo is not None:
+        key, mime_type, name = f"photo:{msg.photo.id}", "image/jpeg", None
+        # The largest size is the photo itself; the next one down makes a good preview
+        thumb_index = -2 if len(msg.photo.sizes) > 1 else -1
+    elif msg.document is not None:
+        if thumb and not msg.document.thumbs:
+            return None
+        key, mime_type = f"document:{msg.document.id}", msg.document.mime_type
+        name = msg.file.name if msg.file else None
+        thumb_index = -1
+    else:
+        return None
+    if thumb:
+        return key + ":thumb", "image/jpeg", None, thumb_index
+    return key, mime_type or "application/octet-stream", name, None
+
+async def get_media(client, phone, chat_id, msg_id, thumb=False):
+    """Return (path, mime_type, name) of a message's media, downloading it on the first request.
+
+    With `thumb`, a thumbnail is returned instead of the full file, which
+    lets clients show a preview long before a big document is downloaded.
+    Returns None if the message has no (thumbnailable) media. The file is kept
+    from eviction until release_media(path) is called after serving it.
+    """
+    variant = "thumb" if thumb else "full"
+    known = await run_db(load_media_file, phone, chat_id, msg_id, variant)
+    if known is not None:
+        file_key, mime_type, name = known
+        path = await cache.get(file_key)
+        if path is not None:
+            cache.stats["hits"] += 1
+            return path, mime_type, name
+
+    entity = await resolve_entity(client, phone, chat_id)
+    msg = await telegram_calls.do(
+        (phone, "get_message", chat_id, msg_id), lambda: client.get_messages(entity, ids=msg_id)
+    )
+    if msg is None or msg.media is None:
+        return None
+    described = _describe(msg, thumb)
+    if described is None:
+        return None
+    file_key, mime_type, name, thumb_index = described
+
+    async def download(file):
+        await client.download_media(msg, file=file, thumb=thumb_index)
+
+    path = await cache.fetch(file_key, download)
+    try:
+        await run_db(store_media_file, phone, chat_id, msg_id, variant, file_key, mime_type, name)
+    except BaseException:
+        await cache.release(path)
+        raise
+    return path, mime_type, name
+
+async def release_media(path):
+    await cache.release(path)
+
+def get_stats():
+    return cache.get_stats()
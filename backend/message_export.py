@@ -0,0 +1,73 @@
+import asyncio
+import json
+from telethon.errors import FloodWaitError
+import config
+import metrics
+from message_store import format_message
+from entity_cache import resolve as resolve_entity
+from session_manager import clients
+
+stats = {
+    "exports_started": 0,
+    "exports_finished": 0,
+    "messages_exported": 0,
+    "flood_waits": 0,
+}
+
+def _line(obj):
+    return json.dumps(obj, default=str) + "\n"
+
+async def export_messages(phone, chat_id, after_id=0, from_date=None, to_date=None):
+    """Yield the messages of a chat as NDJSON lines, oldest first.
+
+    Messages are streamed from iter_messages one page at a time, so memory use does
+    not depend on the size of the chat. Every line carries the message id; passing
+    the last one received as `after_id` resumes an interrupted export. Flood waits
+    are slept through and the export continues where it stopped; if it cannot
+    continue, a final {"error", "resume_from"} line tells the caller where to resume.
+    """
+    stats["exports_started"] += 1
+    last_id = after_id or 0
+    flood_waits = 0
+    while True:
+        # Leased so the client is not evicted or reaped halfway through the export
+        async with clients.lease(phone) as client:
+            if client is None:
+                yield _line({"error": "Account not connected", "resume_from": last_id})
+                return
+            try:
+                entity = await resolve_entity(client, phone, chat_id)
+                # With reverse=True, offset_date returns messages sent after from_date
+                messages = client.iter_messages(
+                    entity,
+                    reverse=True,
+                    offset_id=last_id,
+                    offset_date=from_date if not last_id else None,
+                    wait_time=config.EXPORT_WAIT_TIME,
+                )
+                async for msg in messages:
+                    if to_date is not None and msg.date > to_date:
+                        break
+                    last_id = msg.id
+                    yield _line(format_message(msg))
+                    stats["messages_exported"] += 1
+                stats["exports_finished"] += 1
+                return
+            except FloodWaitError as e:
+                flood_wait = e
+            except Exception as e:
+                yield _line({"error": str(e), "resume_from": last_id})
+                return
+
+        # Sleep without holding the lease
+        stats["flood_waits"] += 1
+        metrics.flood_waits.inc(source="export")
+        flood_waits += 1
+        if flood_waits > config.EXPORT_MAX_FLOOD_WAITS or flood_wait.seconds > config.EXPORT_MAX_FLOOD_WAIT:
+            yield _line({"error": f"Flood wait of {flood_wait.seconds}s", "resume_from": last_id})
+            return
+        print(f"Flood wait of {flood_wait.seconds}s exporting {phone}/{chat_id}, resuming after message {last_id}")
+        await asyncio.sleep(flood_wait.seconds)
+
+def get_stats():
+    return dict(stats)
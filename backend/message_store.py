@@ -0,0 +1,224 @@
+import json
+import time
+from telethon import types, utils
+from database import get_connection, run_db
+from entity_cache import resolve as resolve_entity
+import metrics
+import search_index
+from singleflight import telegram_calls
+
+def media_info(msg):
+    """Describe the photo or document attached to a message, or return None.
+
+    The media itself is served by /get_media/.
+    """
+    if msg.photo is not None:
+        largest = msg.photo.sizes[-1] if msg.photo.sizes else None
+        sizes = getattr(largest, "sizes", None)
+        return {
+            "type": "photo",
+            "mime_type": "image/jpeg",
+            "size": max(sizes) if sizes else getattr(largest, "size", None),
+            "has_thumb": True,
+        }
+    if msg.document is not None:
+        for kind in ("voice", "video_note", "video", "audio", "sticker", "gif"):
+            if getattr(msg, kind, None) is not None:
+                break
+        else:
+            kind = "document"
+        return {
+            "type": kind,
+            "mime_type": msg.document.mime_type,
+            "size": msg.document.size,
+            "name": msg.file.name if msg.file else None,
+            "has_thumb": bool(msg.document.thumbs),
+        }
+    return None
+
+# Fields a message can have in the API; /get_messages/?fields= selects a subset
+MESSAGE_FIELDS = ("id", "text", "date", "out", "sender_id", "reply_to_msg_id", "media")
+
+def format_message(msg):
+    """Convert a Telethon message into the dict returned by the API."""
+    message_obj = {
+        "id": msg.id,
+        "text": msg.text if msg.text is not None else "",
+        "date": msg.date.isoformat(),
+        "out": msg.out,
+        "sender_id": msg.sender_id
+    }
+    if getattr(msg, 'reply_to_msg_id', None) is not None:
+        message_obj["reply_to_msg_id"] = msg.reply_to_msg_id
+    media = media_info(msg) if getattr(msg, 'media', None) is not None else None
+    if media is not None:
+        message_obj["media"] = media
+    return message_obj
+
+def _row_to_message(row):
+    msg_id, text, date, out, sender_id, reply_to_msg_id, media = row
+    message_obj = {
+        "id": msg_id,
+        "text": text,
+        "date": date,
+        "out": bool(out),
+        "sender_id": sender_id
+    }
+    if reply_to_msg_id is not None:
+        message_obj["reply_to_msg_id"] = reply_to_msg_id
+    if media is not None:
+        message_obj["media"] = json.loads(media)
+    return message_obj
+
+# Blocking helpers, run on the DB executor
+
+def get_sync_state(phone, chat_id):
+    row = get_connection().execute(
+        "SELECT min_id, max_id, has_oldest FROM message_sync WHERE phone = ? AND chat_id = ?",
+        (phone, chat_id)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"min_id": row[0], "max_id": row[1], "has_oldest": bool(row[2])}
+
+def save_messages(phone, chat_id, messages, state=None):
+    """Store and index formatted messages and, if given, the new contiguous sync range in one transaction."""
+    conn = get_connection()
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages (phone, chat_id, msg_id, text, date, out, sender_id, reply_to_msg_id, media) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(phone, chat_id, m["id"], m["text"], m["date"], int(bool(m["out"])), m["sender_id"],
+              m.get("reply_to_msg_id"), json.dumps(m["media"]) if "media" in m else None) for m in messages]
+        )
+        search_index.index_messages(conn, phone, chat_id, messages)
+        if state is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO message_sync (phone, chat_id, min_id, max_id, has_oldest, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (phone, chat_id, state["min_id"], state["max_id"], int(state["has_oldest"]), time.time())
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def load_messages(phone, chat_id, limit, min_id=None, max_id=None, oldest_first=False):
+    """Load up to `limit` cached messages with min_id <= id <= max_id, in ascending id order.
+
+    By default the newest messages in the range are returned; with oldest_first the oldest.
+    """
+    query = ("SELECT msg_id, text, date, out, sender_id, reply_to_msg_id, media FROM messages "
+             "WHERE phone = ? AND chat_id = ?")
+    params = [phone, chat_id]
+    if min_id is not None:
+        query += " AND msg_id >= ?"
+        params.append(min_id)
+    if max_id is not None:
+        query += " AND msg_id <= ?"
+        params.append(max_id)
+    query += " ORDER BY msg_id " + ("ASC" if oldest_first else "DESC") + " LIMIT ?"
+    params.append(limit)
+    rows = get_connection().execute(query, params).fetchall()
+    if not oldest_first:
+        rows.reverse()
+    return [_row_to_message(row) for row in rows]
+
+def delete_account_messages(phone):
+    conn = get_connection()
+    conn.execute("DELETE FROM messages WHERE phone = ?", (phone,))
+    conn.execute("DELETE FROM message_sync WHERE phone = ?", (phone,))
+    conn.commit()
+
+# Incremental sync against Telegram
+
+async def _get_messages(client, phone, chat_id, entity, **kwargs):
+    """client.get_messages(), shared between identical concurrent requests for a chat."""
+    key = (phone, "get_messages", chat_id, tuple(sorted(kwargs.items())))
+    with metrics.span("get_messages"):
+        return await telegram_calls.do(key, lambda: client.get_messages(entity, **kwargs))
+
+def forget_chat(phone, peer):
+    """Make the next history read of a chat go to Telegram, e.g. after sending to it."""
+    if isinstance(peer, types.InputPeerSelf):
+        # Saved Messages has no peer id without asking Telegram: drop all the account's reads
+        telegram_calls.forget(phone, "get_messages")
+    else:
+        telegram_calls.forget(phone, "get_messages", utils.get_peer_id(peer))
+
+async def _sync_latest(client, phone, chat_id, state, limit):
+    """Fetch messages newer than the cached range and return the updated sync state."""
+    entity = await resolve_entity(client, phone, chat_id)
+    if state is None:
+        fetched = await _get_messages(client, phone, chat_id, entity, limit=limit)
+    else:
+        fetched = await _get_messages(client, phone, chat_id, entity, min_id=state["max_id"], limit=limit)
+    messages = [format_message(m) for m in fetched]
+    ids = [m["id"] for m in messages]
+
+    if state is None:
+        state = {
+            "min_id": min(ids, default=0),
+            "max_id": max(ids, default=0),
+            "has_oldest": len(messages) < limit,
+        }
+    elif len(messages) >= limit:
+        # More new messages than one page: the cached range is no longer contiguous
+        state = {"min_id": min(ids), "max_id": max(ids), "has_oldest": False}
+    elif messages:
+        state = {**state, "max_id": max(ids)}
+
+    await run_db(save_messages, phone, chat_id, messages, state)
+    return state
+
+async def _fetch_older(client, phone, chat_id, state, before_id, limit):
+    local = await run_db(load_messages, phone, chat_id, limit, state["min_id"], before_id - 1)
+    if len(local) >= limit or state["has_oldest"]:
+        return local
+
+    # Extend the cached range downwards from its oldest message
+    need = limit - len(local)
+    entity = await resolve_entity(client, phone, chat_id)
+    fetched = await _get_messages(client, phone, chat_id, entity, offset_id=state["min_id"], limit=need)
+    messages = [format_message(m) for m in fetched]
+    state = {
+        **state,
+        "min_id": min((m["id"] for m in messages), default=state["min_id"]),
+        "has_oldest": len(messages) < need,
+    }
+    await run_db(save_messages, phone, chat_id, messages, state)
+    return await run_db(load_messages, phone, chat_id, limit, state["min_id"], before_id - 1)
+
+async def _fetch_uncached(client, phone, chat_id, limit, before_id=None, after_id=None):
+    """Fetch a page outside the cached range straight from Telegram, caching the messages."""
+    entity = await resolve_entity(client, phone, chat_id)
+    if after_id is not None:
+        fetched = await _get_messages(client, phone, chat_id, entity, min_id=after_id, limit=limit, reverse=True)
+    else:
+        fetched = await _get_messages(client, phone, chat_id, entity, offset_id=before_id, limit=limit)
+    messages = sorted((format_message(m) for m in fetched), key=lambda m: m["id"])
+    await run_db(save_messages, phone, chat_id, messages)
+    return messages
+
+async def get_messages_cached(client, phone, chat_id, limit=50, before_id=None, after_id=None):
+    """Return messages of a chat in ascending id order, served from the local store when possible.
+
+    Without a cursor the newest `limit` messages are returned; `before_id` pages towards
+    older messages and `after_id` towards newer ones.
+    """
+    state = await run_db(get_sync_state, phone, chat_id)
+
+    if before_id is not None:
+        if state and state["min_id"] < before_id <= state["max_id"] + 1:
+            return await _fetch_older(client, phone, chat_id, state, before_id, limit)
+        return await _fetch_uncached(client, phone, chat_id, limit, before_id=before_id)
+
+    if after_id is not None:
+        if state and state["min_id"] <= after_id <= state["max_id"]:
+            state = await _sync_latest(client, phone, chat_id, state, limit)
+            if state["min_id"] <= after_id:
+                return await run_db(load_messages, phone, chat_id, limit, after_id + 1, oldest_first=True)
+        return await _fetch_uncached(client, phone, chat_id, limit, after_id=after_id)
+
+    state = await _sync_latest(client, phone, chat_id, state, limit)
+    return await run_db(load_messages, phone, chat_id, limit, state["min_id"])
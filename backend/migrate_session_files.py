@@ -0,0 +1,18 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(BASE_DIR)
+
+from session_store import import_session_files, session_file_phones
+
+# Imports the per-account sessions/<phone>.session files into sessions.db,
+# replacing any state already stored for those accounts. The server imports
+# files of accounts missing from sessions.db by itself on startup; run this to
+# re-import all of them, or pass --delete to remove the files once imported.
+delete_files = "--delete" in sys.argv
+
+phones = session_file_phones()
+imported = import_session_files(delete_files=delete_files)
+
+print(f"Imported {len(imported)} of {len(phones)} session files.")
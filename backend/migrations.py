@@ -0,0 +1,261 @@
+"""Versioned schema migrations for sessions.db.
+
+The schema version is kept in SQLite's user_version pragma. Every migration runs
+once, in order, in its own transaction; database.py applies the pending ones on
+startup. Running this file directly applies them and reports the version:
+
+    python migrations.py
+"""
+import sqlite3
+
+
+def _columns(conn, table):
+    return [column[1] for column in conn.execute(f"PRAGMA table_info({table})")]
+
+def _base_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            phone TEXT PRIMARY KEY,
+            api_id INTEGER,
+            api_hash TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE,
+            email TEXT UNIQUE,
+            hashed_password TEXT,
+            disabled INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            UNIQUE(user_id, phone)
+        )
+    ''')
+    # Databases from before user_accounts kept the owner on the session row
+    if "user_id" not in _columns(conn, "sessions"):
+        conn.execute("ALTER TABLE sessions ADD COLUMN user_id TEXT")
+    conn.execute('''
+        INSERT OR IGNORE INTO user_accounts (user_id, phone)
+        SELECT user_id, phone FROM sessions WHERE user_id IS NOT NULL
+    ''')
+
+def _user_accounts_indexes(conn):
+    # Lookups by user_id are served by the UNIQUE(user_id, phone) index
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_accounts_phone ON user_accounts (phone)")
+
+def _message_store(conn):
+    # Local cache of formatted messages. message_sync records, per chat, the contiguous
+    # range of message ids [min_id, max_id] that is fully cached and whether min_id is
+    # the first message of the chat, so later views only fetch what is missing.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            msg_id INTEGER NOT NULL,
+            text TEXT,
+            date TEXT,
+            out INTEGER,
+            sender_id INTEGER,
+            reply_to_msg_id INTEGER,
+            media TEXT,
+            PRIMARY KEY (phone, chat_id, msg_id)
+        ) WITHOUT ROWID
+    ''')
+    if "media" not in _columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN media TEXT")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_sync (
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            has_oldest INTEGER DEFAULT 0,
+            updated_at REAL,
+            PRIMARY KEY (phone, chat_id)
+        )
+    ''')
+
+def _entity_cache(conn):
+    # Resolved peers per account: recipient key -> InputPeer (with access_hash). A row with
+    # a NULL peer_type is a negative entry for a username/phone that does not exist.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS entities (
+            phone TEXT NOT NULL,
+            key TEXT NOT NULL,
+            peer_type TEXT,
+            peer_id INTEGER,
+            access_hash INTEGER,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (phone, key)
+        ) WITHOUT ROWID
+    ''')
+
+def _telegram_sessions(conn):
+    # Telethon state of every account, instead of one sessions/<phone>.session file each
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tg_sessions (
+            phone TEXT PRIMARY KEY,
+            dc_id INTEGER,
+            server_address TEXT,
+            port INTEGER,
+            auth_key BLOB,
+            takeout_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tg_entities (
+            phone TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            hash INTEGER NOT NULL,
+            username TEXT,
+            entity_phone TEXT,
+            name TEXT,
+            PRIMARY KEY (phone, id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tg_update_state (
+            phone TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            pts INTEGER,
+            qts INTEGER,
+            date INTEGER,
+            seq INTEGER,
+            PRIMARY KEY (phone, id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tg_sent_files (
+            phone TEXT NOT NULL,
+            md5_digest BLOB NOT NULL,
+            file_size INTEGER NOT NULL,
+            type INTEGER NOT NULL,
+            id INTEGER,
+            hash INTEGER,
+            PRIMARY KEY (phone, md5_digest, file_size, type)
+        ) WITHOUT ROWID
+    ''')
+
+def _media_files(conn):
+    # Which cached file holds the media (or thumbnail) of a message, so repeated views
+    # are served from disk without asking Telegram for the message again
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            msg_id INTEGER NOT NULL,
+            variant TEXT NOT NULL,
+            file_key TEXT NOT NULL,
+            mime_type TEXT,
+            name TEXT,
+            PRIMARY KEY (phone, chat_id, msg_id, variant)
+        ) WITHOUT ROWID
+    ''')
+
+def _search_index(conn):
+    # Full-text index of message texts. indexed_messages gives every message a rowid
+    # (messages is WITHOUT ROWID) that is shared with its row in message_fts.
+    # index_progress is the background indexer's checkpoint per chat: the range of
+    # message ids [oldest_id, newest_id] already walked and whether oldest_id is the
+    # first message of the chat.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS indexed_messages (
+            id INTEGER PRIMARY KEY,
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            msg_id INTEGER NOT NULL,
+            date TEXT,
+            UNIQUE (phone, chat_id, msg_id)
+        )
+    ''')
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(text, tokenize = 'unicode61 remove_diacritics 2')")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS index_progress (
+            phone TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            oldest_id INTEGER NOT NULL,
+            newest_id INTEGER NOT NULL,
+            complete INTEGER DEFAULT 0,
+            updated_at REAL,
+            PRIMARY KEY (phone, chat_id)
+        )
+    ''')
+
+def _scheduled_messages(conn):
+    # Messages to send later. run_at is the next due time (epoch seconds); jobs with an
+    # interval are sent again every `interval` seconds until max_runs is reached.
+    # status: scheduled -> sending -> scheduled (next run or retry) | sent | failed | cancelled
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_messages (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            phone TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            message TEXT NOT NULL,
+            run_at REAL NOT NULL,
+            interval REAL,
+            max_runs INTEGER,
+            runs INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'scheduled',
+            last_run_at REAL,
+            last_error TEXT,
+            created_at REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_messages_due ON scheduled_messages (status, run_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_messages_user ON scheduled_messages (user_id, created_at)")
+
+# (version, description, migration). Append new migrations; never edit applied ones.
+# The first ones use IF NOT EXISTS so databases created before versioning upgrade cleanly.
+MIGRATIONS = [
+    (1, "sessions, users and user_accounts", _base_schema),
+    (2, "user_accounts index on phone", _user_accounts_indexes),
+    (3, "message store", _message_store),
+    (4, "entity cache", _entity_cache),
+    (5, "Telegram session storage", _telegram_sessions),
+    (6, "media cache index", _media_files),
+    (7, "full-text search index", _search_index),
+    (8, "scheduled messages", _scheduled_messages),
+]
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """Apply the migrations newer than the database's version; returns the new version."""
+    version = current_version(conn)
+    for number, description, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another process (e.g. a shard worker) may have applied it meanwhile
+            if current_version(conn) >= number:
+                conn.rollback()
+                continue
+            print(f"Applying migration {number}: {description}")
+            migration(conn)
+            # PRAGMA does not accept parameters; number is an int from MIGRATIONS
+            conn.execute(f"PRAGMA user_version = {int(number)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    return version
+
+
+if __name__ == "__main__":
+    import os
+    db_path = os.getenv("DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.db"))
+    conn = sqlite3.connect(db_path)
+    print(f"{db_path}: schema version {current_version(conn)}")
+    print(f"Database is at schema version {migrate(conn)}")
+    conn.close()
@@ -0,0 +1,106 @@
+"""Encoding of the large list responses (chats, messages, inbox, search).
+
+Bodies are encoded with orjson, or MessagePack when the client sends
+`Accept: application/msgpack`, and compressed with brotli or gzip when they are
+large enough. orjson, msgpack and brotli are optional: without them responses
+fall back to the stdlib json encoder, JSON only and gzip only.
+"""
+import gzip
+import json
+from datetime import datetime
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson when it is installed."""
+
+    def render(self, content):
+        return dumps_json(content)
+
+
+def _accepted_encodings(header):
+    encodings = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        key, _, value = params.partition("=")
+        try:
+            if key.strip() == "q" and float(value) == 0:
+                # Explicitly refused
+                continue
+        except ValueError:
+            pass
+        encodings.add(name.strip().lower())
+    return encodings
+
+def _compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=config.GZIP_LEVEL)
+
+async def encode(request: Request, content, headers=None):
+    """Return `content` as a Response in the format and encoding the client accepts.
+
+    The dict is encoded directly, skipping FastAPI's per-item validation and
+    jsonable_encoder pass. Bodies of at least COMPRESS_MIN_SIZE bytes are
+    compressed in a worker thread so big pages do not stall the event loop.
+    """
+    if msgpack is not None and any(t in request.headers.get("accept", "") for t in MSGPACK_TYPES):
+        body, media_type = msgpack.packb(content, default=_default), "application/msgpack"
+    else:
+        body, media_type = dumps_json(content), "application/json"
+
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept, Accept-Encoding"
+    if len(body) >= config.COMPRESS_MIN_SIZE:
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = "br" if brotli is not None and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if encoding is not None:
+            body = await run_in_threadpool(_compress, body, encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def project(records, fields, allowed):
+    """Keep only the comma-separated `fields` of every record; all of them if `fields` is empty.
+
+    Raises 400 for a field that is not in `allowed`.
+    """
+    if not fields:
+        return records
+    wanted = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = set(wanted) - set(allowed)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}; available: {', '.join(allowed)}",
+        )
+    return [{field: record[field] for field in wanted if field in record} for record in records]
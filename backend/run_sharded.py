@@ -0,0 +1,68 @@
+"""Run the backend as a front process plus SHARD_WORKERS account-owning workers.
+
+Each worker serves on a unix socket in SHARD_SOCKET_DIR and only connects the
+Telegram accounts that the consistent hash ring assigns to it, so no two processes
+open the same .session file. The front listens on --host/--port, serves user and
+account-list requests itself and forwards per-account requests to the owning worker.
+A /send_batch/ spanning several workers is split into one part per worker, and
+/events/ merges the event streams of the workers owning the requested accounts.
+Workers can be added or removed later by starting/stopping a worker process with a
+new SHARD_ID; all processes pick up the change within SHARD_MEMBERSHIP_INTERVAL.
+
+Usage: python run_sharded.py [--workers 4] [--host 0.0.0.0] [--port 8000]
+"""
+import argparse
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+import config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def spawn(role, shard_id=None, extra_args=()):
+    env = dict(os.environ, SHARD_ROLE=role, SHARD_SOCKET_DIR=config.SHARD_SOCKET_DIR)
+    if shard_id is not None:
+        env["SHARD_ID"] = str(shard_id)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", *extra_args],
+        cwd=BASE_DIR,
+        env=env,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=config.SHARD_WORKERS)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    os.makedirs(config.SHARD_SOCKET_DIR, exist_ok=True)
+    # Tokens issued by the front must validate on every worker
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    processes = []
+    for worker_id in range(args.workers):
+        path = os.path.join(config.SHARD_SOCKET_DIR, f"worker-{worker_id}.sock")
+        if os.path.exists(path):
+            os.remove(path)
+        processes.append(spawn("worker", worker_id, ["--uds", path]))
+    processes.append(spawn("front", extra_args=["--host", args.host, "--port", str(args.port)]))
+
+    def stop(*_):
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    finally:
+        stop()
+        for process in processes:
+            process.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import asyncio
+import heapq
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from telethon.errors import FloodWaitError
+import config
+import entity_cache
+import metrics
+from database import get_connection, run_db
+from message_store import forget_chat
+from health import INVALID_SESSION_ERRORS
+from session_manager import clients, warmup_status
+
+_COLUMNS = ("id, user_id, phone, recipient, message, run_at, interval, max_runs, runs, attempts, "
+            "status, last_run_at, last_error, created_at")
+
+def _row_to_job(row):
+    keys = [column.strip() for column in _COLUMNS.split(",")]
+    return dict(zip(keys, row))
+
+def _iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else None
+
+def to_dict(job):
+    """The API representation of a job."""
+    return {
+        "id": job["id"],
+        "phone": job["phone"],
+        "recipient": job["recipient"],
+        "message": job["message"],
+        "send_at": _iso(job["run_at"]),
+        "interval": job["interval"],
+        "max_runs": job["max_runs"],
+        "runs": job["runs"],
+        "status": job["status"],
+        "last_run_at": _iso(job["last_run_at"]),
+        "last_error": job["last_error"],
+        "created_at": _iso(job["created_at"]),
+    }
+
+def _own_phones():
+    # A shard worker only runs the jobs of the accounts it owns
+    return json.dumps(clients.phones()) if config.SHARD_ROLE == "worker" else None
+
+# Blocking helpers, run on the DB executor
+
+def insert_job(job):
+    conn = get_connection()
+    conn.execute(
+        f"INSERT INTO scheduled_messages ({_COLUMNS}) VALUES ({', '.join('?' * 14)})",
+        (job["id"], job["user_id"], job["phone"], job["recipient"], job["message"], job["run_at"],
+         job["interval"], job["max_runs"], job["runs"], job["attempts"], job["status"],
+         job["last_run_at"], job["last_error"], job["created_at"])
+    )
+    conn.commit()
+
+def load_due(until, limit, phones=None):
+    """Return up to `limit` scheduled jobs due by `until`, earliest first.
+
+    `phones` is a JSON list restricting the jobs to those accounts.
+    """
+    query = f"SELECT {_COLUMNS} FROM scheduled_messages WHERE status = 'scheduled' AND run_at <= ?"
+    params = [until]
+    if phones is not None:
+        query += " AND phone IN (SELECT value FROM json_each(?))"
+        params.append(phones)
+    query += " ORDER BY run_at LIMIT ?"
+    params.append(limit)
+    return [_row_to_job(row) for row in get_connection().execute(query, params)]
+
+def claim(job_id):
+    """Mark a job as being sent; False if it was cancelled or claimed elsewhere meanwhile."""
+    conn = get_connection()
+    claimed = conn.execute(
+        "UPDATE scheduled_messages SET status = 'sending' WHERE id = ? AND status = 'scheduled'", (job_id,)
+    ).rowcount == 1
+    conn.commit()
+    return claimed
+
+def update_job(job):
+    conn = get_connection()
+    conn.execute(
+        "UPDATE scheduled_messages SET run_at = ?, runs = ?, attempts = ?, status = ?, last_run_at = ?, last_error = ? "
+        "WHERE id = ?",
+        (job["run_at"], job["runs"], job["attempts"], job["status"], job["last_run_at"], job["last_error"], job["id"])
+    )
+    conn.commit()
+
+def recover_interrupted(phones=None):
+    """Fail the jobs left 'sending' by a crash, since the message may already have gone out."""
+    query = ("UPDATE scheduled_messages SET status = 'failed', last_error = 'Interrupted while sending' "
+             "WHERE status = 'sending'")
+    params = []
+    if phones is not None:
+        query += " AND phone IN (SELECT value FROM json_each(?))"
+        params.append(phones)
+    conn = get_connection()
+    count = conn.execute(query, params).rowcount
+    conn.commit()
+    return count
+
+def get_job(job_id):
+    row = get_connection().execute(f"SELECT {_COLUMNS} FROM scheduled_messages WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_job(row) if row is not None else None
+
+def list_jobs(user_id, phone=None, status=None, limit=100):
+    query = f"SELECT {_COLUMNS} FROM scheduled_messages WHERE user_id = ?"
+    params = [user_id]
+    if phone is not None:
+        query += " AND phone = ?"
+        params.append(phone)
+    if status is not None:
+        query += " AND status = ?"
+        params.append(status)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(limit)
+    return [_row_to_job(row) for row in get_connection().execute(query, params)]
+
+def cancel_job(job_id, user_id):
+    conn = get_connection()
+    cancelled = conn.execute(
+        "UPDATE scheduled_messages SET status = 'cancelled' WHERE id = ? AND user_id = ? AND status = 'scheduled'",
+        (job_id, user_id)
+    ).rowcount == 1
+    conn.commit()
+    return cancelled
+
+def cancel_account_jobs(phone):
+    conn = get_connection()
+    conn.execute(
+        "UPDATE scheduled_messages SET status = 'cancelled', last_error = 'Account session is no longer valid' "
+        "WHERE phone = ? AND status = 'scheduled'",
+        (phone,)
+    )
+    conn.commit()
+
+
+class MessageScheduler:
+    """Sends scheduled messages when they are due.
+
+    Jobs live in the scheduled_messages table, so they survive restarts. Every
+    SCHEDULE_REFRESH_INTERVAL seconds the jobs due within SCHEDULE_LOOKAHEAD are
+    read in one query and put on an in-memory heap ordered by fire time. Jobs of
+    the same account are spread SCHEDULE_ACCOUNT_SPACING seconds apart, and every
+    job gets up to SCHEDULE_JITTER seconds of random delay, so hundreds of jobs
+    due at the same instant do not hit Telegram at once. Before sending, a job is
+    claimed in the database, so a cancelled job is never sent and no job is sent
+    twice.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._queued = {}
+        self._next_slot = {}
+        # job id -> task sending it
+        self._sending = {}
+        self._wakeup = None
+        self.stats = {"loaded": 0, "sent": 0, "failed": 0, "retried": 0, "flood_waits": 0, "skipped": 0}
+
+    def _push(self, job):
+        if job["id"] in self._queued:
+            return
+        phone = job["phone"]
+        fire_at = max(job["run_at"], self._next_slot.get(phone, 0)) + random.uniform(0, config.SCHEDULE_JITTER)
+        self._next_slot[phone] = fire_at + config.SCHEDULE_ACCOUNT_SPACING
+        self._queued[job["id"]] = job
+        heapq.heappush(self._heap, (fire_at, job["id"]))
+
+    def notify(self, job):
+        """Pick up a job scheduled in this process without waiting for the next refresh."""
+        if job["status"] == "scheduled" and job["run_at"] <= time.time() + config.SCHEDULE_LOOKAHEAD:
+            self._push(job)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def refresh(self):
+        jobs = await run_db(
+            load_due, time.time() + config.SCHEDULE_LOOKAHEAD, config.SCHEDULE_BATCH, _own_phones()
+        )
+        for job in jobs:
+            if job["id"] not in self._queued and job["id"] not in self._sending:
+                self.stats["loaded"] += 1
+                self._push(job)
+
+    async def run(self):
+        """Fire due jobs until cancelled."""
+        self._wakeup = asyncio.Event()
+        # Accounts are registered at the start of the warm-up; a worker needs them to know its jobs
+        while not (warmup_status["done"] or warmup_status["total"]):
+            await asyncio.sleep(0.5)
+        interrupted = await run_db(recover_interrupted, _own_phones())
+        if interrupted:
+            print(f"Marked {interrupted} scheduled messages interrupted by a restart as failed")
+        next_refresh = 0
+        while True:
+            try:
+                if time.time() >= next_refresh:
+                    next_refresh = time.time() + config.SCHEDULE_REFRESH_INTERVAL
+                    await self.refresh()
+                while self._heap and self._heap[0][0] <= time.time():
+                    _, job_id = heapq.heappop(self._heap)
+                    job = self._queued.pop(job_id)
+                    self._sending[job_id] = asyncio.create_task(self._fire(job))
+            except Exception as e:
+                print(f"Error running scheduled messages: {str(e)}")
+
+            wake_at = min(next_refresh, self._heap[0][0]) if self._heap else next_refresh
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, job):
+        try:
+            if await run_db(claim, job["id"]):
+                await self._send(job)
+                await run_db(update_job, job)
+                self.notify(job)
+            else:
+                self.stats["skipped"] += 1
+        except Exception as e:
+            print(f"Error sending scheduled message {job['id']}: {str(e)}")
+        finally:
+            self._sending.pop(job["id"], None)
+
+    async def _send(self, job):
+        """Send a claimed job and update it with the outcome: next run, retry, sent or failed."""
+        phone = job["phone"]
+        now = time.time()
+        try:
+            async with clients.lease(phone) as client:
+                if client is None:
+                    if phone not in clients and warmup_status["done"]:
+                        raise ValueError("Account not found")
+                    raise ConnectionError("Account not connected")
+                peer = await entity_cache.resolve(client, phone, job["recipient"])
+                with metrics.span("send_message"):
+                    await client.send_message(peer, job["message"])
+        except FloodWaitError as e:
+            # Not the job's fault: try again once the account may send, without using up an attempt
+            self.stats["flood_waits"] += 1
+            metrics.flood_waits.inc(source="scheduler")
+            job.update(status="scheduled", run_at=now + e.seconds, last_error=f"Flood wait of {e.seconds}s")
+            return
+        except (ValueError, *INVALID_SESSION_ERRORS) as e:
+            # Unknown recipient or account: retrying cannot help
+            self.stats["failed"] += 1
+            job.update(status="failed", last_error=str(e) or type(e).__name__)
+            return
+        except Exception as e:
+            job["attempts"] += 1
+            if job["attempts"] >= config.SCHEDULE_MAX_ATTEMPTS:
+                self.stats["failed"] += 1
+                job.update(status="failed", last_error=str(e))
+            else:
+                self.stats["retried"] += 1
+                delay = config.SCHEDULE_RETRY_DELAY * (2 ** (job["attempts"] - 1))
+                job.update(status="scheduled", run_at=now + delay, last_error=str(e))
+            return
+
+        forget_chat(phone, peer)
+        self.stats["sent"] += 1
+        job.update(runs=job["runs"] + 1, attempts=0, last_run_at=now, last_error=None)
+        if job["interval"] and (job["max_runs"] is None or job["runs"] < job["max_runs"]):
+            # Next occurrence on the original grid, skipping any missed while down
+            run_at = job["run_at"] + job["interval"]
+            if run_at <= now:
+                run_at += ((now - run_at) // job["interval"] + 1) * job["interval"]
+            job.update(status="scheduled", run_at=run_at)
+        else:
+            job["status"] = "sent"
+
+    def get_stats(self):
+        return {**self.stats, "queued": len(self._queued), "sending": len(self._sending)}
+
+
+scheduler = MessageScheduler()
+
+async def schedule(user_id, phone, recipient, message, run_at, interval=None, max_runs=None):
+    """Persist a new job and return it; raises ValueError for invalid timing."""
+    if interval is not None and interval < config.SCHEDULE_MIN_INTERVAL:
+        raise ValueError(f"interval must be at least {config.SCHEDULE_MIN_INTERVAL:g} seconds")
+    if max_runs is not None and max_runs < 1:
+        raise ValueError("max_runs must be at least 1")
+    now = time.time()
+    job = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "phone": phone,
+        "recipient": recipient,
+        "message": message,
+        "run_at": max(run_at, now),
+        "interval": interval,
+        "max_runs": max_runs,
+        "runs": 0,
+        "attempts": 0,
+        "status": "scheduled",
+        "last_run_at": None,
+        "last_error": None,
+        "created_at": now,
+    }
+    await run_db(insert_job, job)
+    scheduler.notify(job)
+    return job
+
+def get_stats():
+    return scheduler.get_stats()
@@ -0,0 +1,148 @@
+import html
+import time
+from database import get_connection
+
+# Highlight tags and length (in tokens) of the snippets returned with each hit
+SNIPPET_START = "<b>"
+SNIPPET_END = "</b>"
+SNIPPET_TOKENS = 16
+
+# FTS5 marks matches with these control characters; the snippet is escaped before they become tags
+_MARK_START = "\x02"
+_MARK_END = "\x03"
+
+stats = {"indexed": 0, "unchanged": 0, "removed": 0, "searches": 0}
+
+def _searchable_text(message):
+    """Text of a formatted message worth indexing: its text plus the name of an attached file."""
+    parts = [message.get("text") or ""]
+    media = message.get("media")
+    if media and media.get("name"):
+        parts.append(media["name"])
+    text = "\n".join(part for part in parts if part).strip()
+    # A message must not be able to fake a highlight marker
+    return text.replace(_MARK_START, "").replace(_MARK_END, "")
+
+def _highlight(snippet):
+    """Escape the message text of a snippet as HTML and turn the match markers into tags."""
+    return html.escape(snippet).replace(_MARK_START, SNIPPET_START).replace(_MARK_END, SNIPPET_END)
+
+def build_query(query):
+    """Turn user input into an FTS5 query matching messages that contain every term.
+
+    Terms are quoted so characters like - : ( or * cannot form FTS5 syntax errors;
+    a trailing * keeps its meaning as a prefix search.
+    """
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*").replace('"', '""')
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+# Blocking helpers, run on the DB executor
+
+def index_messages(conn, phone, chat_id, messages):
+    """Add or update formatted messages in the full-text index.
+
+    Runs inside the caller's transaction (message_store.save_messages), so the
+    index never disagrees with the stored messages. Unchanged texts are skipped,
+    since the same messages pass through the store every time a chat is viewed.
+    """
+    for message in messages:
+        text = _searchable_text(message)
+        row = conn.execute(
+            "SELECT i.id, f.text FROM indexed_messages i LEFT JOIN message_fts f ON f.rowid = i.id "
+            "WHERE i.phone = ? AND i.chat_id = ? AND i.msg_id = ?",
+            (phone, chat_id, message["id"])
+        ).fetchone()
+        if row is not None and row[1] == text:
+            stats["unchanged"] += 1
+            continue
+        if row is not None:
+            conn.execute("DELETE FROM message_fts WHERE rowid = ?", (row[0],))
+            if not text:
+                # Edited down to nothing searchable
+                conn.execute("DELETE FROM indexed_messages WHERE id = ?", (row[0],))
+                stats["removed"] += 1
+                continue
+            rowid = row[0]
+            conn.execute("UPDATE indexed_messages SET date = ? WHERE id = ?", (message["date"], rowid))
+        elif not text:
+            continue
+        else:
+            rowid = conn.execute(
+                "INSERT INTO indexed_messages (phone, chat_id, msg_id, date) VALUES (?, ?, ?, ?)",
+                (phone, chat_id, message["id"], message["date"])
+            ).lastrowid
+        conn.execute("INSERT INTO message_fts (rowid, text) VALUES (?, ?)", (rowid, text))
+        stats["indexed"] += 1
+
+def search(phones, query, chat_id=None, limit=20, offset=0):
+    """Return the messages of `phones` matching `query`, best match first.
+
+    Ranking is FTS5's bm25; each hit carries a snippet of the text around the
+    matching terms, HTML-escaped with the matches in SNIPPET_START/SNIPPET_END.
+    Raises sqlite3.OperationalError for a query FTS5 rejects.
+    """
+    match = build_query(query)
+    if not match or not phones:
+        return []
+    stats["searches"] += 1
+    phones = sorted(phones)
+    sql = (
+        "SELECT i.phone, i.chat_id, i.msg_id, i.date, snippet(message_fts, 0, ?, ?, '…', ?), bm25(message_fts) AS rank "
+        "FROM message_fts JOIN indexed_messages i ON i.id = message_fts.rowid "
+        f"WHERE message_fts MATCH ? AND i.phone IN ({', '.join('?' * len(phones))})"
+    )
+    params = [_MARK_START, _MARK_END, SNIPPET_TOKENS, match, *phones]
+    if chat_id is not None:
+        sql += " AND i.chat_id = ?"
+        params.append(chat_id)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    return [
+        {
+            "phone": phone,
+            "chat_id": chat,
+            "id": msg_id,
+            "date": date,
+            "snippet": _highlight(snippet),
+            "score": round(-rank, 4),
+        }
+        for phone, chat, msg_id, date, snippet, rank in get_connection().execute(sql, params)
+    ]
+
+def get_progress(phone, chat_id):
+    row = get_connection().execute(
+        "SELECT oldest_id, newest_id, complete FROM index_progress WHERE phone = ? AND chat_id = ?",
+        (phone, chat_id)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"oldest_id": row[0], "newest_id": row[1], "complete": bool(row[2])}
+
+def set_progress(phone, chat_id, progress):
+    conn = get_connection()
+    conn.execute(
+        "INSERT OR REPLACE INTO index_progress (phone, chat_id, oldest_id, newest_id, complete, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (phone, chat_id, progress["oldest_id"], progress["newest_id"], int(progress["complete"]), time.time())
+    )
+    conn.commit()
+
+def delete_account_index(phone):
+    conn = get_connection()
+    conn.execute(
+        "DELETE FROM message_fts WHERE rowid IN (SELECT id FROM indexed_messages WHERE phone = ?)", (phone,)
+    )
+    conn.execute("DELETE FROM indexed_messages WHERE phone = ?", (phone,))
+    conn.execute("DELETE FROM index_progress WHERE phone = ?", (phone,))
+    conn.commit()
+
+def count_indexed():
+    return get_connection().execute("SELECT COUNT(*) FROM indexed_messages").fetchone()[0]
+
+def get_stats():
+    return dict(stats)
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from telethon import events
+from telethon.errors import FloodWaitError
+import config
+import metrics
+from database import run_db
+from dialog_cache import get_dialog_cache
+from entity_cache import resolve as resolve_entity
+from message_store import format_message, save_messages
+from search_index import get_progress, set_progress
+from session_manager import clients
+
+stats = {"passes": 0, "pages": 0, "messages": 0, "live_messages": 0, "flood_waits": 0, "errors": 0}
+
+# Accounts told to back off by a flood wait: phone -> time.monotonic() to resume at
+_paused = {}
+
+async def _fetch_page(client, phone, chat_id, **kwargs):
+    entity = await resolve_entity(client, phone, chat_id)
+    with metrics.span("get_messages"):
+        fetched = await client.get_messages(entity, limit=config.SEARCH_INDEX_PAGE, **kwargs)
+    messages = [format_message(m) for m in fetched]
+    stats["pages"] += 1
+    stats["messages"] += len(messages)
+    await run_db(save_messages, phone, chat_id, messages)
+    await asyncio.sleep(config.SEARCH_INDEX_WAIT)
+    return messages
+
+async def index_chat(client, phone, chat_id, top_message_id):
+    """Take one step indexing a chat: catch up on new messages, then backfill one older page.
+
+    Returns True if the chat still has history left to index.
+    """
+    progress = await run_db(get_progress, phone, chat_id)
+    if progress is None:
+        messages = await _fetch_page(client, phone, chat_id)
+        ids = [m["id"] for m in messages]
+        progress = {
+            "oldest_id": min(ids, default=0),
+            "newest_id": max(ids, default=0),
+            "complete": len(messages) < config.SEARCH_INDEX_PAGE,
+        }
+        await run_db(set_progress, phone, chat_id, progress)
+        return not progress["complete"]
+
+    # Messages sent while the account was not connected, newest page first
+    offset_id = 0
+    newest_id = progress["newest_id"]
+    while top_message_id > progress["newest_id"]:
+        messages = await _fetch_page(client, phone, chat_id, min_id=progress["newest_id"], offset_id=offset_id)
+        if not messages:
+            break
+        newest_id = max(newest_id, max(m["id"] for m in messages))
+        if len(messages) < config.SEARCH_INDEX_PAGE:
+            break
+        offset_id = min(m["id"] for m in messages)
+    progress["newest_id"] = max(newest_id, top_message_id)
+
+    if not progress["complete"]:
+        messages = await _fetch_page(client, phone, chat_id, offset_id=progress["oldest_id"])
+        progress["oldest_id"] = min((m["id"] for m in messages), default=progress["oldest_id"])
+        progress["complete"] = len(messages) < config.SEARCH_INDEX_PAGE
+    await run_db(set_progress, phone, chat_id, progress)
+    return not progress["complete"]
+
+async def index_account(phone):
+    """Give every dialog of a connected account one indexing step."""
+    if _paused.get(phone, 0) > time.monotonic():
+        return
+    try:
+        # Leased so the client is not evicted mid-pass; connect=False does not count as use,
+        # so indexing never connects an account or keeps an idle one connected
+        async with clients.lease(phone, connect=False) as client:
+            if client is None:
+                return
+            cache = await get_dialog_cache(client, phone)
+            for dialog in list(cache.dialogs.values())[:config.SEARCH_INDEX_DIALOGS]:
+                await index_chat(client, phone, dialog["id"], dialog["top_message_id"])
+    except FloodWaitError as e:
+        stats["flood_waits"] += 1
+        metrics.flood_waits.inc(source="search_index")
+        print(f"Flood wait of {e.seconds}s indexing {phone}, pausing the account")
+        _paused[phone] = time.monotonic() + e.seconds
+    except Exception as e:
+        stats["errors"] += 1
+        print(f"Error indexing messages of {phone}: {type(e).__name__}: {e}")
+
+async def run():
+    """Walk the history of connected accounts every SEARCH_INDEX_INTERVAL seconds until cancelled.
+
+    Only accounts already connected are indexed; the indexer never connects one itself.
+    """
+    while True:
+        await asyncio.sleep(config.SEARCH_INDEX_INTERVAL)
+        semaphore = asyncio.Semaphore(max(1, config.SEARCH_INDEX_CONCURRENCY))
+
+        async def step(phone):
+            async with semaphore:
+                await index_account(phone)
+
+        try:
+            await asyncio.gather(*(step(phone) for phone, _ in clients.items()))
+            stats["passes"] += 1
+        except Exception as e:
+            print(f"Error indexing messages: {str(e)}")
+
+def attach(phone, client):
+    """Index new and edited messages as they arrive; used as a client pool on_connect hook."""
+
+    async def on_message(event):
+        try:
+            await run_db(save_messages, phone, event.chat_id, [format_message(event.message)])
+            stats["live_messages"] += 1
+        except Exception as e:
+            print(f"Error indexing new message for {phone}: {str(e)}")
+
+    client.add_event_handler(on_message, events.NewMessage())
+    client.add_event_handler(on_message, events.MessageEdited())
+
+def get_stats():
+    return {**stats, "paused_accounts": sum(1 for until in _paused.values() if until > time.monotonic())}
+
+
+clients.on_connect.append(attach)
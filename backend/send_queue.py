@@ -0,0 +1,280 @@
+import asyncio
+import json
+import time
+import uuid
+import httpx
+from telethon.errors import FloodWaitError
+import config
+import entity_cache
+import metrics
+from message_store import forget_chat
+from session_manager import clients
+from sharding import shards
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendJob:
+    """Progress of one batch of messages."""
+
+    def __init__(self, user_id, total):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.errors = []
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def pending(self):
+        return self.total - self.sent - self.failed
+
+    def record_success(self):
+        self.sent += 1
+        self._check_finished()
+
+    def record_failure(self, index, phone, recipient, error):
+        self.failed += 1
+        self.errors.append({"index": index, "phone": phone, "recipient": recipient, "error": error})
+        self._check_finished()
+
+    def _check_finished(self):
+        if self.pending == 0:
+            self.finished_at = time.time()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "pending": self.pending,
+            "done": self.pending == 0,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class AccountSender:
+    """Sends queued messages for one account at a rate-limited pace.
+
+    A FloodWaitError pauses the whole queue for the requested time and then retries
+    the same message, so the account never keeps hammering Telegram while limited.
+    """
+
+    def __init__(self, phone):
+        self.phone = phone
+        self.queue = asyncio.Queue()
+        self.bucket = TokenBucket(config.SEND_RATE, config.SEND_BURST)
+        self.flood_waits = 0
+        self.paused_until = 0
+        self.task = None
+
+    def submit(self, job, index, recipient, message):
+        self.queue.put_nowait((job, index, recipient, message))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            job, index, recipient, message = await self.queue.get()
+            try:
+                await self._deliver(job, index, recipient, message)
+            except Exception as e:
+                job.record_failure(index, self.phone, recipient, str(e))
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, job, index, recipient, message):
+        flood_retries = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                async with clients.lease(self.phone) as client:
+                    if client is None:
+                        job.record_failure(index, self.phone, recipient, "Account not connected")
+                        return
+                    peer = await entity_cache.resolve(client, self.phone, recipient)
+                    with metrics.span("send_message"):
+                        await client.send_message(peer, message)
+                break
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                metrics.flood_waits.inc(source="send_queue")
+                flood_retries += 1
+                if flood_retries > config.SEND_MAX_FLOOD_RETRIES:
+                    job.record_failure(index, self.phone, recipient, f"Flood wait of {e.seconds}s")
+                    return
+                print(f"Flood wait of {e.seconds}s for {self.phone}, pausing its send queue")
+                self.paused_until = time.time() + e.seconds
+                await asyncio.sleep(e.seconds)
+        forget_chat(self.phone, peer)
+        job.record_success()
+
+    def get_stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "flood_waits": self.flood_waits,
+            "paused_for": max(0, self.paused_until - time.time()),
+        }
+
+
+senders = {}
+jobs = {}
+
+def _get_sender(phone):
+    sender = senders.get(phone)
+    if sender is None:
+        sender = senders[phone] = AccountSender(phone)
+    return sender
+
+def _prune_jobs():
+    cutoff = time.time() - config.SEND_JOB_RETENTION
+    for job_id, job in list(jobs.items()):
+        if job.finished_at is not None and job.finished_at < cutoff:
+            del jobs[job_id]
+
+def submit_batch(user_id, items, fan_out_phones=None):
+    """Queue (phone, recipient, message) items and return the SendJob tracking them.
+
+    Items without a phone are spread over `fan_out_phones`, each going to the account
+    with the shortest queue, to maximize aggregate throughput.
+    """
+    _prune_jobs()
+    job = SendJob(user_id, len(items))
+    jobs[job.id] = job
+    for index, (phone, recipient, message) in enumerate(items):
+        if phone is None:
+            phone = min(fan_out_phones, key=lambda p: _get_sender(p).queue.qsize())
+        _get_sender(phone).submit(job, index, recipient, message)
+    return job
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+# Sharded mode: the front holds no clients, so it splits a batch over the workers
+
+
+class ShardedSendJob:
+    """A batch the front process split into one SendJob per shard worker."""
+
+    def __init__(self, user_id, total):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.total = total
+        # (worker id, the worker's job id, indexes of the batch items it got)
+        self.parts = []
+        # Items whose part could not be submitted
+        self.errors = []
+        self.created_at = time.time()
+        self.finished_at = None
+
+async def _submit_part(job, worker_id, part, headers):
+    indexes, messages, fan_out_phones = part
+    body = json.dumps({"messages": messages, "fan_out_phones": fan_out_phones}).encode()
+    try:
+        upstream = await shards.forward(worker_id, "POST", "/send_batch/", {}, headers, body)
+        if upstream.status_code != 200:
+            raise RuntimeError(upstream.json().get("detail", f"HTTP {upstream.status_code}"))
+        job.parts.append((worker_id, upstream.json()["job_id"], indexes))
+    except Exception as e:
+        print(f"Error submitting batch part to shard {worker_id}: {str(e)}")
+        for index, item in zip(indexes, messages):
+            job.errors.append({"index": index, "phone": item["phone"], "recipient": item["recipient"], "error": str(e)})
+
+async def submit_sharded_batch(user_id, items, fan_out_phones, headers):
+    """Split (phone, recipient, message) items by owning worker and submit each part there.
+
+    Items without a phone are dealt round-robin over the accounts in
+    `fan_out_phones`; the worker owning that account gets the item along with all
+    its fan-out accounts and picks the least busy one itself.
+    """
+    _prune_jobs()
+    job = ShardedSendJob(user_id, len(items))
+    jobs[job.id] = job
+    fan_out_by_worker = {}
+    for phone in fan_out_phones or []:
+        fan_out_by_worker.setdefault(shards.ring.node_for(phone), []).append(phone)
+
+    parts = {}
+    fan_out_index = 0
+    for index, (phone, recipient, message) in enumerate(items):
+        if phone is None:
+            worker_id = shards.ring.node_for(fan_out_phones[fan_out_index % len(fan_out_phones)])
+            fan_out_index += 1
+        else:
+            worker_id = shards.ring.node_for(phone)
+        if worker_id is None:
+            job.errors.append({"index": index, "phone": phone, "recipient": recipient, "error": "No shard workers available"})
+            continue
+        part = parts.setdefault(worker_id, ([], [], fan_out_by_worker.get(worker_id, [])))
+        part[0].append(index)
+        part[1].append({"phone": phone, "recipient": recipient, "message": message})
+    await asyncio.gather(*(_submit_part(job, worker_id, part, headers) for worker_id, part in parts.items()))
+    return job
+
+async def sharded_job_status(job, headers):
+    """Merge the progress of a ShardedSendJob's parts into the shape of SendJob.to_dict()."""
+    sent = 0
+    failed = len(job.errors)
+    errors = list(job.errors)
+    finished_at = None
+    for worker_id, part_id, indexes in job.parts:
+        try:
+            upstream = await shards.forward(worker_id, "GET", f"/send_batch/{part_id}", {}, headers, b"")
+            if upstream.status_code != 200:
+                raise RuntimeError(upstream.json().get("detail", f"HTTP {upstream.status_code}"))
+        except (httpx.HTTPError, RuntimeError) as e:
+            # Its items stay pending until the worker answers again
+            errors.append({"index": None, "phone": None, "recipient": None, "error": f"Shard {worker_id}: {str(e)}"})
+            continue
+        part = upstream.json()
+        sent += part["sent"]
+        failed += part["failed"]
+        errors.extend({**error, "index": indexes[error["index"]]} for error in part["errors"])
+        if part["finished_at"] is not None:
+            finished_at = max(finished_at or 0, part["finished_at"])
+    pending = job.total - sent - failed
+    if pending == 0 and job.finished_at is None:
+        job.finished_at = finished_at or time.time()
+    return {
+        "job_id": job.id,
+        "total": job.total,
+        "sent": sent,
+        "failed": failed,
+        "pending": pending,
+        "done": pending == 0,
+        "errors": errors,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+def get_stats():
+    return {phone: sender.get_stats() for phone, sender in senders.items()}
+
+async def shutdown():
+    """Stop all send workers; messages still queued are abandoned."""
+    for sender in senders.values():
+        if sender.task and not sender.task.done():
+            sender.task.cancel()
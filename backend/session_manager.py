@@ -1,123 +1,232 @@
 from telethon import TelegramClient
 import os
 import asyncio
-from database import get_sessions, conn, cursor
+from database import get_sessions_async
+import config
+import metrics
+from client_pool import ClientPool
+from login_flow import PendingLogins
+import dialog_cache
+import event_hub
+from sharding import shards
+from session_store import open_session, stored_phones, has_stored_session
 
 # Make sure the sessions folder exists
 session_folder = os.path.join(os.path.dirname(__file__), "sessions")
 if not os.path.exists(session_folder):
     os.makedirs(session_folder)
 
-clients = {}
-pending_clients = {}
+# Logins waiting for their verification code
+pending_clients = PendingLogins(ttl=config.LOGIN_PENDING_TTL, max_pending=config.LOGIN_MAX_PENDING)
+
+CODE_SENT = {"status": "code_sent", "message": "Verification code sent to your Telegram app"}
 
 async def start_login(phone, api_id, api_hash, force_code=True):
-    """Start the login process for a Telegram account."""
-    try:
-        # Check if the client already exists
-        if phone in clients:
-            client = clients[phone]
-            
-            # Always force a new code by logging out first
-            if await client.is_user_authorized():
-                # Log out to force a new code
-                await client.log_out()
-                
-                # Create a new client
-                client = TelegramClient(os.path.join("sessions", phone), api_id, api_hash)
+    """Start the login process for a Telegram account.
+
+    Calls for the same phone are serialized. While a login is pending its client is
+    reused: a repeat within LOGIN_RESEND_INTERVAL seconds (e.g. a double submit) does
+    not send another code, a later one re-sends it over the same connection.
+    """
+    async with pending_clients.lock(phone):
+        client = pending_clients.get(phone)
+        if client is not None:
+            pending_clients.stats["reused"] += 1
+            if pending_clients.age(phone) < config.LOGIN_RESEND_INTERVAL:
+                return CODE_SENT
+            try:
+                await client.send_code_request(phone)
+            except Exception as e:
+                print(f"Error in start_login: {str(e)}")
+                raise Exception(str(e))
+            pending_clients.add(phone, client)
+            return CODE_SENT
+
+        # An expired login may still hold a connection
+        await pending_clients.discard(phone)
+        if pending_clients.is_full():
+            await pending_clients.expire()
+        # Take the slot before the first await below, so a burst cannot open more connections than the cap
+        pending_clients.reserve(phone)
+        try:
+            connected = clients.get(phone)
+            if connected is not None:
+                if not force_code:
+                    return {"status": "authorized", "message": "Account is already logged in"}
+                # Always force a new code by logging out first, and drop the old client from the pool
+                try:
+                    if await connected.is_user_authorized():
+                        await connected.log_out()
+                except Exception as e:
+                    print(f"Error logging out {phone}: {str(e)}")
+                await clients.disconnect(phone)
+
+            client = TelegramClient(await open_session(phone), api_id, api_hash)
+            try:
                 await client.connect()
-                clients[phone] = client
-        
-        # Create a new client if it doesn't exist
-        client = TelegramClient(os.path.join("sessions", phone), api_id, api_hash)
-        await client.connect()
-        
-        # Send the code
-        await client.send_code_request(phone)
-        pending_clients[phone] = client
-        return {"status": "code_sent", "message": "Verification code sent to your Telegram app"}
-    except Exception as e:
-        print(f"Error in start_login: {str(e)}")
-        raise Exception(str(e))
+                await client.send_code_request(phone)
+                pending_clients.add(phone, client)
+                return CODE_SENT
+            except Exception as e:
+                print(f"Error in start_login: {str(e)}")
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+                raise Exception(str(e))
+        finally:
+            # A no-op once add() took over the slot
+            pending_clients.release(phone)
 
 async def complete_login(phone, code):
     """Complete the login process with the verification code."""
-    if phone not in pending_clients and phone not in clients:
-        raise Exception("Login session not found")
-    
-    try:
+    async with pending_clients.lock(phone):
         # Get the client from pending or active clients
-        client = pending_clients.get(phone) or clients.get(phone)
-        
-        # Always sign in with the code
-        await client.sign_in(phone, code)
-        
-        # Move from pending to active clients
-        clients[phone] = client
-        if phone in pending_clients:
-            del pending_clients[phone]
+        pending = pending_clients.get(phone)
+        client = pending or clients.get(phone)
+        if client is None:
+            raise Exception("Login session not found or expired")
         
-        # Get the user info
-        me = await client.get_me()
-        
-        return {
-            "status": "success", 
-            "message": f"Successfully logged in as {me.first_name if hasattr(me, 'first_name') else phone}"
-        }
-    except Exception as e:
-        print(f"Error in complete_login: {str(e)}")
-        raise Exception(str(e))
+        try:
+            # Always sign in with the code
+            await client.sign_in(phone, code)
+            
+            # Move from pending to active clients
+            if pending is not None:
+                await clients.add(phone, client)
+                pending_clients.complete(phone)
+            
+            # Get the user info
+            me = await client.get_me()
+            
+            return {
+                "status": "success", 
+                "message": f"Successfully logged in as {me.first_name if hasattr(me, 'first_name') else phone}"
+            }
+        except Exception as e:
+            print(f"Error in complete_login: {str(e)}")
+            raise Exception(str(e))
+
+# Transient errors worth retrying while warming up a session
+TRANSIENT_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
+
+warmup_status = {
+    "total": 0,
+    "loaded": 0,
+    "failed": 0,
+    "unauthorized": 0,
+    "skipped": 0,
+    "pending": 0,
+    "done": False,
+}
+
+def is_ready():
+    """Return True once enough sessions have been processed to serve traffic."""
+    if warmup_status["done"]:
+        return True
+    total = warmup_status["total"]
+    if total == 0:
+        return False
+    processed = total - warmup_status["pending"]
+    return processed / total >= config.READY_THRESHOLD
+
+async def connect_session(phone, api_id, api_hash):
+    """Connect a stored session with a timeout, retrying transient failures with backoff.
+
+    Returns the connected client, or None if the session is not authorized.
+    """
+    attempts = max(1, config.WARMUP_RETRIES)
+    for attempt in range(1, attempts + 1):
+        client = TelegramClient(await open_session(phone), api_id, api_hash)
+        try:
+            await asyncio.wait_for(client.connect(), timeout=config.WARMUP_CONNECT_TIMEOUT)
+            if await client.is_user_authorized():
+                return client
+            await client.disconnect()
+            return None
+        except TRANSIENT_ERRORS as e:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+            if attempt == attempts:
+                raise
+            delay = config.WARMUP_BACKOFF * (2 ** (attempt - 1))
+            print(f"Connecting {phone} failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# Connected clients, keyed by phone. Accounts are connected lazily and evicted when idle.
+clients = ClientPool(
+    connect_session,
+    max_active=config.POOL_MAX_ACTIVE,
+    idle_ttl=config.POOL_IDLE_TTL,
+)
+clients.on_connect.append(dialog_cache.attach)
+clients.on_disconnect.append(dialog_cache.detach)
+clients.on_connect.append(event_hub.hub.attach)
+
+async def _warm_up_session(semaphore, phone):
+    async with semaphore:
+        try:
+            with metrics.span("session_warmup"):
+                client = await clients.acquire(phone)
+            if client is not None:
+                warmup_status["loaded"] += 1
+                print(f"Loaded session for {phone}")
+            elif phone not in clients:
+                warmup_status["unauthorized"] += 1
+            else:
+                warmup_status["failed"] += 1
+        finally:
+            warmup_status["pending"] -= 1
 
 async def load_sessions_on_startup():
-    """Load all sessions from the database on startup."""
+    """Register all sessions from the database and pre-connect up to the pool size concurrently."""
     print("Loading Telegram sessions on startup...")
-    from database import get_sessions
     try:
-        sessions = get_sessions()
-        loaded_count = 0
-        
-        for session in sessions:
-            phone, api_id, api_hash = session
-            try:
-                # Check if session file exists
-                session_path = os.path.join("sessions", phone)
-                session_file = session_path + ".session"
-                
-                if not os.path.exists(session_file):
-                    print(f"Session file for {phone} does not exist, skipping")
-                    continue
-                
-                # Create and connect client
-                client = TelegramClient(session_path, api_id, api_hash)
-                await client.connect()
-                
-                # Check if authorized
-                if await client.is_user_authorized():
-                    clients[phone] = client
-                    loaded_count += 1
-                    print(f"Loaded session for {phone}")
-                else:
-                    print(f"Session for {phone} exists but is not authorized")
-            except Exception as e:
-                print(f"Error loading session for {phone}: {str(e)}")
-        
-        print(f"Successfully loaded {loaded_count} Telegram sessions")
+        sessions = await get_sessions_async()
+        # One bulk read of the stored Telegram state of every account
+        stored = await stored_phones()
+        to_load = []
+        for phone, api_id, api_hash in sessions:
+            # In sharded mode every worker only loads the accounts it owns
+            if not shards.owns(phone):
+                continue
+            if phone not in stored:
+                print(f"No stored session for {phone}, skipping")
+                warmup_status["skipped"] += 1
+                continue
+            clients.register(phone, api_id, api_hash)
+            to_load.append(phone)
+
+        # Remaining accounts are connected lazily on first use
+        to_load = to_load[:clients.max_active]
+        warmup_status["total"] = len(to_load)
+        warmup_status["pending"] = len(to_load)
+
+        semaphore = asyncio.Semaphore(max(1, config.WARMUP_CONCURRENCY))
+        await asyncio.gather(*(_warm_up_session(semaphore, phone) for phone in to_load))
+
+        print(f"Successfully loaded {warmup_status['loaded']} Telegram sessions "
+              f"({warmup_status['failed']} failed, {warmup_status['unauthorized']} unauthorized, "
+              f"{len(clients.phones())} registered)")
     except Exception as e:
         print(f"Error in load_sessions_on_startup: {str(e)}")
+    finally:
+        warmup_status["done"] = True
+
+async def rebalance_shard():
+    """Drop the accounts this worker no longer owns and register the ones it gained."""
+    for phone in clients.phones():
+        if not shards.owns(phone):
+            print(f"Handing {phone} over to another shard")
+            await clients.remove(phone)
+    for phone, api_id, api_hash in await get_sessions_async():
+        if shards.owns(phone) and phone not in clients:
+            if await has_stored_session(phone):
+                clients.register(phone, api_id, api_hash)
 
 async def disconnect_all_clients():
     """Disconnect all clients when shutting down."""
-    for phone, client in list(clients.items()):
-        try:
-            await client.disconnect()
-            print(f"Disconnected client for {phone}")
-        except Exception as e:
-            print(f"Error disconnecting client for {phone}: {str(e)}")
-    
-    for phone, client in list(pending_clients.items()):
-        try:
-            await client.disconnect()
-            print(f"Disconnected pending client for {phone}")
-        except Exception as e:
-            print(f"Error disconnecting pending client for {phone}: {str(e)}")
-
+    await clients.close()
+    await pending_clients.close()
\ No newline at end of file
@@ -0,0 +1,415 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.sessions.memory import _SentFileType
+from telethon.tl import types
+import config
+from database import get_connection, run_db
+
+
+class DatabaseSession(MemorySession):
+    """Telethon session whose state is kept in memory and persisted to sessions.db.
+
+    Changes are only marked dirty; the shared SessionWriter flushes the dirty
+    sessions of all accounts together in one transaction.
+    """
+
+    def __init__(self, phone=None, state=None):
+        super().__init__()
+        self.phone = phone
+        self._session_dirty = False
+        self._new_entities = []
+        self._new_states = {}
+        self._new_files = []
+        if state is not None:
+            self._load(state)
+
+    def _load(self, state):
+        if state.get("session"):
+            dc_id, server_address, port, key, takeout_id = state["session"]
+            self._dc_id = dc_id or 0
+            self._server_address = server_address
+            self._port = port
+            self._auth_key = AuthKey(data=key) if key else None
+            self._takeout_id = takeout_id
+        self._entities = set(state.get("entities", ()))
+        for entity_id, pts, qts, date, seq in state.get("update_states", ()):
+            self._update_states[entity_id] = types.updates.State(
+                pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc), seq, unread_count=0
+            )
+        for md5_digest, file_size, file_type, file_id, file_hash in state.get("files", ()):
+            self._files[(md5_digest, file_size, _SentFileType(file_type))] = (file_id, file_hash)
+
+    # Everything that changes persisted state marks the session dirty
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._session_dirty = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._session_dirty = True
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._session_dirty = True
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._new_states[entity_id] = state
+
+    def process_entities(self, tlo):
+        rows = set(self._entities_to_rows(tlo)) - self._entities
+        if rows:
+            self._entities |= rows
+            self._new_entities.extend(rows)
+
+    def cache_file(self, md5_digest, file_size, instance):
+        super().cache_file(md5_digest, file_size, instance)
+        file_type = _SentFileType.from_type(type(instance)).value
+        self._new_files.append((md5_digest, file_size, file_type, instance.id, instance.access_hash))
+
+    def save(self):
+        if self.phone is not None:
+            writer.mark_dirty(self)
+
+    # Telethon awaits close() and delete() when they are coroutines, so the writes run on the DB executor
+
+    async def close(self):
+        # Called on disconnect; make sure nothing is lost
+        if self.phone is not None and self.has_changes():
+            writer.discard(self)
+            changes = self.take_changes()
+            try:
+                await run_db(write_changes, [changes])
+            except Exception as e:
+                # Leave them to the writer, which retries on its next flush
+                print(f"Error writing Telegram session of {self.phone}: {str(e)}")
+                self.restore_changes(changes)
+                writer.mark_dirty(self)
+
+    async def delete(self):
+        if self.phone is not None:
+            writer.discard(self)
+            await run_db(delete_stored_session, self.phone)
+        return True
+
+    def has_changes(self):
+        return bool(self._session_dirty or self._new_entities or self._new_states or self._new_files)
+
+    def take_changes(self):
+        """Return the unsaved changes and reset the dirty markers."""
+        changes = {
+            "phone": self.phone,
+            "session": None,
+            "entities": self._new_entities,
+            "update_states": [
+                (entity_id, s.pts, s.qts, int(s.date.timestamp()), s.seq)
+                for entity_id, s in self._new_states.items()
+            ],
+            "files": self._new_files,
+        }
+        if self._session_dirty:
+            changes["session"] = (
+                self._dc_id, self._server_address, self._port,
+                self._auth_key.key if self._auth_key else b"", self._takeout_id,
+            )
+        self._session_dirty = False
+        self._new_entities = []
+        self._new_states = {}
+        self._new_files = []
+        return changes
+
+    def restore_changes(self, changes):
+        """Mark changes taken by take_changes() unsaved again, e.g. after the write failed."""
+        if changes["session"] is not None:
+            self._session_dirty = True
+        self._new_entities = changes["entities"] + self._new_entities
+        for entity_id, *_ in changes["update_states"]:
+            # Newer states replaced the taken ones in memory; whichever is current gets written
+            if entity_id not in self._new_states and entity_id in self._update_states:
+                self._new_states[entity_id] = self._update_states[entity_id]
+        self._new_files = changes["files"] + self._new_files
+
+
+# Blocking helpers
+
+def write_changes(changes):
+    """Persist the changes of several sessions in a single transaction."""
+    conn = get_connection()
+    try:
+        for change in changes:
+            phone = change["phone"]
+            if change["session"] is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tg_sessions (phone, dc_id, server_address, port, auth_key, takeout_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (phone, *change["session"])
+                )
+            if change["entities"]:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tg_entities (phone, id, hash, username, entity_phone, name) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(phone, *row) for row in change["entities"]]
+                )
+            if change["update_states"]:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tg_update_state (phone, id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(phone, *row) for row in change["update_states"]]
+                )
+            if change["files"]:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tg_sent_files (phone, md5_digest, file_size, type, id, hash) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(phone, *row) for row in change["files"]]
+                )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def load_all_states(phones=None):
+    """Read the stored state of all (or the given) accounts with one query per table."""
+    conn = get_connection()
+    states = {}
+    for row in conn.execute("SELECT phone, dc_id, server_address, port, auth_key, takeout_id FROM tg_sessions"):
+        if phones is None or row[0] in phones:
+            states[row[0]] = {"session": row[1:], "entities": [], "update_states": [], "files": []}
+    for row in conn.execute("SELECT phone, id, hash, username, entity_phone, name FROM tg_entities"):
+        if row[0] in states:
+            states[row[0]]["entities"].append(row[1:])
+    for row in conn.execute("SELECT phone, id, pts, qts, date, seq FROM tg_update_state"):
+        if row[0] in states:
+            states[row[0]]["update_states"].append(row[1:])
+    for row in conn.execute("SELECT phone, md5_digest, file_size, type, id, hash FROM tg_sent_files"):
+        if row[0] in states:
+            states[row[0]]["files"].append(row[1:])
+    return states
+
+def load_state(phone):
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT dc_id, server_address, port, auth_key, takeout_id FROM tg_sessions WHERE phone = ?", (phone,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {
+        "session": row,
+        "entities": conn.execute(
+            "SELECT id, hash, username, entity_phone, name FROM tg_entities WHERE phone = ?", (phone,)
+        ).fetchall(),
+        "update_states": conn.execute(
+            "SELECT id, pts, qts, date, seq FROM tg_update_state WHERE phone = ?", (phone,)
+        ).fetchall(),
+        "files": conn.execute(
+            "SELECT md5_digest, file_size, type, id, hash FROM tg_sent_files WHERE phone = ?", (phone,)
+        ).fetchall(),
+    }
+
+def read_session_file(path):
+    """Return the state kept in a Telethon .session file, or None if it holds no session."""
+    conn = sqlite3.connect(path)
+    try:
+        session = conn.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions").fetchone()
+        if session is None:
+            return None
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        state = {"session": session, "entities": [], "update_states": [], "files": []}
+        if "entities" in tables:
+            state["entities"] = conn.execute("SELECT id, hash, username, phone, name FROM entities").fetchall()
+        if "update_state" in tables:
+            state["update_states"] = conn.execute("SELECT id, pts, qts, date, seq FROM update_state").fetchall()
+        if "sent_files" in tables:
+            state["files"] = conn.execute("SELECT md5_digest, file_size, type, id, hash FROM sent_files").fetchall()
+        return state
+    finally:
+        conn.close()
+
+def session_file_phones():
+    if not os.path.isdir("sessions"):
+        return []
+    return sorted(name[:-len(".session")] for name in os.listdir("sessions") if name.endswith(".session"))
+
+def import_session_files(only_missing=False, delete_files=False):
+    """Copy sessions/<phone>.session files into sessions.db; return the phones imported.
+
+    With `only_missing`, accounts that already have state in the database keep it,
+    since a file left behind after an earlier import is older than that state.
+    """
+    existing = set()
+    if only_missing:
+        existing = {row[0] for row in get_connection().execute("SELECT phone FROM tg_sessions")}
+    imported = []
+    for phone in session_file_phones():
+        if phone in existing:
+            continue
+        path = session_file(phone)
+        try:
+            state = read_session_file(path)
+        except sqlite3.Error as e:
+            print(f"{phone}: cannot read {path} ({str(e)}), skipping")
+            continue
+        if state is None:
+            print(f"{phone}: no session data, skipping")
+            continue
+        write_changes([{"phone": phone, **state}])
+        imported.append(phone)
+        print(f"{phone}: imported ({len(state['entities'])} entities)")
+        if delete_files:
+            os.remove(path)
+    return imported
+
+def delete_stored_session(phone):
+    conn = get_connection()
+    for table in ("tg_sessions", "tg_entities", "tg_update_state", "tg_sent_files"):
+        conn.execute(f"DELETE FROM {table} WHERE phone = ?", (phone,))
+    conn.commit()
+    # An imported .session file would otherwise bring the account back on the next start
+    if os.path.exists(session_file(phone)):
+        os.remove(session_file(phone))
+
+
+class SessionWriter:
+    """Write-behind queue that flushes dirty sessions in batches.
+
+    Telethon calls save() after most state changes; instead of one commit per call,
+    dirty sessions are collected and written together every SESSION_FLUSH_INTERVAL
+    seconds, or sooner once SESSION_FLUSH_BATCH sessions are waiting.
+    """
+
+    def __init__(self):
+        self._dirty = set()
+        self._writing = set()
+        self._task = None
+        self._wakeup = None
+        self.stats = {"flushes": 0, "sessions_written": 0, "errors": 0}
+
+    def mark_dirty(self, session):
+        self._dirty.add(session)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. the migration tool): write straight away
+            self.flush_sync()
+            return
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        if len(self._dirty) >= config.SESSION_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def discard(self, session):
+        self._dirty.discard(session)
+        self._writing.discard(session)
+
+    def _take_batch(self):
+        batch, self._dirty = self._dirty, set()
+        sessions = [session for session in batch if session.has_changes()]
+        self._writing.update(sessions)
+        return sessions, [session.take_changes() for session in sessions]
+
+    def _restore_batch(self, sessions, changes):
+        # Keep the changes for the next flush, unless the session was closed or deleted meanwhile
+        for session, change in zip(sessions, changes):
+            if session in self._writing:
+                session.restore_changes(change)
+                self._dirty.add(session)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config.SESSION_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        sessions, changes = self._take_batch()
+        if not changes:
+            return
+        try:
+            await run_db(write_changes, changes)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Error flushing Telegram sessions: {str(e)}")
+            self._restore_batch(sessions, changes)
+            return
+        finally:
+            self._writing.difference_update(sessions)
+        self.stats["flushes"] += 1
+        self.stats["sessions_written"] += len(changes)
+
+    def flush_sync(self):
+        sessions, changes = self._take_batch()
+        if not changes:
+            return
+        try:
+            write_changes(changes)
+        except Exception:
+            self.stats["errors"] += 1
+            self._restore_batch(sessions, changes)
+            raise
+        finally:
+            self._writing.difference_update(sessions)
+        self.stats["flushes"] += 1
+        self.stats["sessions_written"] += len(changes)
+
+    async def close(self):
+        """Flush everything that is still pending; called on shutdown."""
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+
+
+writer = SessionWriter()
+
+# State read in bulk at startup, handed to the sessions as they are created
+_preloaded = {}
+
+def session_file(phone):
+    return os.path.join("sessions", phone) + ".session"
+
+async def stored_phones():
+    """Return the phones that have stored Telegram state, preloading it in bulk.
+
+    With the "db" backend, .session files of accounts not in sessions.db yet (left
+    from running with the "file" backend) are imported first, so an upgrade does
+    not lose any account. The files are kept.
+    """
+    if config.SESSION_BACKEND == "file":
+        return set(session_file_phones())
+    imported = await run_db(import_session_files, True)
+    if imported:
+        print(f"Imported {len(imported)} .session files into sessions.db")
+    states = await run_db(load_all_states)
+    _preloaded.update(states)
+    return set(states)
+
+async def open_session(phone):
+    """Return the session to pass to TelegramClient for `phone`."""
+    if config.SESSION_BACKEND == "file":
+        return os.path.join("sessions", phone)
+    state = _preloaded.pop(phone, None)
+    if state is None:
+        state = await run_db(load_state, phone)
+    return DatabaseSession(phone, state)
+
+async def has_stored_session(phone):
+    if config.SESSION_BACKEND == "file":
+        return os.path.exists(session_file(phone))
+    return phone in _preloaded or await run_db(load_state, phone) is not None
+
+async def delete_session_data(phone):
+    """Remove all stored Telegram state of an account."""
+    if config.SESSION_BACKEND == "file":
+        if os.path.exists(session_file(phone)):
+            os.remove(session_file(phone))
+        return
+    _preloaded.pop(phone, None)
+    await run_db(delete_stored_session, phone)
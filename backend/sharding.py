@@ -0,0 +1,169 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import httpx
+import config
+
+# Requests for these paths are served by the worker that owns the account in `phone`
+SHARDED_PATHS = {
+    "/send_message/",
+    "/schedule_message/",
+    "/import_contacts/",
+    "/get_chats/",
+    "/get_messages/",
+    "/start_login/",
+    "/complete_login/",
+    "/export_messages/",
+    "/get_media/",
+}
+
+# Sharded paths whose responses are relayed as a stream rather than buffered
+STREAMED_PATHS = {"/export_messages/", "/get_media/"}
+
+# Hop-by-hop headers that must not be copied between the front and a worker
+_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "host"}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping account phones to worker ids.
+
+    Each worker gets `replicas` virtual nodes, so adding or removing a worker only
+    moves the accounts that hashed to its nodes.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = sorted(set(nodes))
+        self._ring = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._keys = [key for key, _ in self._ring]
+
+    def node_for(self, phone):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, _hash(phone)) % len(self._ring)
+        return self._ring[index][1]
+
+
+def is_enabled():
+    return config.SHARD_ROLE in ("front", "worker")
+
+def socket_path(worker_id):
+    return os.path.join(config.SHARD_SOCKET_DIR, f"worker-{worker_id}.sock")
+
+async def _is_alive(path):
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_unix_connection(path), timeout=1)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+async def discover_workers():
+    """Return the ids of the workers whose IPC socket currently accepts connections."""
+    if not os.path.isdir(config.SHARD_SOCKET_DIR):
+        return []
+    workers = []
+    for name in sorted(os.listdir(config.SHARD_SOCKET_DIR)):
+        if name.startswith("worker-") and name.endswith(".sock"):
+            if await _is_alive(os.path.join(config.SHARD_SOCKET_DIR, name)):
+                workers.append(name[len("worker-"):-len(".sock")])
+    return workers
+
+
+class ShardState:
+    """Current ring as seen by this process, refreshed when workers join or leave."""
+
+    def __init__(self):
+        self.ring = HashRing()
+        self.rebalances = 0
+        self._on_change = []
+        self._http_clients = {}
+
+    def owns(self, phone):
+        """True if this process should hold the client for `phone`."""
+        if config.SHARD_ROLE != "worker":
+            return True
+        return self.ring.node_for(phone) == config.SHARD_ID
+
+    def on_change(self, callback):
+        """Register an async callback run after the ring changed."""
+        self._on_change.append(callback)
+
+    async def refresh(self):
+        workers = await discover_workers()
+        if config.SHARD_ROLE == "worker" and config.SHARD_ID not in workers:
+            # Our own socket may not be listening yet; we still own our share
+            workers.append(config.SHARD_ID)
+        if sorted(workers) == self.ring.nodes:
+            return False
+        print(f"Shard membership changed: {self.ring.nodes} -> {sorted(workers)}")
+        self.ring = HashRing(workers, config.SHARD_REPLICAS)
+        self.rebalances += 1
+        for callback in self._on_change:
+            try:
+                await callback()
+            except Exception as e:
+                print(f"Error rebalancing shards: {str(e)}")
+        return True
+
+    async def run_membership_watcher(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing shard membership: {str(e)}")
+            await asyncio.sleep(config.SHARD_MEMBERSHIP_INTERVAL)
+
+    def _client_for(self, worker_id):
+        client = self._http_clients.get(worker_id)
+        if client is None:
+            transport = httpx.AsyncHTTPTransport(uds=socket_path(worker_id))
+            client = httpx.AsyncClient(transport=transport, base_url="http://shard", timeout=config.SHARD_PROXY_TIMEOUT)
+            self._http_clients[worker_id] = client
+        return client
+
+    async def forward(self, worker_id, method, path, query, headers, body, stream=False):
+        """Forward a request to a worker over its unix socket and return the httpx response.
+
+        With stream=True the body is not read; the caller must close the response.
+        """
+        headers = {k: v for k, v in headers.items() if k.lower() not in _HOP_HEADERS}
+        client = self._client_for(worker_id)
+        # A stream may legitimately go quiet for long stretches (e.g. during a flood wait)
+        timeout = httpx.Timeout(config.SHARD_PROXY_TIMEOUT, read=None) if stream else client.timeout
+        request = client.build_request(method, path, params=query, headers=headers, content=body, timeout=timeout)
+        return await client.send(request, stream=stream)
+
+    async def close(self):
+        for client in self._http_clients.values():
+            await client.aclose()
+        self._http_clients.clear()
+
+    def get_status(self):
+        return {
+            "role": config.SHARD_ROLE or "single",
+            "shard_id": config.SHARD_ID,
+            "workers": self.ring.nodes,
+            "rebalances": self.rebalances,
+        }
+
+
+def extract_phone(query, body):
+    """Find the account phone in the query string or a JSON body."""
+    phone = query.get("phone")
+    if phone or not body:
+        return phone
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get("phone") if isinstance(data, dict) else None
+
+
+shards = ShardState()
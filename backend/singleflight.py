@@ -0,0 +1,79 @@
+import asyncio
+import config
+from cache import TTLCache
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls into one.
+
+    Callers pass a key describing the call, e.g. (phone, "get_messages", chat_id, ...).
+    While a call with that key is in flight, later callers await the same result
+    instead of starting their own; with a `ttl` the result is also reused for that
+    many seconds after it arrives. Errors are shared by the waiting callers but
+    never cached.
+    """
+
+    def __init__(self, ttl=0.0, maxsize=10000):
+        self.ttl = ttl
+        self._in_flight = {}
+        self._results = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0, "cached": 0, "errors": 0}
+
+    async def do(self, key, call, ttl=None):
+        """Return the result of `await call()`, sharing it with identical calls.
+
+        `ttl` overrides the default result lifetime; 0 only coalesces calls in flight.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self.stats["calls"] += 1
+        if ttl > 0:
+            found = self._results.get(key, _MISSING)
+            if found is not _MISSING:
+                self.stats["cached"] += 1
+                return found
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["executed"] += 1
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done, ttl))
+        # Shielded so a caller that goes away does not cancel the call the others wait for
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task, ttl):
+        # A call that forget() dropped while in flight may be stale: share it, don't cache it
+        current = self._in_flight.get(key) is task
+        if current:
+            del self._in_flight[key]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.stats["errors"] += 1
+        elif ttl > 0 and current:
+            self._results.set(key, task.result(), ttl=ttl)
+
+    def forget(self, *prefix):
+        """Drop the cached results of the calls whose key starts with `prefix`.
+
+        forget(phone) drops everything of an account, e.g. after it was disconnected;
+        a longer prefix drops the calls that a change made stale. Calls still in
+        flight keep serving their current waiters, but later callers start anew.
+        """
+        size = len(prefix)
+        for key, _ in self._results.items():
+            if key[:size] == prefix:
+                self._results.invalidate(key)
+        for key in [key for key in self._in_flight if key[:size] == prefix]:
+            del self._in_flight[key]
+
+    def get_stats(self):
+        return {**self.stats, "in_flight": len(self._in_flight), "cached_results": len(self._results), "ttl": self.ttl}
+
+
+_MISSING = object()
+
+# Shared by the Telegram calls made on behalf of API requests
+telegram_calls = SingleFlight(ttl=config.SINGLEFLIGHT_TTL)